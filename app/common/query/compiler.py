@@ -0,0 +1,202 @@
+import math
+
+import constant
+
+from app.common.error.status import Status, OK, INVALID_ARGUMENT, NOT_IMPLEMENTED, CALCULATE_PARAM_TYPE_ERROR, TYPE_ERROR
+from app.common.query.operators import operator_map
+from app.common.table.field import FieldNameProcessor
+
+# python types of field types declared in metadata
+_FIELD_TYPES = {'int': int, 'float': float, 'str': str, 'bool': bool}
+_LITERAL_TYPES = (int, str, bool, type(None))
+
+_ARITH_OPS = {
+    constant.OP_NAME_ADD: "+",
+    constant.OP_NAME_SUB: "-",
+    constant.OP_NAME_MUL: "*",
+    constant.OP_NAME_DIV: "/",
+}
+_COMPARISON_OPS = {
+    constant.OP_NAME_LT: "<",
+    constant.OP_NAME_LE: "<=",
+    constant.OP_NAME_GT: ">",
+    constant.OP_NAME_GE: ">=",
+}
+_LOGIC_OPS = {
+    constant.OP_NAME_AND: "&",
+    constant.OP_NAME_OR: "|",
+}
+
+
+class _ParamTypeError(Exception):
+    pass
+
+
+class _CodeGenerator:
+    """
+    turn an expression into straight-line python statements, one temporary variable per node
+    semantic is the same as ExprTree + operators.py, including the type checks of operands
+    a type check is dropped when types of operands are known in advance (literals, or fields declared in the schema)
+    """
+
+    def __init__(self, schemas: list[dict[str, str]] | None):
+        self.schemas = schemas or []
+        self.lines: list[str] = []
+        self.consts: dict[str, object] = {}
+        self.entry_indexes: set[int] = set()
+        self.tmp_cnt = 0
+
+    def _new_tmp(self) -> str:
+        self.tmp_cnt += 1
+        return "t{}".format(self.tmp_cnt)
+
+    def _emit(self, line: str):
+        self.lines.append(line)
+
+    def _emit_check(self, condition: str):
+        self._emit("if {}: raise _ParamTypeError".format(condition))
+
+    def _literal(self, value) -> (str, type):
+        if type(value) in _LITERAL_TYPES or (type(value) is float and math.isfinite(value)):
+            return repr(value), type(value)
+        name = "k{}".format(len(self.consts))
+        self.consts[name] = value
+        return name, type(value)
+
+    def _ref(self, field: str) -> (str, type | None):
+        table, name = FieldNameProcessor.get_outer_prefix(field), FieldNameProcessor.remove_outer_prefix(field)
+        try:
+            idx = int(table)
+        except ValueError:
+            raise SyntaxError("invalid table reference {}".format(field))
+        if idx < 0:
+            raise SyntaxError("invalid table reference {}".format(field))
+        self.entry_indexes.add(idx)
+        tmp = self._new_tmp()
+        self._emit("{} = e{}[{}]".format(tmp, idx, repr(name)))
+        field_type = None
+        if idx < len(self.schemas):
+            field_type = _FIELD_TYPES.get(self.schemas[idx].get(name))
+        return tmp, field_type
+
+    def generate(self, expr) -> (str, type | None):
+        """
+        :return: variable (or literal) holding the value of the expression, and its type if known
+        """
+        if type(expr) is not dict:
+            if type(expr) is not str or constant.QUERY_FIELD_REF_SYM not in expr:
+                return self._literal(expr)
+            return self._ref(expr)
+
+        op = expr.get(constant.QUERY_OP_KEY)
+        if op not in operator_map:
+            raise SyntaxError("unsupported operator {}".format(op))
+        if operator_map[op].get_param_cnt() == 1:
+            v, t = self.generate(expr[constant.QUERY_VAR1_KEY])
+            if t is not bool:
+                self._emit_check("type({}) is not bool".format(v))
+            tmp = self._new_tmp()
+            self._emit("{} = not {}".format(tmp, v))
+            return tmp, bool
+
+        v1, t1 = self.generate(expr[constant.QUERY_VAR1_KEY])
+        v2, t2 = self.generate(expr[constant.QUERY_VAR2_KEY])
+        tmp = self._new_tmp()
+        if op in _LOGIC_OPS:
+            # no type check for && and ||, same as LogicBiOperator
+            self._emit("{} = {} {} {}".format(tmp, v1, _LOGIC_OPS[op], v2))
+            return tmp, bool if t1 is bool and t2 is bool else None
+
+        if op in _ARITH_OPS:
+            for v, t in [(v1, t1), (v2, t2)]:
+                if t is not int and t is not float:
+                    self._emit_check("type({0}) is not int and type({0}) is not float".format(v))
+            self._emit("{} = {} {} {}".format(tmp, v1, _ARITH_OPS[op], v2))
+            if t1 not in (int, float) or t2 not in (int, float):
+                return tmp, None
+            return tmp, int if t1 is int and t2 is int and op != constant.OP_NAME_DIV else float
+
+        if op in _COMPARISON_OPS:
+            if t1 is None or t2 is None or not issubclass(t2, t1):
+                self._emit_check("not isinstance({}, type({}))".format(v2, v1))
+            self._emit("{} = {} {} {}".format(tmp, v1, _COMPARISON_OPS[op], v2))
+            return tmp, bool
+
+        # == and !=, 1 should not be considered the same as True
+        is_same_type = t1 is not None and t2 is not None and issubclass(t1, t2)
+        if op == constant.OP_NAME_EQ:
+            if not is_same_type:
+                self._emit_check("not isinstance({}, type({}))".format(v1, v2))
+            self._emit("{} = {} == {}".format(tmp, v1, v2))
+        elif is_same_type:
+            self._emit("{} = {} != {}".format(tmp, v1, v2))
+        else:
+            self._emit("{} = {} != {} if isinstance({}, type({})) else True".format(tmp, v1, v2, v1, v2))
+        return tmp, bool
+
+
+class CompiledExpr:
+    """
+    an expression compiled into python functions:
+        valuate(entries) -> value of the expression, same as ExprTree.valuate
+        get_mask(records) -> whether each record makes the expression True, only for expressions referencing the first entry
+    """
+
+    def __init__(self, source: str, namespace: dict):
+        self.source = source
+        exec(compile(source, "<expression>", "exec"), namespace)
+        self._valuate = namespace["_valuate"]
+        self._mask = namespace.get("_mask")
+
+    def valuate(self, entries: list[dict[str, object]]) -> (any, Status):
+        try:
+            return self._valuate(entries), OK
+        except (KeyError, IndexError):
+            # referenced entry or field doesn't exist
+            return None, INVALID_ARGUMENT
+        except _ParamTypeError:
+            return 0, CALCULATE_PARAM_TYPE_ERROR
+
+    def has_mask(self) -> bool:
+        return self._mask is not None
+
+    def get_mask(self, records: list[dict[str, object]]) -> (list[bool], Status):
+        if self._mask is None:
+            return [], NOT_IMPLEMENTED
+        try:
+            return self._mask(records), OK
+        except KeyError:
+            return [], INVALID_ARGUMENT
+        except _ParamTypeError:
+            return [], TYPE_ERROR
+
+
+def compile_expression(expression: any, schemas: list[dict[str, str]] | None = None) -> CompiledExpr | None:
+    """
+    compile an expression into a specialized python function, which is much faster than valuating the ExprTree recursively
+    :param expression: expression object in json format, with relative prefix
+    :param schemas: field types of each entry (i.e. metadata of sql tables), type checks are skipped for declared fields
+    :return: None if the expression is invalid
+    """
+    generator = _CodeGenerator(schemas)
+    try:
+        res, res_type = generator.generate(expression)
+    except (SyntaxError, KeyError, TypeError):
+        return None
+
+    prologue = ["e{0} = entries[{0}]".format(idx) for idx in sorted(generator.entry_indexes)]
+    body = prologue + generator.lines + ["return {}".format(res)]
+    source = "def _valuate(entries):\n" + "".join("    {}\n".format(line) for line in body)
+
+    if generator.entry_indexes <= {0}:
+        loop_body = generator.lines[:]
+        if res_type is not bool:
+            loop_body.append("if type({}) is not bool: raise _ParamTypeError".format(res))
+        loop_body.append("append({} is True)".format(res))
+        source += "\n\ndef _mask(records):\n    mask = []\n    append = mask.append\n    for e0 in records:\n"
+        source += "".join("        {}\n".format(line) for line in loop_body)
+        source += "    return mask\n"
+
+    namespace = dict(generator.consts)
+    namespace["_ParamTypeError"] = _ParamTypeError
+    return CompiledExpr(source, namespace)
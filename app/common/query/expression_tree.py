@@ -2,6 +2,7 @@ import constant
 
 from app.common.error.status import Status, INVALID_ARGUMENT, UNSUPPORTED, OK, NOT_IMPLEMENTED, INTERNAL, CALCULATE_PARAM_TYPE_ERROR
 from app.common.query.operators import operator_map, Operator
+from app.common.query.vector import Scalar
 from app.common.table.field import FieldNameProcessor
 
 
@@ -18,6 +19,14 @@ class Node:
     def valuate(self, entries: list[dict[str: object]]) -> (any, Status):
         return None, NOT_IMPLEMENTED
 
+    # batch mode, columns are column vectors of each entry (see vector.py), the result is a column vector of size rows
+    def valuate_batch(self, columns: list[dict[str, object]], size: int) -> (any, Status):
+        return None, NOT_IMPLEMENTED
+
+    # all references (to any entry) used by this node
+    def get_refs(self) -> list[RuntimeRef]:
+        return []
+
 
 class ExprNode(Node):
 
@@ -28,6 +37,9 @@ class ExprNode(Node):
     def append_child(self, node: Node):
         self.vals.append(node)
 
+    def get_refs(self) -> list[RuntimeRef]:
+        return [ref for val in self.vals if val is not None for ref in val.get_refs()]
+
     def valuate(self, entries) -> (any, Status):
         vals = []
         for val in self.vals:
@@ -37,6 +49,15 @@ class ExprNode(Node):
             vals.append(res)
         return self.op.valuate(*vals)
 
+    def valuate_batch(self, columns, size) -> (any, Status):
+        vals = []
+        for val in self.vals:
+            res, status = val.valuate_batch(columns, size)
+            if not status.ok():
+                return None, status
+            vals.append(res)
+        return self.op.valuate_batch(size, *vals)
+
 
 class LiteralNode(Node):
 
@@ -46,12 +67,18 @@ class LiteralNode(Node):
     def valuate(self, entries) -> (any, Status):
         return self.val, OK
 
+    def valuate_batch(self, columns, size) -> (any, Status):
+        return Scalar(self.val), OK
+
 
 class RuntimeRefNode(Node):
 
     def __init__(self, ref: RuntimeRef):
         self.ref = ref
 
+    def get_refs(self) -> list[RuntimeRef]:
+        return [self.ref]
+
     def valuate(self, entries) -> (any, Status):
         if self.ref.idx >= len(entries):
             return None, INVALID_ARGUMENT
@@ -60,6 +87,11 @@ class RuntimeRefNode(Node):
             return None, INVALID_ARGUMENT
         return entry[self.ref.name], OK
 
+    def valuate_batch(self, columns, size) -> (any, Status):
+        if self.ref.idx >= len(columns) or self.ref.name not in columns[self.ref.idx]:
+            return None, INVALID_ARGUMENT
+        return columns[self.ref.idx][self.ref.name], OK
+
 
 # The complicated operation expression tree can be evaluated recursively
 # e.g. for expression:
@@ -136,12 +168,24 @@ class ExprTree:
 
         return node, OK
 
+    # names of all fields of the idx-th entry used in the expression
+    def get_referenced_columns(self, idx: int = 0) -> set[str]:
+        if self.root is None:
+            return set()
+        return {ref.name for ref in self.root.get_refs() if ref.idx == idx}
+
     def valuate(self, entries: list[dict[str: object]]) -> (any, Status):
         if self.root is None:
             return None, INTERNAL
 
         return self.root.valuate(entries)
 
+    def valuate_batch(self, columns: list[dict[str, object]], size: int) -> (any, Status):
+        if self.root is None:
+            return None, INTERNAL
+
+        return self.root.valuate_batch(columns, size)
+
 
 if __name__ == "__main__":
     def test(expr, expected_value, expected_status, entries=None):
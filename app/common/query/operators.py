@@ -2,6 +2,29 @@ import operator
 
 import constant
 from app.common.error.status import Status, OK, CALCULATE_PARAM_CNT_ERROR, CALCULATE_PARAM_TYPE_ERROR
+from app.common.query.vector import Scalar, numpy, uniform_type, iterate, can_use_numpy, to_numpy_operand, valuate_by_codes
+
+
+def _is_number_vector(vector, size: int) -> bool:
+    t = uniform_type(vector)
+    if t is not None:
+        return t is int or t is float
+    return all(type(v) is int or type(v) is float for v in iterate(vector, size))
+
+
+def _is_bool_vector(vector, size: int) -> bool:
+    t = uniform_type(vector)
+    if t is not None:
+        return t is bool
+    return all(type(v) is bool for v in iterate(vector, size))
+
+
+def _is_instance_vector(vector, type_vector, size: int) -> bool:
+    # isinstance(v, type(t)) for each pair of values
+    t1, t2 = uniform_type(vector), uniform_type(type_vector)
+    if t1 is not None and t2 is not None:
+        return issubclass(t1, t2)
+    return all(isinstance(v, type(t)) for v, t in zip(iterate(vector, size), iterate(type_vector, size)))
 
 
 class Operator:
@@ -22,6 +45,26 @@ class Operator:
             return 0, CALCULATE_PARAM_CNT_ERROR
         return self.func(*args), OK
 
+    def valuate_batch(self, size: int, *args) -> (any, Status):
+        """
+        batch mode of valuate, args are column vectors of a batch with size rows (see vector.py)
+        :return: column vector of results
+        """
+        if self.get_param_cnt() != len(args):
+            return 0, CALCULATE_PARAM_CNT_ERROR
+        if all(isinstance(arg, Scalar) for arg in args):
+            res, status = self.valuate(*[arg.value for arg in args])
+            return Scalar(res), status
+        return self._batch_kernel(size, *args), OK
+
+    def _batch_kernel(self, size: int, *args):
+        res = valuate_by_codes(self.func, list(args))
+        if res is not None:
+            return res
+        if can_use_numpy(list(args)):
+            return self.func(*[to_numpy_operand(arg) for arg in args])
+        return [self.func(*values) for values in zip(*[iterate(arg, size) for arg in args])]
+
 
 class UniOperator(Operator):
 
@@ -45,6 +88,20 @@ class ArithOperator(Operator):
                 return 0, CALCULATE_PARAM_TYPE_ERROR
         return self.func(*args), OK
 
+    def valuate_batch(self, size: int, *args) -> (any, Status):
+        if self.get_param_cnt() != len(args):
+            return 0, CALCULATE_PARAM_CNT_ERROR
+        if all(isinstance(arg, Scalar) for arg in args):
+            return super().valuate_batch(size, *args)
+        if not all(_is_number_vector(arg, size) for arg in args):
+            return 0, CALCULATE_PARAM_TYPE_ERROR
+        if self.func is operator.truediv and can_use_numpy(list(args)):
+            # numpy produces inf instead of raising
+            divisor = to_numpy_operand(args[1])
+            if numpy.any(numpy.asarray(divisor) == 0):
+                raise ZeroDivisionError("division by zero")
+        return self._batch_kernel(size, *args), OK
+
 
 class LogicOperator(Operator):
 
@@ -56,6 +113,17 @@ class LogicOperator(Operator):
                 return 0, CALCULATE_PARAM_TYPE_ERROR
         return self.func(*args), OK
 
+    def valuate_batch(self, size: int, *args) -> (any, Status):
+        if self.get_param_cnt() != len(args):
+            return 0, CALCULATE_PARAM_CNT_ERROR
+        if all(isinstance(arg, Scalar) for arg in args):
+            return super().valuate_batch(size, *args)
+        if not all(_is_bool_vector(arg, size) for arg in args):
+            return 0, CALCULATE_PARAM_TYPE_ERROR
+        if self.func is operator.not_ and can_use_numpy(list(args)):
+            return numpy.logical_not(args[0]), OK
+        return self._batch_kernel(size, *args), OK
+
 
 class ComparisonOperator(Operator):
 
@@ -67,6 +135,15 @@ class ComparisonOperator(Operator):
 
         return self.func(*args), OK
 
+    def valuate_batch(self, size: int, *args) -> (any, Status):
+        if self.get_param_cnt() != len(args):
+            return 0, CALCULATE_PARAM_CNT_ERROR
+        if all(isinstance(arg, Scalar) for arg in args):
+            return super().valuate_batch(size, *args)
+        if not all(_is_instance_vector(arg, args[0], size) for arg in args):
+            return 0, CALCULATE_PARAM_TYPE_ERROR
+        return self._batch_kernel(size, *args), OK
+
 
 class ArithBiOperator(BiOperator, ArithOperator):
     pass
@@ -95,6 +172,18 @@ class EqualityBiOperator(BiOperator):
 
         return self.func(*args), OK
 
+    def valuate_batch(self, size: int, *args) -> (any, Status):
+        if self.get_param_cnt() != len(args):
+            return 0, CALCULATE_PARAM_CNT_ERROR
+        if all(isinstance(arg, Scalar) for arg in args):
+            return super().valuate_batch(size, *args)
+        if _is_instance_vector(args[0], args[1], size):
+            return self._batch_kernel(size, *args), OK
+        if self.get_name() != constant.OP_NAME_NE:
+            return 0, CALCULATE_PARAM_TYPE_ERROR  # for EQ
+        # values of different types are always not equal
+        return [v1 != v2 if isinstance(v1, type(v2)) else True for v1, v2 in zip(iterate(args[0], size), iterate(args[1], size))], OK
+
 
 class ComparisonBiOperator(BiOperator, ComparisonOperator):
     pass
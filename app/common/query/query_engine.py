@@ -7,20 +7,35 @@ import constant
 
 from app.common.context.context import Context
 from app.common.error.status import Status, INVALID_ARGUMENT, NOT_IMPLEMENTED, OK
+from app.common.query.result import QueryResult
+from app.common.table.chunk_cache import get_chunk_cache
 from app.common.table.field import FieldNameProcessor
-from app.common.table.manipulator import TableManipulator, JoinOption, SortOption, GroupByOption, ReduceOption, ReduceOperation
+from app.common.table.manipulator import JoinOption, SortOption, GroupByOption, ReduceOption, ReduceOperation
 from app.common.table.metadata import Metadata
+from app.common.table.pipeline import PhysicalOperator, ScanOp, FilterOp, ProjectOp, RenameOp, SortOp, TopKOp, AggregateOp, JoinOp, LimitOp, materialize, read_locked, locked_batches
 from app.common.table.selector import Selector, AlwaysTrueSelector
 from app.common.table.table import Table
 from app.common.table.table_manager import get_table_manager
 from app.services.database.sql.db_factory import DBFactory as SQLDBFactory
 
 
+class QueryState:
+    """
+    execution state of a single query, the engine itself is stateless so that queries can run concurrently
+    """
+
+    def __init__(self, tmp_tables: list[str] | None = None):
+        # inner prefix of join sides ("0", "1") -> prefix of their columns in the joined records
+        self.prefix_map: dict[str, str] = {}
+        # results of sub queries, shared by the outer query, which can be dropped once the query is finished
+        self.tmp_tables = tmp_tables if tmp_tables is not None else []
+
+
 class QueryEngine:
     """
     query will be parsed by dfs
     src_tables will be calculated first
-    TableManipulator will be used for query operations including: filtering, projection, ..., group by
+    each query is turned into a tree of physical operators (see pipeline.py) including: filtering, projection, ..., group by
     query result will be a single table (may be empty)
     """
 
@@ -28,9 +43,8 @@ class QueryEngine:
         self.cfg = ctx.get_cfg()
         self.logger = ctx.get_logger()
         self.tm = ctx.get_table_manager()
-        self.prefix_map = {}
 
-    def handle_src_table(self, q: dict) -> (Table | None, Status):
+    def handle_src_table(self, q: dict, state: QueryState) -> (PhysicalOperator | None, Status):
         if constant.QUERY_SRC_TABLE_KEY not in q:
             self.logger.error("at least one src table should be offered in query {}".format(q))
             return None, INVALID_ARGUMENT
@@ -41,7 +55,7 @@ class QueryEngine:
             if table is None:
                 self.logger.error("unable to join not existed table {}, should create it first".format(src_table))
                 return None, INVALID_ARGUMENT
-            return table, OK
+            return ScanOp(table), OK
 
         if constant.QUERY_JOIN_TABLE_LEFT_KEY not in src_table and constant.QUERY_SRC_TABLE_KEY not in src_table:
             self.logger.error("invalid subquery format in query {}".format(q))
@@ -50,31 +64,33 @@ class QueryEngine:
         if constant.QUERY_JOIN_TABLE_LEFT_KEY in src_table:
             left_table, right_table = src_table[constant.QUERY_JOIN_TABLE_LEFT_KEY], src_table[constant.QUERY_JOIN_TABLE_RIGHT_KEY]
             self.logger.info("multiple src tables are detected, try to join them: {}".format([left_table, right_table]))
+            if src_table[constant.QUERY_JOIN_TYPE_KEY] != JoinOption.outer.name:
+                self.logger.error("Not implemented other join option: {}".format(src_table[constant.QUERY_JOIN_TYPE_KEY]))
+                return None, NOT_IMPLEMENTED
             l, r = self.tm.get_table(left_table), self.tm.get_table(right_table)
             l_chunk, _ = l.chunk_manager.get_fist_chunk()
             r_chunk, _ = r.chunk_manager.get_fist_chunk()
-            self.prefix_map["0"], self.prefix_map["1"] = l.name, r.name
+            state.prefix_map["0"], state.prefix_map["1"] = l.name, r.name
             if FieldNameProcessor.get_prefix(list(l_chunk[0].keys())[0]) != "":
-                self.prefix_map["0"] = FieldNameProcessor.add_prefix(FieldNameProcessor.get_prefix(list(l_chunk[0].keys())[0]), l.name)
+                state.prefix_map["0"] = FieldNameProcessor.add_prefix(FieldNameProcessor.get_prefix(list(l_chunk[0].keys())[0]), l.name)
             if FieldNameProcessor.get_prefix(list(r_chunk[0].keys())[0]) != "":
-                self.prefix_map["1"] = FieldNameProcessor.add_prefix(FieldNameProcessor.get_prefix(list(r_chunk[0].keys())[0]), r.name)
-            res: Table = TableManipulator.join(l, r, Selector(src_table[constant.QUERY_JOIN_CONDITION_KEY]), src_table[constant.QUERY_JOIN_TYPE_KEY])
-            return res, OK
+                state.prefix_map["1"] = FieldNameProcessor.add_prefix(FieldNameProcessor.get_prefix(list(r_chunk[0].keys())[0]), r.name)
+            return JoinOp(ScanOp(l), l.name, r, Selector(src_table[constant.QUERY_JOIN_CONDITION_KEY], [l.metadata, r.metadata])), OK
 
-        table, status = self.handle_sub_query(src_table)
+        plan, status = self.handle_sub_query(src_table, state)
         if not status.ok():
             self.logger.error("unable to join due to failure to handle sub query {}".format(src_table))
             return None, status
-        return table, OK
+        return plan, OK
 
-    def handle_sub_query(self, sub_query: dict) -> (Table | None, Status):
-        table, status = self.handle_query(sub_query)
+    def handle_sub_query(self, sub_query: dict, state: QueryState) -> (PhysicalOperator | None, Status):
+        table, status = self.handle_query(sub_query, QueryState(state.tmp_tables))
         if not status.ok():
-            return table, status
+            return None, status
+        state.tmp_tables.append(table.name)
 
         # append table name to each field name
-        new_table = TableManipulator.rename_fields(table, {name: FieldNameProcessor.add_prefix(name, table.name) for name in table.metadata.get_all_field_names()})
-        return new_table, OK
+        return RenameOp(ScanOp(table), table.name), OK
 
     def parse_query_str(self, query_str: str) -> (dict, Status):
         try:
@@ -84,79 +100,134 @@ class QueryEngine:
             return {}, INVALID_ARGUMENT
         return q, OK
 
-    def handle_query(self, q: dict) -> (Table | None, Status):
+    def build_plan(self, q: dict, state: QueryState) -> (PhysicalOperator | None, Status):
+        """
+        build the operator tree of the query: src table -> group by -> filter -> sort -> projection -> limit
+        filter and projection are pushed down into the scan of the src table if possible
+        sorting with a limit which fits in the memory budget keeps only the top records instead of sorting all of them
+        """
         # 1. handle src table, may contain subquery and joining
-        src_table, status = self.handle_src_table(q)
+        plan, status = self.handle_src_table(q, state)
         if not status.ok():
             self.logger.error("failed to handle query {} due to failed to parse src_tables".format(q))
             return None, INVALID_ARGUMENT
 
-        res_table = src_table
+        limit, offset = q.get(constant.QUERY_LIMIT_KEY), q.get(constant.QUERY_OFFSET_KEY, 0)
+        for key, value in [(constant.QUERY_LIMIT_KEY, limit), (constant.QUERY_OFFSET_KEY, offset)]:
+            if value is not None and (type(value) is not int or value < 0):
+                self.logger.error("{} should be a non-negative integer, got {}".format(key, value))
+                return None, INVALID_ARGUMENT
+
+        memory_budget = self.cfg.get_memory_budget()
         # 2. handle group by
         if constant.QUERY_GROUP_BY in q:
-            # only support group by one column now
-            # TODO remove this check
             columns = q[constant.QUERY_GROUP_BY]
-            if len(columns) > 1:
-                self.logger.error("failed to handle more than one group by in query {}!".format(q))
-                return None, NOT_IMPLEMENTED
             reduce_options = []
             for column in q[constant.QUERY_DESIRED_COLUMNS_KEY]:
                 if FieldNameProcessor.get_suffix(column) != "":
-                    reduce_options.append(ReduceOption(column, ReduceOperation[FieldNameProcessor.get_suffix(column)]))
-            self.logger.info("grouping by table {}".format(res_table.name))
-            res_table = TableManipulator.group_by(res_table, GroupByOption(columns[0], reduce_options))
-            self.logger.info("group by on table {} is finished".format(res_table.name))
-
-        # 3. filter data
-        if constant.QUERY_FILTER_KEY in q:
-            expression = q[constant.QUERY_FILTER_KEY]
-            self.logger.info("filtering table {}".format(res_table.name))
-            res_table = TableManipulator.filter(res_table, Selector(expression))
-            self.logger.info("table is filtered, new_table is {}".format(res_table.name))
+                    reduce_options.append(ReduceOption(FieldNameProcessor.remove_outer_prefix(column), ReduceOperation[FieldNameProcessor.get_suffix(column)]))
+            self.logger.info("grouping by columns {}".format(columns))
+            plan = AggregateOp(plan, GroupByOption([FieldNameProcessor.remove_outer_prefix(column) for column in columns], reduce_options), memory_budget)
 
-        # 4. sorting
-        if constant.QUERY_ORDER_BY_KEY in q:
-            sort_options: list[dict] = q[constant.QUERY_ORDER_BY_KEY]
-            # only support order by one column now
-            # TODO remove this check
-            if len(sort_options) > 1:
-                self.logger.error("doesn't support order by 2 columns".format(q[constant.QUERY_ORDER_BY_KEY]))
-                return None, NOT_IMPLEMENTED
-            self.logger.info("sorting table {}".format(res_table.name))
-            res_table = TableManipulator.sort(res_table, [
-                SortOption(
-                    option.get(constant.QUERY_ORDER_BY_COLUMN_KEY),
-                    option.get(constant.QUERY_ORDER_BY_ASC_KEY)) if constant.QUERY_ORDER_BY_ASC_KEY in option else True  # default is asc
-                for option in sort_options
-            ])
-            self.logger.info("table is sorted, new table: {}".format(res_table.name))
-
-        # 5. projection
-        # keep all columns by default
+        # columns to keep, keep all columns by default
+        modified_columns = None
         if constant.QUERY_DESIRED_COLUMNS_KEY in q:
             columns = q[constant.QUERY_DESIRED_COLUMNS_KEY]
             modified_columns = []
             for column in columns:
-                if FieldNameProcessor.get_inner_prefix(column) in self.prefix_map:
-                    modified_columns.append(FieldNameProcessor.replace_inner_prefix(column, self.prefix_map[FieldNameProcessor.get_inner_prefix(column)]))
+                if FieldNameProcessor.get_inner_prefix(column) in state.prefix_map:
+                    modified_columns.append(FieldNameProcessor.replace_inner_prefix(column, state.prefix_map[FieldNameProcessor.get_inner_prefix(column)]))
                 else:
                     modified_columns.append(column)
             if len(modified_columns) == 0:
                 self.logger.warn("empty table due to empty desired_columns field in query: {} ".format(q))
                 return None, INVALID_ARGUMENT
-            self.logger.info("projecting table {} to columns: {}".format(res_table.name, modified_columns))
-            res_table = TableManipulator.projection(res_table, modified_columns)
-            self.logger.info("table is projected to columns: {}, new table is {}".format(modified_columns, res_table))
+            modified_columns = [FieldNameProcessor.remove_outer_prefix(column) for column in modified_columns]
+
+        # 3. filter data
+        if constant.QUERY_FILTER_KEY in q:
+            selector = Selector(q[constant.QUERY_FILTER_KEY], [plan.get_metadata()])
+            if type(plan) is ScanOp:
+                self.logger.info("filter is pushed down into the scan of table {}".format(plan.table.name))
+                plan.selector = selector
+            else:
+                plan = FilterOp(plan, selector)
+
+        # 4. sorting
+        if constant.QUERY_ORDER_BY_KEY in q:
+            sort_options: list[dict] = q[constant.QUERY_ORDER_BY_KEY]
+            if type(sort_options) is not list or len(sort_options) == 0:
+                self.logger.error("invalid order by {}".format(sort_options))
+                return None, INVALID_ARGUMENT
+            sort_options = [
+                SortOption(FieldNameProcessor.remove_outer_prefix(option.get(constant.QUERY_ORDER_BY_COLUMN_KEY)), option.get(constant.QUERY_ORDER_BY_ASC_KEY, True))  # default is asc
+                for option in sort_options
+            ]
+            if type(plan) is ScanOp and modified_columns is not None:
+                # sorting columns are needed even if they are not desired
+                plan.columns = modified_columns + [option.column for option in sort_options if option.column not in modified_columns]
+            if limit is not None and limit + offset <= memory_budget:
+                self.logger.info("keep top {} records instead of sorting all of them".format(limit + offset))
+                plan = TopKOp(plan, sort_options, limit + offset)
+            else:
+                plan = SortOp(plan, sort_options, memory_budget)
+
+        # 5. projection
+        if modified_columns is not None:
+            if type(plan) is ScanOp:
+                self.logger.info("projection is pushed down into the scan of table {}".format(plan.table.name))
+                plan.columns = modified_columns
+            else:
+                plan = ProjectOp(plan, modified_columns)
+
+        # 6. limit, the scan stops as soon as enough records are produced
+        if limit is not None or offset > 0:
+            plan = LimitOp(plan, limit, offset)
+
+        return plan, OK
 
+    def handle_query(self, q: dict, state: QueryState) -> (Table | None, Status):
+        plan, status = self.build_plan(q, state)
+        if not status.ok():
+            return None, status
+
+        # only the query result is written into a table, records flow between operators in memory
+        with read_locked(plan):
+            res_table = materialize(plan)
+        self.logger.info("query {} is finished, result table is {}".format(q, res_table.name))
+        self.logger.info("chunk cache stats: {}".format(get_chunk_cache().get_stats()))
         return res_table, OK
 
+    def stream(self, query: str) -> (QueryResult | None, Status):
+        """
+        run the query lazily, records are produced by the operator tree while the result is consumed
+        """
+        q, status = self.parse_query_str(query)
+        if not status.ok():
+            return None, INVALID_ARGUMENT
+
+        state = QueryState()
+        plan, status = self.build_plan(q, state)
+        if not status.ok():
+            self._drop_tmp_tables(state)
+            return None, status
+        self.logger.info("streaming results of query {}".format(q))
+        return QueryResult(plan.get_metadata(), locked_batches(plan), state.tmp_tables, self.tm), OK
+
     def run(self, query: str) -> (Table | None, Status):
         q, status = self.parse_query_str(query)
         if not status.ok():
             return None, INVALID_ARGUMENT
 
-        return self.handle_query(q)
+        state = QueryState()
+        table, status = self.handle_query(q, state)
+        # results of sub queries are no longer needed once the result is materialized
+        self._drop_tmp_tables(state)
+        return table, status
+
+    def _drop_tmp_tables(self, state: QueryState):
+        for table_name in state.tmp_tables:
+            self.tm.drop_table(table_name)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,40 @@
+from typing import Iterator, TYPE_CHECKING
+
+from app.common.table.metadata import Metadata
+
+if TYPE_CHECKING:
+    from app.common.table.table_manager import TableManager
+
+
 # all queries should return uniformed QueryResult or None
-# each result of query should be stored in a file to support streaming (thus the memory usage is reduced)
+# records are produced lazily by the operator tree while the result is streamed, nothing is written onto the disk
+# unless an operator has to spill (thus the memory usage and the time to the first record are reduced)
 class QueryResult:
 
-    def __init__(self, result_file_path):
-        self.result_file_path = result_file_path
+    def __init__(self, metadata: Metadata | None, batches: Iterator[list[dict[str, object]]], tmp_tables: list[str] | None = None,
+                 table_manager: 'TableManager' = None):
+        """
+        :param metadata: metadata of result records
+        :param batches: a generator of result batches, usually from the root of the operator tree
+        :param tmp_tables: tables created for the query (e.g. results of sub queries), dropped once the stream completes
+        :param table_manager: table manager owning the tmp tables
+        """
+        self.metadata = metadata
+        self._batches = batches
+        self.tmp_tables = tmp_tables if tmp_tables is not None else []
+        self.table_manager = table_manager
+
+    def get_metadata(self) -> Metadata:
+        return self.metadata
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        # tmp tables are dropped even if the consumer stops early, e.g. the client disconnects
+        try:
+            yield from self._batches
+        finally:
+            self.close()
 
-    def get_result_file_path(self) -> str:
-        return self.result_file_path
+    def close(self):
+        for table_name in self.tmp_tables:
+            self.table_manager.drop_table(table_name)
+        self.tmp_tables = []
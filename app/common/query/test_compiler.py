@@ -0,0 +1,100 @@
+from unittest import TestCase
+
+from app.common.error.status import OK
+from app.common.query.compiler import compile_expression
+from app.common.query.expression_tree import ExprTree
+from app.common.query.vector import make_vector
+from app.common.table.selector import Selector
+
+
+class Test(TestCase):
+
+    def test_compiled_expression_is_same_as_expr_tree(self):
+        entries = [{"a": 1, "b": 2.5, "c": "x", "d": True}, {"a": 3, "c": "y"}]
+        schemas = [{"a": "int", "b": "float", "c": "str", "d": "bool"}, {"a": "int", "c": "str"}]
+        expressions = [
+            True,
+            "0::a",
+            {"op": "+", "v1": "0::a", "v2": "0::b"},
+            {"op": "/", "v1": "0::a", "v2": 2},
+            {"op": "+", "v1": "0::c", "v2": 1},
+            {"op": "+", "v1": "0::d", "v2": 1},
+            {"op": "<", "v1": "0::a", "v2": "1::a"},
+            {"op": "<", "v1": "0::a", "v2": 1.5},
+            {"op": ">=", "v1": "0::b", "v2": 1},
+            {"op": "==", "v1": "0::c", "v2": "1::c"},
+            {"op": "==", "v1": "0::a", "v2": True},
+            {"op": "==", "v1": "0::d", "v2": 1},
+            {"op": "!=", "v1": "0::a", "v2": "1"},
+            {"op": "!=", "v1": "0::c", "v2": "x"},
+            {"op": "!", "v1": "0::d"},
+            {"op": "!", "v1": "0::a"},
+            {"op": "&&", "v1": {"op": "<", "v1": "0::a", "v2": 2}, "v2": {"op": "==", "v1": "0::c", "v2": "x"}},
+            {"op": "||", "v1": "0::d", "v2": {"op": "<", "v1": "0::a", "v2": 0}},
+            {"op": "||", "v1": "0::a", "v2": "1::a"},
+            {"op": "==", "v1": "0::missing", "v2": 1},
+            {"op": "==", "v1": "2::a", "v2": 1},
+            {"op": "==", "v1": "0::a", "v2": [1]},
+        ]
+        for expression in expressions:
+            expected_value, expected_status = ExprTree(expression).valuate(entries)
+            for field_types in [None, schemas]:
+                compiled = compile_expression(expression, field_types)
+                value, status = compiled.valuate(entries)
+                assert status.ok() == expected_status.ok(), expression
+                if status.ok():
+                    assert value == expected_value and type(value) is type(expected_value), expression
+
+        assert compile_expression({"op": "?", "v1": 1, "v2": 2}) is None
+        assert compile_expression({"op": "==", "v1": "a::b", "v2": 2}) is None
+
+    def test_mask(self):
+        records = [{"a": i, "c": "x" if i % 2 else "y"} for i in range(10)]
+        compiled = compile_expression({"op": "&&", "v1": {"op": ">", "v1": "0::a", "v2": 3}, "v2": {"op": "==", "v1": "0::c", "v2": "x"}}, [{"a": "int", "c": "str"}])
+        mask, status = compiled.get_mask(records)
+        assert status.ok()
+        assert mask == [i > 3 and i % 2 == 1 for i in range(10)]
+
+        # result is not a bool
+        mask, status = compile_expression("0::a").get_mask(records)
+        assert not status.ok()
+        # referencing other entries
+        assert not compile_expression({"op": "==", "v1": "0::a", "v2": "1::a"}).has_mask()
+
+    def test_batch_valuation_is_same_as_row_valuation(self):
+        records = [{"a": i, "b": i / 4, "c": "x" if i % 3 else "y", "d": i % 2 == 0} for i in range(20)]
+        field_types = {"a": "int", "b": "float", "c": "str", "d": "bool"}
+        expressions = [
+            True,
+            {"op": "<", "v1": "0::a", "v2": 7},
+            {"op": "<", "v1": 7, "v2": "0::a"},
+            {"op": "<", "v1": "0::b", "v2": 2},
+            {"op": ">=", "v1": "0::b", "v2": 2.0},
+            {"op": "==", "v1": "0::c", "v2": "x"},
+            {"op": "==", "v1": "0::a", "v2": "x"},
+            {"op": "!=", "v1": "0::a", "v2": "x"},
+            {"op": "!", "v1": "0::d"},
+            {"op": "!", "v1": "0::a"},
+            {"op": "&&", "v1": "0::d", "v2": {"op": "<", "v1": {"op": "*", "v1": "0::a", "v2": 2}, "v2": 20}},
+            {"op": "||", "v1": {"op": "==", "v1": "0::c", "v2": "y"}, "v2": {"op": ">", "v1": {"op": "/", "v1": "0::a", "v2": 4}, "v2": "0::b"}},
+            {"op": "<", "v1": {"op": "+", "v1": "0::c", "v2": 1}, "v2": 2},
+            {"op": "<", "v1": "0::missing", "v2": 2},
+        ]
+        for as_vectors in [False, True]:
+            columns = {name: [record[name] for record in records] for name in field_types}
+            if as_vectors:
+                columns = {name: make_vector(field_types[name], values) for name, values in columns.items()}
+            for expression in expressions:
+                selector = Selector(expression)
+                expected, expected_status = [], OK
+                for i, record in enumerate(records):
+                    match, status = selector.is_match([record])
+                    if not status.ok():
+                        expected_status = status
+                        break
+                    if match:
+                        expected.append(i)
+                selection, status = selector.get_selection(columns, len(records))
+                assert status.ok() == expected_status.ok(), expression
+                if status.ok():
+                    assert selection == expected, expression
@@ -1,5 +1,6 @@
 import json
 from unittest import TestCase
+from unittest.mock import patch
 import random
 import config
 import constant
@@ -78,6 +79,57 @@ class Test(TestCase):
             sorted_chunk = sorted(chunk, key=lambda x: x['col1'])
             assert chunk == sorted_chunk, f"Chunk {chunk_idx} is not sorted correctly."
 
+    def test_query_engine_limit(self):
+        table_name = "test_query_engine_limit"
+        self.tm.drop_table(table_name)
+        table, status = self.tm.create_table(table_name, Metadata(table_name, constant.DB_TYPE_SQL, [{"col1": "int"}, {"col2": "str"}]))
+        assert status.ok()
+        records = [{"col1": random.randint(0, 100), "col2": str(i)} for i in range(self.cfg.max_chunk_size * 4)]
+        status = table.insert_bulk(records)
+        assert status.ok()
+
+        # top k with a bounded heap, no run is spilled onto the disk
+        query = {"src_table": table_name, "order_by": [{"column": "::col1", "is_asc": False}], "limit": 10, "offset": 5}
+        tmp_table_cnt = self.tm.tmp_table_cnt
+        t, status = self.qe.run(json.dumps(query))
+        assert status.ok()
+        assert self.tm.tmp_table_cnt == tmp_table_cnt + 1
+        expected = sorted(records, key=lambda record: record["col1"], reverse=True)[5:15]
+        assert [entry for chunk in t.chunk_manager.get_iter() for entry in chunk] == expected
+
+        # without sorting, the scan stops once enough records are read
+        query = {"src_table": table_name, "desired_columns": ["::col2"], "limit": 3, "offset": 2}
+        cm = table.chunk_manager
+        cm.cache.invalidate_table(cm.table_path)
+        scanned, scan_chunk = [], cm.reader.scan
+        with patch.object(cm.reader, "scan", side_effect=lambda chunk, *args: scanned.append(chunk.chunk_path) or scan_chunk(chunk, *args)):
+            t, status = self.qe.run(json.dumps(query))
+        assert status.ok()
+        assert [entry for chunk in t.chunk_manager.get_iter() for entry in chunk] == [{"col2": str(i)} for i in range(2, 5)]
+        assert scanned == [cm.get_chunk_path(0)]
+
+        for invalid in [{"limit": -1}, {"limit": "10"}, {"offset": 1.5}]:
+            _, status = self.qe.run(json.dumps({"src_table": table_name, **invalid}))
+            assert not status.ok()
+
+    def test_query_engine_stream(self):
+        table_name = "test_query_engine_stream"
+        self.tm.drop_table(table_name)
+        table, status = self.tm.create_table(table_name, Metadata(table_name, constant.DB_TYPE_SQL, [{"col1": "int"}, {"col2": "str"}]))
+        assert status.ok()
+        status = table.insert_bulk([{"col1": i, "col2": "a,b" if i % 2 else "c"} for i in range(self.cfg.max_chunk_size * 2)])
+        assert status.ok()
+
+        query = {"src_table": {"src_table": table_name, "row_filter": {"op": "<", "v1": "0::col1", "v2": 4}, "desired_columns": ["::col2"]}}
+        result, status = self.qe.stream(json.dumps(query))
+        assert status.ok()
+        # the result of the sub query is materialized, the outer query is not
+        assert len(result.tmp_tables) == 1 and self.tm.get_table(result.tmp_tables[0]) is not None
+        sub_table = result.tmp_tables[0]
+        output = "".join(SQLDBFactory.instance().format_output(result))
+        assert output.splitlines() == ["{}::col2".format(sub_table), "c", '"a,b"', "c", '"a,b"']
+        assert sub_table not in self.tm.table_map
+
     def test_query_engine_join(self):
         table_name1, table_name2 = "test_query_engine_join_1", "test_query_engine_join_2"
         self.tm.drop_table(table_name1)
@@ -109,3 +161,26 @@ class Test(TestCase):
             ]
         }
         self.qe.run(json.dumps(query))
+
+    def test_query_engine_filter_and_projection(self):
+        for chunk_format in [constant.CHUNK_FORMAT_CSV, constant.CHUNK_FORMAT_COLUMNAR]:
+            table_name = "test_query_engine_filter_and_projection_" + chunk_format
+            self.tm.drop_table(table_name)
+            table, status = self.tm.create_table(table_name, Metadata(table_name, constant.DB_TYPE_SQL, [{"col1": "int"}, {"col2": "str"}, {"col3": "float"}], chunk_format))
+            assert status.ok()
+            status = table.insert_bulk([{"col1": i, "col2": str(i % 3), "col3": i / 4} for i in range(self.cfg.max_chunk_size * 2)])
+            assert status.ok()
+
+            query = {
+                "src_table": table_name,
+                "row_filter": {"op": "&&", "v1": {"op": "<", "v1": "0::col1", "v2": 20}, "v2": {"op": "==", "v1": "0::col2", "v2": "1"}},
+                "desired_columns": ["::col3", "::col2"]
+            }
+            tmp_table_cnt = self.tm.tmp_table_cnt
+            t, status = self.qe.run(json.dumps(query))
+            assert status.ok()
+            # filter and projection are done in a single scan
+            assert self.tm.tmp_table_cnt == tmp_table_cnt + 1
+            assert t.metadata.get_all_field_names() == ["col3", "col2"]
+            records = [entry for chunk in t.chunk_manager.get_iter() for entry in chunk]
+            assert records == [{"col3": i / 4, "col2": "1"} for i in range(1, 20, 3)]
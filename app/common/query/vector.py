@@ -0,0 +1,127 @@
+import itertools
+from array import array
+
+try:
+    import numpy
+except ImportError:  # numpy is optional, column vectors fall back to array/list
+    numpy = None
+
+# a column vector of a batch is one of: list, array.array (int/float), numpy.ndarray, DictionaryVector (str) or Scalar (a literal)
+_ARRAY_CODES = {'int': 'q', 'float': 'd'}
+_ARRAY_TYPES = {'q': int, 'd': float}
+_NUMPY_DTYPES = {'int': 'int64', 'float': 'float64', 'bool': 'bool'}
+_NUMPY_KINDS = {'i': int, 'u': int, 'f': float, 'b': bool}
+
+
+class Scalar:
+    """
+    a literal, which is the same for every row of a batch
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+
+class DictionaryVector:
+    """
+    a str column vector stored as codes of its distinct values, e.g. a dictionary encoded column of a columnar chunk
+    an operator on it and literals is valuated once for each distinct value instead of each row (see valuate_by_codes)
+    """
+
+    def __init__(self, values: list[str], codes):
+        """
+        :param values: distinct values
+        :param codes: index of the value of each row, numpy.ndarray or array.array
+        """
+        self.values = values
+        self.codes = codes
+
+    def decode(self) -> list[str]:
+        values = self.values
+        return [values[code] for code in self.codes.tolist()]
+
+
+def is_numpy(vector) -> bool:
+    return numpy is not None and isinstance(vector, numpy.ndarray)
+
+
+def uniform_type(vector) -> type | None:
+    """
+    :return: python type shared by all values of the vector, None if values need to be checked one by one
+    """
+    if isinstance(vector, Scalar):
+        return type(vector.value)
+    if isinstance(vector, DictionaryVector):
+        return str
+    if isinstance(vector, array):
+        return _ARRAY_TYPES.get(vector.typecode)
+    if is_numpy(vector):
+        return _NUMPY_KINDS.get(vector.dtype.kind)
+    return None
+
+
+def iterate(vector, size: int):
+    if isinstance(vector, Scalar):
+        return itertools.repeat(vector.value, size)
+    if isinstance(vector, DictionaryVector):
+        return vector.decode()
+    return vector
+
+
+def valuate_by_codes(func, args: list):
+    """
+    valuate func on a dictionary vector and literals, e.g. 0::a == "x", the result of each distinct value is looked up by codes
+    :return: column vector of results, None if args are not a single dictionary vector and literals
+    """
+    vectors = [arg for arg in args if not isinstance(arg, Scalar)]
+    if len(vectors) != 1 or not isinstance(vectors[0], DictionaryVector):
+        return None
+    vector = vectors[0]
+    results = [func(*[value if arg is vector else arg.value for arg in args]) for value in vector.values]
+    if is_numpy(vector.codes) and all(type(res) is bool for res in results):
+        return numpy.array(results, dtype=bool)[vector.codes]
+    return [results[code] for code in vector.codes.tolist()]
+
+
+def can_use_numpy(vectors: list) -> bool:
+    # literals are broadcast by numpy, other literals (e.g. str) are compared one by one
+    if not any(is_numpy(vector) for vector in vectors):
+        return False
+    return all(is_numpy(vector) or uniform_type(vector) in _NUMPY_KINDS.values() for vector in vectors)
+
+
+def to_numpy_operand(vector):
+    return vector.value if isinstance(vector, Scalar) else vector
+
+
+def make_vector(field_type: str, values: list):
+    """
+    build a column vector from values of the declared field type
+    """
+    try:
+        if numpy is not None and field_type in _NUMPY_DTYPES:
+            return numpy.array(values, dtype=_NUMPY_DTYPES[field_type])
+        if field_type in _ARRAY_CODES:
+            return array(_ARRAY_CODES[field_type], values)
+    except (OverflowError, TypeError):
+        pass
+    return values
+
+
+def selection_indexes(vector, size: int) -> list[int] | None:
+    """
+    :return: indexes of rows whose value is True, None if any value is not a bool
+    """
+    if isinstance(vector, Scalar):
+        if type(vector.value) is not bool:
+            return None
+        return list(range(size)) if vector.value else []
+    if is_numpy(vector):
+        if vector.dtype.kind != 'b':
+            return None
+        return numpy.flatnonzero(vector).tolist()
+    if uniform_type(vector) is not None:
+        return None
+    if not all(type(value) is bool for value in vector):
+        return None
+    return [i for i, value in enumerate(vector) if value]
@@ -0,0 +1,181 @@
+import base64
+import hashlib
+import json
+import math
+import os
+
+import constant
+from app.common.table.zone_map import parse_comparison
+
+
+def hash_value(value) -> tuple[int, int] | None:
+    """
+    hash a value the same way in every process (unlike hash() of str), values equal in python get the same hash,
+    e.g. 1, 1.0 and True
+    :return: None if the value is not a scalar, which is never added to or looked up in a bloom filter
+    """
+    if value is None:
+        data = b"z"
+    elif type(value) in (bool, int, float):
+        try:
+            # -0.0 + 0.0 is 0.0
+            data = b"n" + repr(float(value) + 0.0).encode("utf-8")
+        except OverflowError:
+            data = b"n" + str(value).encode("utf-8")
+    elif type(value) is str:
+        data = b"s" + value.encode("utf-8", "surrogatepass")
+    else:
+        return None
+    digest = hashlib.blake2b(data, digest_size=16).digest()
+    return int.from_bytes(digest[:8], "little"), int.from_bytes(digest[8:], "little") | 1
+
+
+class BloomFilter:
+    """
+    set of values without false negatives, positions of a value are derived from two hashes (see hash_value)
+    """
+
+    def __init__(self, bit_cnt: int, hash_cnt: int, bits: bytearray | None = None):
+        self.bit_cnt = bit_cnt
+        self.hash_cnt = hash_cnt
+        self.bits = bytearray((bit_cnt + 7) // 8) if bits is None else bits
+
+    @staticmethod
+    def create(capacity: int, fpp: float) -> 'BloomFilter':
+        """
+        :param capacity: expected number of distinct values
+        :param fpp: false positive probability when the filter holds capacity values
+        """
+        bit_cnt = max(8, math.ceil(-capacity * math.log(fpp) / math.log(2) ** 2))
+        hash_cnt = max(1, round(bit_cnt / max(1, capacity) * math.log(2)))
+        return BloomFilter(bit_cnt, hash_cnt)
+
+    def _get_positions(self, h: tuple[int, int]):
+        return ((h[0] + i * h[1]) % self.bit_cnt for i in range(self.hash_cnt))
+
+    def add(self, value):
+        h = hash_value(value)
+        if h is None:
+            return
+        for pos in self._get_positions(h):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def may_contain_hash(self, h: tuple[int, int]) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._get_positions(h))
+
+    def may_contain(self, value) -> bool:
+        h = hash_value(value)
+        return h is None or self.may_contain_hash(h)
+
+    def to_json_obj(self) -> dict:
+        return {"bit_cnt": self.bit_cnt, "hash_cnt": self.hash_cnt, "bits": base64.b64encode(self.bits).decode("ascii")}
+
+    @staticmethod
+    def from_json_obj(obj: dict) -> 'BloomFilter':
+        return BloomFilter(obj["bit_cnt"], obj["hash_cnt"], bytearray(base64.b64decode(obj["bits"])))
+
+
+class BloomFilters:
+    """
+    per-chunk bloom filters of columns chosen when the table is created, persisted in a sidecar file under the table dir
+    they skip chunks on equality with a value, e.g. unsorted string columns whose min/max in the zone map skip nothing
+    a filter is sized for a full chunk, rows are only added to it (until the chunk is rewritten), so it never rules out a live row
+    """
+
+    def __init__(self, path: str, columns: list[str], capacity: int, fpp: float, converters: dict | None = None):
+        """
+        :param converters: column -> function converting a value into the type of the field (see csv_adapter.get_converter),
+            values are hashed the same as they are stored, e.g. "2023" of an int column is hashed as 2023. None for nosql
+        """
+        self.path = path
+        self.columns = columns
+        self.converters = {} if converters is None else converters
+        self.capacity = capacity
+        self.fpp = fpp
+        self.chunks: dict[int, dict[str, BloomFilter]] = {}
+
+    def is_empty(self) -> bool:
+        return len(self.columns) == 0
+
+    def load(self):
+        if self.is_empty() or not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            obj = json.load(f)
+        self.chunks = {int(idx): {column: BloomFilter.from_json_obj(bloom) for column, bloom in filters.items()} for idx, filters in obj.items()}
+
+    def save(self):
+        if self.is_empty() or not os.path.exists(os.path.dirname(self.path)):
+            return
+        # same as ZoneMap.save
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({idx: {column: bloom.to_json_obj() for column, bloom in filters.items()} for idx, filters in self.chunks.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def _build(self, chunk: list[dict[str, object]]) -> dict[str, BloomFilter]:
+        filters = {column: BloomFilter.create(self.capacity, self.fpp) for column in self.columns}
+        self._add(filters, chunk)
+        return filters
+
+    def _add(self, filters: dict[str, BloomFilter], records: list[dict[str, object]]):
+        for column, bloom in filters.items():
+            convert = self.converters.get(column)
+            for record in records:
+                if column in record:
+                    bloom.add(record[column] if convert is None else convert(record[column]))
+
+    def set_chunk(self, chunk_idx: int, chunk: list[dict[str, object]]):
+        if not self.is_empty():
+            self.chunks[chunk_idx] = self._build(chunk)
+
+    def append_to_chunk(self, chunk_idx: int, records: list[dict[str, object]]):
+        if chunk_idx in self.chunks:
+            self._add(self.chunks[chunk_idx], records)
+
+    # same as ChunkManifest.replace_chunks
+    def replace_chunks(self, start: int, end: int, chunks: list[list[dict[str, object]]]):
+        if self.is_empty():
+            return
+        shift = (end - start) - len(chunks)
+        new_filters = {idx if idx < start else idx - shift: filters for idx, filters in self.chunks.items() if idx < start or idx >= end}
+        for i, chunk in enumerate(chunks):
+            new_filters[start + i] = self._build(chunk)
+        self.chunks = new_filters
+
+    def clear(self):
+        self.chunks = {}
+
+    def has_filter(self, column: str) -> bool:
+        return column in self.columns
+
+    def may_contain_any(self, chunk_idx: int, column: str, hashes: list[tuple[int, int]]) -> bool:
+        """
+        :param hashes: hashes of values, see hash_value
+        :return: False only when the chunk has none of the values in the column
+        """
+        bloom = self.chunks.get(chunk_idx, {}).get(column)
+        return bloom is None or any(bloom.may_contain_hash(h) for h in hashes)
+
+    def may_match(self, chunk_idx: int, expression: any) -> bool:
+        """
+        only &&, || and equalities between a column with a bloom filter and a literal are used for pruning, same as ZoneMap
+        :return: False only when no row in the chunk can satisfy the expression
+        """
+        filters = self.chunks.get(chunk_idx)
+        return filters is None or self._may_match(filters, expression)
+
+    def _may_match(self, filters: dict[str, BloomFilter], expression: any) -> bool:
+        if type(expression) is not dict:
+            return True
+        op = expression.get(constant.QUERY_OP_KEY)
+        if op == constant.OP_NAME_AND:
+            return self._may_match(filters, expression.get(constant.QUERY_VAR1_KEY)) and self._may_match(filters, expression.get(constant.QUERY_VAR2_KEY))
+        if op == constant.OP_NAME_OR:
+            return self._may_match(filters, expression.get(constant.QUERY_VAR1_KEY)) or self._may_match(filters, expression.get(constant.QUERY_VAR2_KEY))
+        if op != constant.OP_NAME_EQ:
+            return True
+        comparison = parse_comparison(expression)
+        if comparison is None or comparison[0] not in filters:
+            return True
+        return filters[comparison[0]].may_contain(comparison[2])
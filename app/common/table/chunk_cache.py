@@ -0,0 +1,104 @@
+import sys
+import threading
+from collections import OrderedDict
+
+import config
+
+# number of records sampled to estimate the memory used by a decoded chunk
+_SIZE_SAMPLE_CNT = 16
+
+
+def estimate_size(chunk: list[dict[str, object]]) -> int:
+    """
+    rough number of bytes used by a decoded chunk, estimated from a few records
+    """
+    if len(chunk) == 0:
+        return sys.getsizeof(chunk)
+    samples = chunk[:_SIZE_SAMPLE_CNT]
+    sample_size = sum(sys.getsizeof(record) + sum(sys.getsizeof(k) + sys.getsizeof(v) for k, v in record.items()) for record in samples)
+    return sys.getsizeof(chunk) + sample_size * len(chunk) // len(samples)
+
+
+class ChunkCache:
+    """
+    LRU cache of decoded chunks shared by all tables of the process, bounded by the estimated size in bytes
+    entries are keyed by (table path, chunk idx) and tagged with the version of the chunk in the manifest,
+    an entry of an older version is never returned
+    records are copied in and out, callers are free to modify loaded chunks
+    all methods are thread safe
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 0
+        # (table path, chunk idx) -> (version, records, size)
+        self.entries: OrderedDict[tuple[str, int], tuple[int, list[dict[str, object]], int]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, table_path: str, chunk_idx: int, version: int) -> list[dict[str, object]] | None:
+        key = (table_path, chunk_idx)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.entries.move_to_end(key)
+        return [dict(record) for record in entry[1]]
+
+    def contains(self, table_path: str, chunk_idx: int, version: int) -> bool:
+        with self.lock:
+            entry = self.entries.get((table_path, chunk_idx))
+        return entry is not None and entry[0] == version
+
+    def put(self, table_path: str, chunk_idx: int, version: int, chunk: list[dict[str, object]]):
+        size = estimate_size(chunk)
+        records = [dict(record) for record in chunk]
+        with self.lock:
+            self._invalidate(table_path, chunk_idx)
+            if size > self.capacity:
+                return
+            self.entries[(table_path, chunk_idx)] = (version, records, size)
+            self.size += size
+            while self.size > self.capacity:
+                _, (_, _, evicted_size) = self.entries.popitem(last=False)
+                self.size -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, table_path: str, chunk_idx: int):
+        with self.lock:
+            self._invalidate(table_path, chunk_idx)
+
+    def _invalidate(self, table_path: str, chunk_idx: int):
+        entry = self.entries.pop((table_path, chunk_idx), None)
+        if entry is not None:
+            self.size -= entry[2]
+
+    def invalidate_table(self, table_path: str):
+        with self.lock:
+            for key in [key for key in self.entries if key[0] == table_path]:
+                self._invalidate(*key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def get_stats(self) -> dict[str, int]:
+        with self.lock:
+            return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                    "entries": len(self.entries), "size": self.size, "capacity": self.capacity}
+
+
+chunk_cache_singleton = None
+
+
+def get_chunk_cache(capacity: int = config.chunk_cache_size) -> ChunkCache:
+    # the capacity only takes effect when the cache is created
+    global chunk_cache_singleton
+    if chunk_cache_singleton is None:
+        chunk_cache_singleton = ChunkCache(capacity)
+    return chunk_cache_singleton
@@ -1,36 +1,201 @@
 import csv
+import itertools
 import json
 import os
+from typing import TYPE_CHECKING
 
 import constant
 
 import config
 from app.common.context.context import Context
-from app.common.error.status import Status, OK, FILE_NOT_EXIST, INVALID_ARGUMENT, UNSUPPORTED, UNKNOWN, FILE_EXIST, INTERNAL
+from app.common.error.status import Status, OK, FILE_NOT_EXIST, INVALID_ARGUMENT, UNSUPPORTED, UNKNOWN, FILE_EXIST, INTERNAL, INCONSISTENT
+from app.common.query.vector import make_vector
 from app.common.table.metadata import Metadata
-from app.common.table.csv_adapter import row_to_object, object_to_row
+from app.common.table.csv_adapter import row_to_object, object_to_row, get_converter
+from app.common.table.columnar import encode_chunk, decode_chunk, decode_columns
+from app.common.table.chunk_cache import get_chunk_cache
+from app.common.table import ndjson_chunk
+from app.common.table.bloom_filter import BloomFilters
+from app.common.table.index import IndexManager
+from app.common.table.manifest import ChunkManifest
+from app.common.table.tombstone import TombstoneManager, DeletionBitmap
+from app.common.table.wal import WriteAheadLog, fsync_path
+from app.common.table.zone_map import ZoneMap
+
+if TYPE_CHECKING:
+    from app.common.table.selector import Selector
+
+# lines of an ndjson chunk decoded and filtered at a time during a scan
+_NDJSON_SCAN_BATCH = 1024
 
 
 class ChunkIterator:
 
-    def __init__(self, chunk_manager: 'ChunkManager'):
+    # if expression is offered, chunks which can't satisfy the expression (according to the zone map) are skipped
+    # deleted rows are removed from chunks unless include_deleted, e.g. to build indexes which refer to offsets of rows
+    def __init__(self, chunk_manager: 'ChunkManager', expression: any = None, include_deleted: bool = False):
         self.chunk_manager = chunk_manager
         self.current = 0
+        self.expression = expression
+        self.include_deleted = include_deleted
 
     def __iter__(self):
         return self
 
     def __next__(self):
+        if self.expression is not None:
+            while self.current < self.chunk_manager.get_chunk_cnt() and not self.chunk_manager.may_match(self.current, self.expression):
+                self.current += 1
         if self.current < self.chunk_manager.get_chunk_cnt():
             chunk, status = self.chunk_manager.load_chunk(self.current)
             if not status.ok():
                 raise ValueError("failed to load next chunk!")
+            if not self.include_deleted:
+                chunk = self.chunk_manager.remove_deleted(self.current, chunk)
             self.current += 1
             return chunk
         else:
             raise StopIteration
 
 
+class ChunkFile:
+    """
+    files of a chunk and its state when it's taken, enough to scan the chunk without its manager (see ChunkReader)
+    rows appended since are ignored, so it can be scanned while the chunk is written, e.g. by a scanning process
+    """
+
+    def __init__(self, chunk_path: str, tail_path: str, row_cnt: int | None, deleted: DeletionBitmap | None):
+        self.chunk_path = chunk_path
+        self.tail_path = tail_path
+        # None if unknown, then all rows in the files are scanned
+        self.row_cnt = row_cnt
+        self.deleted = deleted
+
+
+class ChunkReader:
+    """
+    filter and project chunk files of a table, it never writes anything and only holds the metadata of the table
+    """
+
+    def __init__(self, metadata: Metadata, db_type: str):
+        self.metadata = metadata
+        self.is_sql = db_type == constant.DB_TYPE_SQL
+        self.is_columnar = self.is_sql and metadata.is_columnar()
+        self.is_ndjson = not self.is_sql and metadata.is_ndjson()
+
+    def scan(self, chunk: ChunkFile, selector: 'Selector | None' = None, columns: list[str] | None = None) -> list[dict[str, object]]:
+        """
+        records of the chunk satisfying the selector, only columns used by the selector or desired are decoded,
+        and a record is built only when it satisfies the selector
+        """
+        if self.is_columnar:
+            return self._scan_columnar_chunk(chunk, selector, columns)
+        if self.is_sql:
+            return self._scan_csv_chunk(chunk, selector, columns)
+        if self.is_ndjson:
+            return self._scan_ndjson_chunk(chunk, selector, columns)
+        records = self._read_json_chunk(chunk)
+        return self.filter_records(records if chunk.deleted is None else chunk.deleted.filter(records), selector, columns)
+
+    def _select(self, chunk: ChunkFile, selector: 'Selector | None', filter_vectors: dict[str, object], row_cnt: int) -> list[int] | range:
+        """
+        valuate the selector on column vectors of the whole chunk at once
+        :return: indexes of matched rows which are not deleted
+        """
+        if selector is None:
+            selection = range(row_cnt)
+        else:
+            selection, status = selector.get_selection(filter_vectors, row_cnt)
+            if not status.ok():
+                raise RuntimeError("selector failed to valuate expression")
+        if chunk.row_cnt is not None and chunk.row_cnt < row_cnt:
+            selection = [i for i in selection if i < chunk.row_cnt]
+        if chunk.deleted is None:
+            return selection
+        return [i for i in selection if i not in chunk.deleted]
+
+    def _get_scan_names(self, selector: 'Selector | None', columns: list[str] | None) -> (list[str], list[str]):
+        field_names = self.metadata.get_all_field_names()
+        filter_names = [] if selector is None else [name for name in field_names if name in selector.get_referenced_columns()]
+        out_names = field_names if columns is None else [name for name in columns if name in field_names]
+        return filter_names, out_names
+
+    def _scan_columnar_chunk(self, chunk: ChunkFile, selector: 'Selector | None', columns: list[str] | None) -> list[dict[str, object]]:
+        filter_names, out_names = self._get_scan_names(selector, columns)
+        with open(chunk.chunk_path, 'rb') as file:
+            data = file.read()
+        row_cnt, filter_vectors = decode_columns(data, self.metadata, set(filter_names), as_vectors=True)
+        selection = self._select(chunk, selector, filter_vectors, row_cnt)
+        if len(selection) == 0:
+            return []
+        # only matched rows are turned into records
+        _, out_columns = decode_columns(data, self.metadata, set(out_names))
+        if len(selection) == row_cnt:
+            out_rows = zip(*[out_columns[name] for name in out_names])
+        else:
+            out_rows = zip(*[[out_columns[name][i] for i in selection] for name in out_names])
+        if len(out_names) == 0:
+            return [{} for _ in selection]
+        return [dict(zip(out_names, values)) for values in out_rows]
+
+    def _scan_csv_chunk(self, chunk: ChunkFile, selector: 'Selector | None', columns: list[str] | None) -> list[dict[str, object]]:
+        filter_names, out_names = self._get_scan_names(selector, columns)
+        field_names = self.metadata.get_all_field_names()
+        out_fields = [(name, field_names.index(name), get_converter(self.metadata.get_field_type(name))) for name in out_names]
+
+        with open(chunk.chunk_path, 'r', newline='') as file:
+            rows = list(itertools.islice(csv.reader(file), chunk.row_cnt))
+        # only cells used by the selector are converted before filtering
+        filter_vectors = {}
+        for name in filter_names:
+            i, field_type = field_names.index(name), self.metadata.get_field_type(name)
+            convert = get_converter(field_type)
+            filter_vectors[name] = make_vector(field_type, [convert(row[i]) for row in rows])
+        selection = self._select(chunk, selector, filter_vectors, len(rows))
+        return [{name: convert(rows[j][i]) for name, i, convert in out_fields} for j in selection]
+
+    def _scan_ndjson_chunk(self, chunk: ChunkFile, selector: 'Selector | None', columns: list[str] | None) -> list[dict[str, object]]:
+        # records are decoded and filtered a batch of lines at a time, the whole chunk is never materialized
+        result = []
+        records = itertools.islice(ndjson_chunk.iter_records(chunk.chunk_path), chunk.row_cnt)
+        offset = 0
+        while True:
+            batch = list(itertools.islice(records, _NDJSON_SCAN_BATCH))
+            if len(batch) == 0:
+                return result
+            if chunk.deleted is not None:
+                batch = [entry for i, entry in enumerate(batch, offset) if i not in chunk.deleted]
+            offset += _NDJSON_SCAN_BATCH
+            result += self.filter_records(batch, selector, columns)
+
+    # the tail log is read before the chunk, which may have taken in the rows of the tail log since
+    def _read_json_chunk(self, chunk: ChunkFile) -> list[dict[str, object]]:
+        tail = []
+        try:
+            with open(chunk.tail_path, 'r') as file:
+                for line in file:
+                    try:
+                        tail.append(json.loads(line))
+                    except ValueError:
+                        break
+        except FileNotFoundError:
+            pass
+        with open(chunk.chunk_path, 'r') as file:
+            records = json.load(file) + tail
+        return records if chunk.row_cnt is None else records[:chunk.row_cnt]
+
+    @staticmethod
+    def filter_records(records: list[dict[str, object]], selector: 'Selector | None', columns: list[str] | None) -> list[dict[str, object]]:
+        if selector is not None:
+            mask, status = selector.get_mask(records)
+            if not status.ok():
+                raise RuntimeError("selector failed to valuate expression")
+            records = [entry for entry, match in zip(records, mask) if match]
+        if columns is None:
+            return records
+        return [{column: entry[column] for column in columns if column in entry} for entry in records]
+
+
 class ChunkManager:
 
     # metadata is only used for SQL
@@ -39,44 +204,139 @@ class ChunkManager:
         self.table_path = table_path
         self.ctx = ctx
         self.logger = self.ctx.get_logger()
-        self.total_chunks = 0
-        self.ext = self.ctx.get_cfg().get_file_extension()
         self.cfg = ctx.get_cfg()
+        self.is_columnar = self.cfg.is_sql() and self.metadata.is_columnar()
+        self.is_ndjson = self.cfg.is_nosql() and self.metadata.is_ndjson()
+        if self.is_columnar:
+            self.ext = constant.COLUMNAR_CHUNK_EXT
+        elif self.is_ndjson:
+            self.ext = constant.NDJSON_CHUNK_EXT
+        else:
+            self.ext = self.cfg.get_file_extension()
         self.db_type = self.cfg.get_db_type()
+        self.reader = ChunkReader(self.metadata, self.db_type)
         self.max_chunk_size = self.cfg.get_max_chunk_size()
+        self.zone_map = ZoneMap(os.path.join(self.table_path, constant.ZONE_MAP_FILE_NAME))
+        bloom_filter_columns = self.metadata.get_bloom_filter_columns()
+        converters = {column: get_converter(self.metadata.get_field_type(column)) for column in bloom_filter_columns} if self.cfg.is_sql() else None
+        self.bloom_filters = BloomFilters(os.path.join(self.table_path, constant.BLOOM_FILTER_FILE_NAME), bloom_filter_columns,
+                                          self.max_chunk_size, config.bloom_filter_fpp, converters)
+        self.index_manager = IndexManager(self.table_path, self.metadata)
+        self.manifest = ChunkManifest(os.path.join(self.table_path, constant.MANIFEST_FILE_NAME))
+        self.cache = get_chunk_cache(self.cfg.get_chunk_cache_size())
+        self.tombstones = TombstoneManager(self.table_path)
+        # opened by the first logged operation, scanning processes never write the table
+        self.wal = WriteAheadLog(os.path.join(self.table_path, constant.WAL_FILE_NAME))
+        # changed whenever chunks are renumbered or removed (compaction, drop), chunk idx taken before are no longer valid
+        self.generation = 0
+        # files written since the last checkpoint, indexes keep their own (see IndexManager.sync)
+        self.unsynced_paths: set[str] = set()
 
     def start(self) -> Status:
         if not os.path.exists(self.table_path):
             self.ctx.get_logger().warn("uninitialized table {} found", self.table_path)
             return OK
-        self.total_chunks = self.get_chunk_cnt()
+        self.zone_map.load()
+        self.bloom_filters.load()
+        if not self.manifest.load():
+            self._rebuild_manifest()
+        if self.cfg.is_sql():
+            self.index_manager.load()
+        return OK
 
-    def get_chunk_cnt(self):
-        if not os.path.exists(self.table_path):
-            return 0
+    # the table dir is only listed once for tables without a manifest, e.g. tables created by older versions
+    def _rebuild_manifest(self):
+        # sidecar files (e.g. zone map) are stored under the same dir, only chunk files are counted
+        chunk_ids = [int(os.path.splitext(f)[0]) for f in os.listdir(self.table_path) if os.path.splitext(f)[1] == self.ext and os.path.splitext(f)[0].isdigit()]
+        self.manifest.clear()
+        # versions of chunks start over, cached chunks of this table can't be told apart
+        self.cache.invalidate_table(self.table_path)
+        for i in range(0 if len(chunk_ids) == 0 else max(chunk_ids) + 1):
+            stats = self.zone_map.get_chunk(i)
+            chunk_path = self.get_chunk_path(i)
+            size = sum(os.path.getsize(path) for path in [chunk_path, self.get_tail_path(i)] if os.path.exists(path))
+            # statistics only count live rows of a chunk with deleted rows
+            deleted_cnt = len(self.tombstones.get(self.manifest.get_file_id(i)))
+            self.manifest.set_chunk(i, None if stats is None or deleted_cnt > 0 else stats.row_cnt, size)
+            self.manifest.set_deleted_cnt(i, deleted_cnt)
+        self.manifest.save()
+        self.logger.info("manifest of table {} is rebuilt with {} chunks".format(self.table_path, self.manifest.get_chunk_cnt()))
 
-        chunk_ids = [int(os.path.splitext(f)[0]) for f in os.listdir(self.table_path)]
-        return 0 if len(chunk_ids) == 0 else max(chunk_ids) + 1
+    def get_chunk_cnt(self) -> int:
+        return self.manifest.get_chunk_cnt()
 
     def get_fist_chunk(self) -> (list[object], Status):
-        if self.total_chunks == 0:
+        if self.is_empty_table():
             self.logger.error("empty table {}, can't find the first chunk".format(self.table_path))
             return [], FILE_NOT_EXIST
 
         return self.load_chunk(0)
 
     def get_last_chunk(self) -> (list[object], Status):
-        if self.total_chunks == 0:
+        if self.is_empty_table():
             self.logger.error("empty table {}, can't find the first chunk".format(self.table_path))
             return [], FILE_NOT_EXIST
 
-        return self.load_chunk(self.total_chunks - 1)
+        return self.load_chunk(self.get_last_chunk_index())
 
+    # files of a chunk are named by its file id, see ChunkManifest
     def get_chunk_path(self, chunk_idx) -> str:
-        return os.path.join(self.table_path, str(chunk_idx) + self.ext)
-
-    def get_iter(self) -> ChunkIterator:
-        return ChunkIterator(self)
+        return os.path.join(self.table_path, str(self.manifest.get_file_id(chunk_idx)) + self.ext)
+
+    # for nosql, records appended to a chunk are kept in a newline-delimited json log until the chunk is full
+    def get_tail_path(self, chunk_idx) -> str:
+        return os.path.join(self.table_path, str(self.manifest.get_file_id(chunk_idx)) + constant.TAIL_LOG_EXT)
+
+    def get_iter(self, expression: any = None, include_deleted: bool = False) -> ChunkIterator:
+        return ChunkIterator(self, expression, include_deleted)
+
+    # offsets of deleted rows of a chunk, None if no row is deleted
+    def get_deleted_rows(self, chunk_idx: int) -> DeletionBitmap | None:
+        if self.manifest.get_deleted_cnt(chunk_idx) == 0:
+            return None
+        return self.tombstones.get(self.manifest.get_file_id(chunk_idx))
+
+    def remove_deleted(self, chunk_idx: int, chunk: list[dict[str, object]]) -> list[dict[str, object]]:
+        deleted = self.get_deleted_rows(chunk_idx)
+        return chunk if deleted is None else deleted.filter(chunk)
+
+    def has_live_rows(self, chunk_idx: int) -> bool:
+        row_cnt = self.manifest.get_row_cnt(chunk_idx)
+        return row_cnt is None or self.manifest.get_deleted_cnt(chunk_idx) < row_cnt
+
+    # check the zone map and bloom filters of a chunk, return False only when no record in the chunk can satisfy the expression
+    def may_match(self, chunk_idx: int, expression: any) -> bool:
+        return self.zone_map.may_match(chunk_idx, expression) and self.bloom_filters.may_match(chunk_idx, expression)
+
+    # check the bloom filter of the column, return False only when the chunk has none of the values (see bloom_filter.hash_value)
+    def may_contain_any(self, chunk_idx: int, column: str, hashes: list[tuple[int, int]]) -> bool:
+        return self.bloom_filters.may_contain_any(chunk_idx, column, hashes)
+
+    # chunks which may contain records satisfying the expression, according to indexes and the zone map
+    # chunks with all rows deleted are skipped until they are compacted
+    def get_chunks_to_scan(self, expression: any = None) -> list[int]:
+        chunk_ids = range(self.get_chunk_cnt())
+        if expression is None:
+            return [i for i in chunk_ids if self.has_live_rows(i)]
+        if not self.index_manager.is_empty():
+            candidates = self.index_manager.get_candidate_chunks(expression)
+            if candidates is not None:
+                chunk_ids = sorted(i for i in candidates if i < self.get_chunk_cnt())
+        return [i for i in chunk_ids if self.has_live_rows(i) and self.may_match(i, expression)]
+
+    def create_index(self, column: str) -> Status:
+        if not self.cfg.is_sql():
+            self.logger.error("index is only supported for sql tables")
+            return UNSUPPORTED
+        if column not in self.metadata.get_all_field_names():
+            self.logger.error("failed to create index on not existed column {} of table {}".format(column, self.table_path))
+            return INVALID_ARGUMENT
+        if self.index_manager.has_index(column):
+            self.logger.error("index on column {} of table {} is already existed".format(column, self.table_path))
+            return FILE_EXIST
+        self.index_manager.create(column, self.get_iter(include_deleted=True), self.get_deleted_rows)
+        self.logger.info("index on column {} of table {} is created".format(column, self.table_path))
+        return OK
 
     def get_remaining_slots(self, occupied_cnt: int) -> int:
         remaining = self.max_chunk_size - occupied_cnt
@@ -85,15 +345,48 @@ class ChunkManager:
         return max(0, remaining)
 
     def get_last_chunk_index(self) -> int:
-        return self.total_chunks - 1  # return -1 when table is empty
+        return self.get_chunk_cnt() - 1  # return -1 when table is empty
 
     # return a list of objects which can be iterated through
     # for sql, we have to transfer each row (which is simply a list to an object) to use it with ease
+    # decoded chunks are cached, the file is only read when the chunk isn't cached or has been written since
     def load_chunk(self, chunk_idx: int) -> (list[dict[str, object]], Status):
-        if chunk_idx >= self.total_chunks:
-            self.logger.error("try to load chunk {}, which is greater than total chunks: {}".format(chunk_idx, self.total_chunks))
+        if chunk_idx >= self.get_chunk_cnt():
+            self.logger.error("try to load chunk {}, which is greater than total chunks: {}".format(chunk_idx, self.get_chunk_cnt()))
             return [], INVALID_ARGUMENT
 
+        version = self.manifest.get_version(chunk_idx)
+        data = self.cache.get(self.table_path, chunk_idx, version)
+        if data is not None:
+            return data, OK
+        data, status = self._read_chunk(chunk_idx)
+        if status.ok():
+            self.cache.put(self.table_path, chunk_idx, version, data)
+        return data, status
+
+    def load_row(self, chunk_idx: int, row: int) -> (dict[str, object] | None, Status):
+        """
+        a single record of a chunk, ndjson chunks which are not cached are read by seeking to the offset of the row
+        """
+        if chunk_idx < 0 or chunk_idx >= self.get_chunk_cnt():
+            self.logger.error("try to load a row of chunk {}, which is out of total chunks: {}".format(chunk_idx, self.get_chunk_cnt()))
+            return None, INVALID_ARGUMENT
+        deleted = self.get_deleted_rows(chunk_idx)
+        if deleted is not None and row in deleted:
+            record = None
+        elif self.is_ndjson and not self.cache.contains(self.table_path, chunk_idx, self.manifest.get_version(chunk_idx)):
+            record = ndjson_chunk.read_row(self.get_chunk_path(chunk_idx), row)
+        else:
+            chunk, status = self.load_chunk(chunk_idx)
+            if not status.ok():
+                return None, status
+            record = chunk[row] if 0 <= row < len(chunk) else None
+        if record is None:
+            self.logger.error("row {} of chunk {} doesn't exist".format(row, chunk_idx))
+            return None, INVALID_ARGUMENT
+        return record, OK
+
+    def _read_chunk(self, chunk_idx: int) -> (list[dict[str, object]], Status):
         chunk_path = self.get_chunk_path(chunk_idx)
         if not os.path.exists(chunk_path):
             self.logger.error("try to load chunk {} from not existed path {}, system is not consistent".format(chunk_idx, chunk_path))
@@ -103,12 +396,27 @@ class ChunkManager:
             self.logger.error("unsupported db type".format(self.db_type))
             return [], UNSUPPORTED
 
-        if self.db_type == constant.DB_TYPE_NOSQL:
+        if self.db_type == constant.DB_TYPE_NOSQL and self.is_ndjson:
+            # Load a newline-delimited JSON file, records are appended to the file itself
+            data = ndjson_chunk.read_chunk(chunk_path)
+            self.logger.info("load trunk {} for nosql successfully".format(chunk_idx))
+            return data, OK
+        elif self.db_type == constant.DB_TYPE_NOSQL:
             # Load a JSON file
             with open(chunk_path, 'r') as file:
                 data = json.load(file)
+            tail_path = self.get_tail_path(chunk_idx)
+            if os.path.exists(tail_path):
+                with open(tail_path, 'r') as file:
+                    data += [json.loads(line) for line in file if line.strip()]
             self.logger.info("load trunk {} for nosql successfully".format(chunk_idx))
             return data, OK
+        elif self.db_type == constant.DB_TYPE_SQL and self.is_columnar:
+            # Load a binary columnar file, all columns are decoded in bulk
+            with open(chunk_path, 'rb') as file:
+                data = decode_chunk(file.read(), self.metadata)
+            self.logger.info("load trunk {} for sql successfully".format(chunk_idx))
+            return data, OK
         elif self.db_type == constant.DB_TYPE_SQL:
             # Load a CSV file and convert each row to a dictionary
             with open(chunk_path, 'r') as file:
@@ -119,24 +427,63 @@ class ChunkManager:
 
         return [], UNKNOWN
 
+    def scan(self, selector: 'Selector | None' = None, columns: list[str] | None = None, chunk_ids: list[int] | None = None):
+        """
+        scan the table chunk by chunk with the filter and the projection pushed down
+        chunks are skipped according to indexes and the zone map, only columns used by the selector or desired are decoded,
+        and a record is built only when it satisfies the selector
+        :param selector: filter, all records are kept if None
+        :param columns: desired columns (without prefix), all columns are kept if None. columns not existed are ignored
+        :param chunk_ids: chunks to scan, get_chunks_to_scan of the selector if None
+        :return: a generator of records, one list for each chunk (may be empty)
+        """
+        if chunk_ids is None:
+            chunk_ids = self.get_chunks_to_scan(None if selector is None else selector.expression)
+        for chunk_idx in chunk_ids:
+            yield self.scan_chunk(chunk_idx, selector, columns)
+
+    # records of a single chunk satisfying the selector, see scan
+    def scan_chunk(self, chunk_idx: int, selector: 'Selector | None' = None, columns: list[str] | None = None) -> list[dict[str, object]]:
+        # decoding selected rows from the file is slower than filtering a cached chunk, nosql json chunks are always loaded as a whole
+        if self.cache.contains(self.table_path, chunk_idx, self.manifest.get_version(chunk_idx)) or (self.cfg.is_nosql() and not self.is_ndjson):
+            chunk, status = self.load_chunk(chunk_idx)
+            if not status.ok():
+                raise RuntimeError("failed to load chunk {}".format(chunk_idx))
+            return self.reader.filter_records(self.remove_deleted(chunk_idx, chunk), selector, columns)
+        return self.reader.scan(self.get_chunk_file(chunk_idx), selector, columns)
+
+    def get_chunk_file(self, chunk_idx: int) -> 'ChunkFile':
+        return ChunkFile(self.get_chunk_path(chunk_idx), self.get_tail_path(chunk_idx), self.manifest.get_row_cnt(chunk_idx), self.get_deleted_rows(chunk_idx))
+
     def create_new_chunk(self) -> Status:
-        new_chunk_path = self.get_chunk_path(self.total_chunks)
+        chunk_idx = self.get_chunk_cnt()
+        new_chunk_path = self.get_chunk_path(chunk_idx)
         if os.path.exists(new_chunk_path):
             self.logger.error("try to create a new chunk {} and override a existed chunk, system is not consistent".format(new_chunk_path))
             return FILE_EXIST
 
-        with open(new_chunk_path, "w") as f:
-            if self.cfg.is_nosql():
-                f.write("[]")
-        self.total_chunks += 1
+        with open(new_chunk_path, "wb") as f:
+            if self.is_ndjson:
+                f.write(ndjson_chunk.encode_chunk([]))
+            elif self.cfg.is_nosql():
+                f.write(b"[]")
+        self.unsynced_paths.add(new_chunk_path)
+        self.zone_map.set_chunk(chunk_idx, [])
+        self.bloom_filters.set_chunk(chunk_idx, [])
+        self.manifest.set_chunk(chunk_idx, 0, os.path.getsize(new_chunk_path))
         return OK
 
     def is_empty_table(self) -> bool:
-        return self.total_chunks == 0
+        return self.get_chunk_cnt() == 0
 
     def is_chunk_full(self, chunk: list[object]) -> bool:
         return len(chunk) == self.max_chunk_size
 
+    # known from the manifest without loading the chunk, a chunk with unknown number of rows is considered not full
+    def is_last_chunk_full(self) -> bool:
+        row_cnt = self.manifest.get_row_cnt(self.get_last_chunk_index())
+        return row_cnt is not None and row_cnt >= self.max_chunk_size
+
     # always append new record to the last chunk
     # if the last chunk is full i.e. len(chunk) == config.chunk_size, then create a new chunk as the last chunk
     def dump_one(self, record: dict) -> Status:
@@ -144,61 +491,455 @@ class ChunkManager:
         return OK
 
     def dump_bulk(self, records: list[dict]) -> Status:
+        status = self._dump_bulk(records)
+        # the manifest, statistics and indexes of all written chunks are persisted at once, even if only part of records are dumped
+        self._save_sidecars()
+        return status
+
+    def bulk_load(self, batches) -> Status:
+        """
+        append batches of records, e.g. streamed from a file being imported
+        unlike calling dump_bulk for each batch, the manifest, statistics and indexes are persisted once at the end,
+        so that the cost of each batch doesn't grow with the number of chunks
+        :param batches: iterable of lists of records, batches of max_chunk_size fill one chunk each
+        """
+        status = OK
+        try:
+            for batch in batches:
+                status = self._dump_bulk(batch)
+                if not status.ok():
+                    self.logger.error("bulk load into {} stopped due to failed to dump a batch".format(self.table_path))
+                    break
+        finally:
+            # chunks written before a failure of the source are kept consistent with sidecars
+            self._save_sidecars()
+        return status
+
+    def _dump_bulk(self, records: list[dict]) -> Status:
         if self.is_empty_table():
             status = self.create_new_chunk()
             if not status.ok():
                 return INTERNAL
 
-        chunk, status = self.get_last_chunk()
-        if not status.ok():
-            self.logger.error("failed to append new record as unable to load last chunk")
-            return status
-
-        # fill the last chunk
-        remaining = self.get_remaining_slots(len(chunk))
-        insert_cnt = min(remaining, len(records))
-        chunk += records[:insert_cnt]
-        status = self.update_chunk(self.get_last_chunk_index(), chunk)
-        if not status.ok():
-            self.logger.error("failed to append records to the last chunk")
-            return status
-        records = records[insert_cnt:]
+        # fill the last chunk, which is not loaded at all if it's full
+        # records are sliced from an offset instead of being re-sliced after each chunk
+        offset = 0
+        row_cnt = self.manifest.get_row_cnt(self.get_last_chunk_index())
+        if not self.is_last_chunk_full() and row_cnt is not None and self.can_append():
+            offset = min(self.get_remaining_slots(row_cnt), len(records))
+            status = self._append_to_chunk(self.get_last_chunk_index(), row_cnt, records[:offset])
+            if not status.ok():
+                self.logger.error("failed to append records to the last chunk")
+                return status
+        elif not self.is_last_chunk_full():
+            chunk, status = self.get_last_chunk()
+            if not status.ok():
+                self.logger.error("failed to append new record as unable to load last chunk")
+                return status
+
+            remaining = self.get_remaining_slots(len(chunk))
+            offset = min(remaining, len(records))
+            unchanged_cnt = len(chunk)
+            chunk += records[:offset]
+            status = self._write_chunk(self.get_last_chunk_index(), chunk, unchanged_cnt)
+            if not status.ok():
+                self.logger.error("failed to append records to the last chunk")
+                return status
 
         # create new chunks and fill
-        while len(records):
+        for start in range(offset, len(records), self.max_chunk_size):
             status = self.create_new_chunk()
             if not status.ok():
                 return INTERNAL
-            size = min(self.max_chunk_size, len(records))
-            status = self.update_chunk(self.get_last_chunk_index(), records[:size])
+            status = self._write_chunk(self.get_last_chunk_index(), records[start:start + self.max_chunk_size])
             if not status.ok():
                 return INTERNAL
-            records = records[size:]
+        return OK
+
+    # chunks in binary columnar format are always rewritten as a whole
+    def can_append(self) -> bool:
+        return not self.is_columnar
+
+    def _append_to_chunk(self, chunk_idx: int, row_cnt: int, records: list[dict]) -> Status:
+        """
+        append records to the tail of a chunk without rewriting it, csv rows and ndjson lines are appended in place,
+        and json lines are appended to the tail log for nosql json chunks
+        appended rows are not fsynced, they are recovered from the write-ahead log (see restore)
+        """
+        if len(records) == 0:
+            return OK
+        is_full = row_cnt + len(records) >= self.max_chunk_size
+        path = self.get_tail_path(chunk_idx) if self.cfg.is_nosql() and not self.is_ndjson else self.get_chunk_path(chunk_idx)
+        if self.is_ndjson:
+            # new lines and the new footer overwrite the old footer in a single write
+            ndjson_chunk.append_records(path, records)
+        else:
+            with open(path, 'a', newline='') as f:
+                if self.cfg.is_sql():
+                    csv.writer(f).writerows([object_to_row(obj, self.metadata) for obj in records])
+                else:
+                    f.writelines(json.dumps(record) + "\n" for record in records)
+        self.unsynced_paths.add(path)
+
+        self.cache.invalidate(self.table_path, chunk_idx)
+        self.zone_map.append_to_chunk(chunk_idx, records)
+        self.bloom_filters.append_to_chunk(chunk_idx, records)
+        size = sum(os.path.getsize(p) for p in [self.get_chunk_path(chunk_idx), self.get_tail_path(chunk_idx)] if os.path.exists(p))
+        self.manifest.set_chunk(chunk_idx, row_cnt + len(records), size)
+        if not self.index_manager.is_empty():
+            self.index_manager.on_append_chunk(chunk_idx, records)
+        if is_full and self.cfg.is_nosql() and not self.is_ndjson:
+            # fold the tail log into the json chunk, offsets of records are unchanged
+            chunk, status = self.load_chunk(chunk_idx)
+            if not status.ok():
+                return status
+            return self._write_chunk(chunk_idx, chunk, len(chunk))
         return OK
 
     def destroy_all_chunks(self) -> Status:
         self.logger.warn("deleting all chunks under {}".format(self.table_path))
-        for i in range(0, self.total_chunks):
+        for i in range(0, self.get_chunk_cnt()):
             chunk_path = self.get_chunk_path(i)
             os.remove(chunk_path)
-        self.total_chunks = 0
+            if os.path.exists(self.get_tail_path(i)):
+                os.remove(self.get_tail_path(i))
+            self.tombstones.remove(self.manifest.get_file_id(i))
+        self.tombstones.reset()
+        self.manifest.clear()
+        self.cache.invalidate_table(self.table_path)
+        self.zone_map.clear()
+        self.bloom_filters.clear()
+        self.index_manager.clear()
+        self._save_sidecars()
+        self.close()
         self.logger.warn("all chunks under {} are deleted".format(self.table_path))
         return OK
 
-    def update_chunk(self, chunk_idx: int, chunk: list[dict[str, object]]) -> Status:
-        if chunk_idx < 0 or chunk_idx >= self.total_chunks:
+    # rewrite chunks (chunk idx -> records), sidecars are persisted once all chunks are written
+    def update_chunks(self, chunks: dict[int, list[dict[str, object]]]) -> Status:
+        for chunk_idx, chunk in chunks.items():
+            status = self._write_chunk(chunk_idx, chunk)
+            if not status.ok():
+                return status
+        self._save_sidecars()
+        return OK
+
+    def _save_sidecars(self):
+        self.zone_map.save()
+        self.bloom_filters.save()
+        self.index_manager.flush()
+        # the manifest is saved at last, it records the lsn of the applied operation
+        self.manifest.save()
+        self.unsynced_paths.update([self.zone_map.path, self.bloom_filters.path, self.manifest.path])
+
+    def log(self, entries: list[dict]) -> list[int]:
+        """
+        append entries of operations going to be applied to the write-ahead log with a single fsync, see WriteAheadLog
+        :return: lsn of each entry, see set_applied_lsn
+        """
+        if not self.wal.is_open():
+            self.wal.open(self.manifest.lsn)
+        lsns = [self.wal.append(entry) for entry in entries]
+        self.wal.sync()
+        return lsns
+
+    # called before the operation of the entry is applied, the lsn is persisted in the manifest once sidecars are saved
+    def set_applied_lsn(self, lsn: int):
+        self.manifest.lsn = lsn
+
+    def get_pending_log_entries(self) -> list[dict]:
+        return self.wal.read_entries(self.manifest.lsn)
+
+    def checkpoint(self, force: bool = False):
+        """
+        once the write-ahead log is large enough, flush files written since the last checkpoint onto the disk and truncate the log
+        chunks and sidecars are written without fsync, the log is all they rely on until the checkpoint
+        """
+        if not self.wal.is_open() or (not force and self.wal.get_size() < config.wal_checkpoint_size):
+            return
+        for path in self.unsynced_paths:
+            # files may be removed since, e.g. tail logs folded into chunks, or sidecars never saved
+            if os.path.exists(path):
+                fsync_path(path)
+        self.unsynced_paths = set()
+        self.index_manager.sync()
+        # files created, renamed and removed in the table dir
+        fsync_path(self.table_path)
+        self.wal.truncate()
+        self.logger.info("checkpoint of table {} at lsn {}".format(self.table_path, self.manifest.lsn))
+
+    def close(self):
+        self.wal.close()
+        self.generation += 1
+
+    def restore(self):
+        """
+        bring chunk files back to the state recorded in the manifest before the write-ahead log is replayed,
+        i.e. remove rows appended and chunks created by operations interrupted by a crash
+        chunks are written by renaming temporary files, so a chunk is either the old or the new one
+        """
+        chunk_cnt = self.get_chunk_cnt()
+        self.remove_orphan_files()
+        for i in range(chunk_cnt):
+            info = self.manifest.get_chunk(i)
+            size = sum(os.path.getsize(path) for path in [self.get_chunk_path(i), self.get_tail_path(i)] if os.path.exists(path))
+            if info.row_cnt is None or size == info.size:
+                continue
+            chunk = self._read_first_rows(i, info.row_cnt)
+            self.logger.warn("chunk {} of table {} is restored to {} rows".format(i, self.table_path, len(chunk)))
+            self._write_chunk_file(i, chunk)
+            self.manifest.set_chunk(i, len(chunk), os.path.getsize(self.get_chunk_path(i)))
+            live_rows = self.remove_deleted(i, chunk)
+            self.zone_map.set_chunk(i, live_rows)
+            self.bloom_filters.set_chunk(i, live_rows)
+        self.cache.invalidate_table(self.table_path)
+
+    # remove temporary files and files of chunks not in the manifest, e.g. new chunks of an interrupted compaction or
+    # old chunks of a compaction interrupted after the manifest is saved
+    def remove_orphan_files(self):
+        if not os.path.exists(self.table_path):
+            return
+        file_ids = self.manifest.get_file_ids()
+        for f in os.listdir(self.table_path):
+            name, ext = os.path.splitext(f)
+            if ext == ".tmp" or (name.isdigit() and int(name) not in file_ids and ext in [self.ext, constant.TAIL_LOG_EXT, constant.TOMBSTONE_EXT]):
+                os.remove(os.path.join(self.table_path, f))
+
+    def _read_first_rows(self, chunk_idx: int, row_cnt: int) -> list[dict[str, object]]:
+        chunk_path = self.get_chunk_path(chunk_idx)
+        if self.is_ndjson:
+            return ndjson_chunk.read_first_records(chunk_path, row_cnt)
+        if self.cfg.is_sql() and not self.is_columnar:
+            with open(chunk_path, 'r', newline='') as file:
+                return [row_to_object(row, self.metadata) for row in itertools.islice(csv.reader(file), row_cnt)]
+        if self.is_columnar:
+            chunk, _ = self._read_chunk(chunk_idx)
+        else:
+            chunk = self._read_json_chunk(chunk_idx)
+        return chunk[:row_cnt]
+
+    # rows of a nosql json chunk and its tail log, the tail log may be partially written
+    def _read_json_chunk(self, chunk_idx: int) -> list[dict[str, object]]:
+        with open(self.get_chunk_path(chunk_idx), 'r') as file:
+            chunk = json.load(file)
+        if os.path.exists(self.get_tail_path(chunk_idx)):
+            with open(self.get_tail_path(chunk_idx), 'r') as file:
+                for line in file:
+                    try:
+                        chunk.append(json.loads(line))
+                    except ValueError:
+                        break
+        return chunk
+
+    def replay_log(self, apply) -> Status:
+        """
+        restore chunks to the state in the manifest then apply pending entries of the write-ahead log in order,
+        entries which fail are logged and skipped
+        :param apply: apply an entry of the log without logging it again
+        """
+        entries = self.get_pending_log_entries()
+        if len(entries) == 0:
+            self.remove_orphan_files()
+            return OK
+        self.logger.warn("replaying #{} operations of table {} from the write-ahead log".format(len(entries), self.table_path))
+        self.restore()
+        for entry in entries:
+            self.set_applied_lsn(entry["lsn"])
+            # an entry failing to apply is skipped, or it would fail again on every restart
+            try:
+                status = apply(entry)
+            except Exception as e:
+                self.logger.error("failed to replay operation {} of table {}, skip entry {}, due to {}".format(entry["lsn"], self.table_path, entry, e))
+                continue
+            if not status.ok():
+                self.logger.error("failed to replay operation {} of table {}, skip entry {}, {}".format(entry["lsn"], self.table_path, entry, status))
+        # entries of rows removed by restore may be left in indexes
+        self.rebuild_indexes()
+        self._save_sidecars()
+        if not self.wal.is_open():
+            self.wal.open(self.manifest.lsn)
+        self.checkpoint(force=True)
+        return OK
+
+    # rebuild zone maps and bloom filters of all chunks, e.g. saved by a compaction interrupted before its manifest is saved
+    def rebuild_statistics(self) -> Status:
+        self.zone_map.clear()
+        self.bloom_filters.clear()
+        for chunk_idx in range(self.get_chunk_cnt()):
+            chunk, status = self.load_chunk(chunk_idx)
+            if not status.ok():
+                return status
+            live_rows = self.remove_deleted(chunk_idx, chunk)
+            self.zone_map.set_chunk(chunk_idx, live_rows)
+            self.bloom_filters.set_chunk(chunk_idx, live_rows)
+        return OK
+
+    def rebuild_indexes(self):
+        for column in self.index_manager.get_indexed_columns():
+            self.index_manager.create(column, self.get_iter(include_deleted=True), self.get_deleted_rows)
+
+    # rows of the chunk on the disk which are going to be overwritten, used to remove their index entries
+    def _get_overwritten_rows(self, chunk_idx: int, unchanged_cnt: int) -> list[dict[str, object]]:
+        row_cnt = self.manifest.get_row_cnt(chunk_idx)
+        if row_cnt is not None and row_cnt <= unchanged_cnt:
+            return []
+        chunk, status = self.load_chunk(chunk_idx)
+        if not status.ok():
+            raise RuntimeError("failed to load chunk {} to maintain indexes".format(chunk_idx))
+        return chunk
+
+    # write the chunk onto the disk and refresh its manifest entry, statistics and indexes in memory, they are not persisted
+    # the first unchanged_cnt records are known to be the same as the chunk on the disk
+    def _write_chunk(self, chunk_idx: int, chunk: list[dict[str, object]], unchanged_cnt: int = 0) -> Status:
+        if chunk_idx < 0 or chunk_idx >= self.get_chunk_cnt():
             self.logger.error("failed to update chunk due to invalid chunk_idx: {}".format(chunk_idx))
             return INVALID_ARGUMENT
 
-        if self.cfg.is_sql():
+        old_chunk = [] if self.index_manager.is_empty() else self._get_overwritten_rows(chunk_idx, unchanged_cnt)
+
+        status = self._write_chunk_file(chunk_idx, chunk)
+        if not status.ok():
+            return status
+
+        self.cache.invalidate(self.table_path, chunk_idx)
+        # offsets of rows are kept, so rows marked as deleted are still deleted
+        deleted = self.get_deleted_rows(chunk_idx)
+        live_rows = chunk if deleted is None else deleted.filter(chunk)
+        self.zone_map.set_chunk(chunk_idx, live_rows)
+        self.bloom_filters.set_chunk(chunk_idx, live_rows)
+        self.manifest.set_chunk(chunk_idx, len(chunk), os.path.getsize(self.get_chunk_path(chunk_idx)))
+        if not self.index_manager.is_empty():
+            self.index_manager.on_write_chunk(chunk_idx, old_chunk, chunk, unchanged_cnt, deleted)
+        self.logger.info("successfully update chunk {}".format(chunk_idx))
+        return OK
+
+    # only write the file of the chunk, which replaces the tail log for nosql json chunks
+    # the chunk is written to a temporary file then renamed, a crash never leaves a partially written chunk
+    def _write_chunk_file(self, chunk_idx: int, chunk: list[dict[str, object]]) -> Status:
+        chunk_path = self.get_chunk_path(chunk_idx)
+        tmp_path = chunk_path + ".tmp"
+        if self.is_columnar:
+            try:
+                data = encode_chunk(chunk, self.metadata)
+            except (KeyError, ValueError, TypeError, OverflowError) as e:
+                self.logger.error("failed to encode chunk {} as columnar format, due to {}".format(chunk_idx, e))
+                return INVALID_ARGUMENT
+            with open(tmp_path, 'wb') as f:
+                f.write(data)
+
+        elif self.cfg.is_sql():
             csv_rows = [object_to_row(obj, self.metadata) for obj in chunk]
-            with open(self.get_chunk_path(chunk_idx), 'w', newline='') as f:
+            with open(tmp_path, 'w', newline='') as f:
                 writer = csv.writer(f)
                 writer.writerows(csv_rows)
 
+        elif self.is_ndjson:
+            with open(tmp_path, 'wb') as f:
+                f.write(ndjson_chunk.encode_chunk(chunk))
+
         elif self.cfg.is_nosql():
-            with open(self.get_chunk_path(chunk_idx), 'w', newline='') as f:
+            with open(tmp_path, 'w', newline='') as f:
                 json.dump(chunk, f)
 
-        self.logger.info("successfully update chunk {}".format(chunk_idx))
+        os.replace(tmp_path, chunk_path)
+        self.unsynced_paths.add(chunk_path)
+        # the whole chunk is written, including records in the tail log
+        if self.cfg.is_nosql() and os.path.exists(self.get_tail_path(chunk_idx)):
+            os.remove(self.get_tail_path(chunk_idx))
+        return OK
+
+    def delete_rows(self, deletions: dict[int, list[int]]) -> Status:
+        """
+        mark rows as deleted in the deletion bitmaps of their chunks, which costs a small write for each chunk instead of rewriting it
+        statistics of the chunks are refreshed with their live rows, and index entries of deleted rows are removed
+        :param deletions: chunk idx -> offsets of rows to delete, which are not deleted yet
+        """
+        for chunk_idx, offsets in deletions.items():
+            if chunk_idx < 0 or chunk_idx >= self.get_chunk_cnt():
+                self.logger.error("failed to delete rows due to invalid chunk_idx: {}".format(chunk_idx))
+                return INVALID_ARGUMENT
+            chunk, status = self.load_chunk(chunk_idx)
+            if not status.ok():
+                return status
+            bitmap = self.tombstones.mark(self.manifest.get_file_id(chunk_idx), offsets)
+            self.unsynced_paths.add(self.tombstones.get_path(self.manifest.get_file_id(chunk_idx)))
+            self.manifest.set_deleted_cnt(chunk_idx, len(bitmap))
+            self.zone_map.set_chunk(chunk_idx, bitmap.filter(chunk))
+            if not self.index_manager.is_empty():
+                self.index_manager.on_delete_rows(chunk_idx, chunk, offsets)
+        self._save_sidecars()
+        return OK
+
+    # (version, number of deleted rows) of chunks, which is changed whenever rows of a chunk are written or deleted
+    def _get_compaction_snapshot(self, start: int, end: int) -> list[tuple[int, int]]:
+        return [(self.manifest.get_version(i), self.manifest.get_deleted_cnt(i)) for i in range(start, end)]
+
+    def get_sparse_chunks(self) -> tuple[int, int] | None:
+        """
+        the first run of consecutive chunks with at least compaction_min_deleted_ratio of their rows deleted
+        :return: [start, end) of the chunks, None if no chunk needs to be compacted
+        """
+        start = None
+        for i in range(self.get_chunk_cnt()):
+            row_cnt, deleted_cnt = self.manifest.get_row_cnt(i), self.manifest.get_deleted_cnt(i)
+            is_sparse = deleted_cnt > 0 and (row_cnt is None or deleted_cnt >= row_cnt * config.compaction_min_deleted_ratio)
+            if is_sparse and start is None:
+                start = i
+            elif not is_sparse and start is not None:
+                return start, i
+        return None if start is None else (start, self.get_chunk_cnt())
+
+    def read_live_rows(self, start: int, end: int) -> (list[tuple[int, int]], list[dict[str, object]], Status):
+        """
+        :return: (snapshot of the chunks, live rows of chunks [start, end) in order, status), see compact
+        """
+        snapshot = self._get_compaction_snapshot(start, end)
+        records = []
+        for chunk_idx in range(start, end):
+            chunk, status = self.load_chunk(chunk_idx)
+            if not status.ok():
+                return snapshot, [], status
+            records += self.remove_deleted(chunk_idx, chunk)
+        return snapshot, records, OK
+
+    def compact(self, start: int, end: int, snapshot: list[tuple[int, int]], records: list[dict[str, object]]) -> Status:
+        """
+        replace chunks [start, end) with as few chunks as their live rows fill, chunks after them are renumbered
+        new chunks are written under new file ids and the manifest saved at last switches to them, files of the old chunks
+        are removed after that, so a crash leaves either layout (see remove_orphan_files), sidecars of an interrupted
+        compaction are rebuilt by replaying its entry in the write-ahead log (see rebuild_statistics)
+        :param snapshot: taken when the live rows were read, nothing is changed if any of the chunks is written since
+        """
+        if end > self.get_chunk_cnt() or snapshot != self._get_compaction_snapshot(start, end):
+            self.logger.warn("chunks [{}, {}) of {} are changed since read, compaction is skipped".format(start, end, self.table_path))
+            return INCONSISTENT
+
+        chunk_cnt = self.get_chunk_cnt()
+        chunks = [records[i:i + self.max_chunk_size] for i in range(0, len(records), self.max_chunk_size)]
+        # new chunks are written as if they were appended after the last chunk
+        new_paths = [self.get_chunk_path(chunk_cnt + i) for i in range(len(chunks))]
+        for i, chunk in enumerate(chunks):
+            status = self._write_chunk_file(chunk_cnt + i, chunk)
+            if not status.ok():
+                for path in new_paths[:i]:
+                    os.remove(path)
+                return status
+        old_file_ids = [self.manifest.get_file_id(i) for i in range(start, end)]
+
+        self.manifest.replace_chunks(start, end, [(len(chunk), os.path.getsize(path)) for chunk, path in zip(chunks, new_paths)])
+        self.zone_map.replace_chunks(start, end, chunks)
+        self.bloom_filters.replace_chunks(start, end, chunks)
+        # cached chunks are looked up by idx, which may refer to another chunk now
+        self.cache.invalidate_table(self.table_path)
+        self.generation += 1
+        # offsets of all rows after the compacted chunks are changed
+        self.rebuild_indexes()
+        self._save_sidecars()
+
+        for file_id in old_file_ids:
+            self.tombstones.remove(file_id)
+            for path in [os.path.join(self.table_path, str(file_id) + ext) for ext in [self.ext, constant.TAIL_LOG_EXT]]:
+                if os.path.exists(path):
+                    os.remove(path)
+        self.logger.info("chunks [{}, {}) of {} are compacted into {} chunks".format(start, end, self.table_path, len(chunks)))
         return OK
@@ -0,0 +1,197 @@
+import struct
+import sys
+from array import array
+
+import config
+from app.common.query.vector import numpy, DictionaryVector
+from app.common.table.metadata import Metadata
+
+# binary column-oriented chunk layout, all numbers are little endian
+#   header:  magic(4s) version(H) row_cnt(I) col_cnt(H)
+#   columns: for each field (same sequence as metadata): type_tag(B) payload_len(I) payload
+# payload of each column:
+#   int   -> array('q') with row_cnt items
+#   float -> array('d') with row_cnt items
+#   bool  -> array('b') with row_cnt items
+#   str   -> array('I') with row_cnt + 1 byte offsets, followed by the utf-8 blob of all values
+#   str with few distinct values (dictionary encoded, since version 2) ->
+#            dict_cnt(I) code_size(B), codes of rows (unsigned, code_size bytes each), followed by distinct values encoded as a str column
+# as the payload length is stored, a column can be skipped without decoding it
+
+COLUMNAR_MAGIC = b"AVAC"
+COLUMNAR_VERSION = 2
+_READABLE_VERSIONS = [1, 2]
+
+_HEADER = struct.Struct("<4sHIH")
+_COLUMN_HEADER = struct.Struct("<BI")
+
+_DICTIONARY_HEADER = struct.Struct("<IB")
+
+_TYPE_TAGS = {'int': 1, 'float': 2, 'bool': 3, 'str': 4}
+# tag of dictionary encoded str columns, which is decoded as 'str'
+_DICTIONARY_TAG = 5
+_CODE_CODES = {1: 'B', 2: 'H', 4: 'I'}
+_ARRAY_CODES = {'int': 'q', 'float': 'd', 'bool': 'b'}
+_NUMPY_DTYPES = {'int': '<i8', 'float': '<f8', 'bool': '<i1'}
+_OFFSET_CODE = 'I'
+_CONVERTERS = {'int': int, 'float': float, 'bool': bool, 'str': str}
+_IS_BIG_ENDIAN = sys.byteorder == "big"
+
+
+def _to_bytes(arr: array) -> bytes:
+    if _IS_BIG_ENDIAN:
+        arr = array(arr.typecode, arr)
+        arr.byteswap()
+    return arr.tobytes()
+
+
+def _from_bytes(typecode: str, data: bytes | memoryview) -> array:
+    arr = array(typecode)
+    arr.frombytes(data)
+    if _IS_BIG_ENDIAN:
+        arr.byteswap()
+    return arr
+
+
+def _encode_column(field_type: str, values: list) -> (int, bytes):
+    """
+    :return: type tag and payload of the column
+    """
+    convert = _CONVERTERS[field_type]
+    if field_type != 'str':
+        return _TYPE_TAGS[field_type], _to_bytes(array(_ARRAY_CODES[field_type], [convert(v) for v in values]))
+
+    values = [convert(v) for v in values]
+    # distinct values in the order of their first rows
+    dictionary = dict.fromkeys(values)
+    if 0 < len(dictionary) <= len(values) * config.dictionary_max_distinct_ratio:
+        return _DICTIONARY_TAG, _encode_dictionary(values, dictionary)
+    return _TYPE_TAGS[field_type], _encode_strings(values)
+
+
+def _encode_strings(values: list[str]) -> bytes:
+    encoded = [v.encode("utf-8") for v in values]
+    offsets = array(_OFFSET_CODE, [0])
+    total = 0
+    for item in encoded:
+        total += len(item)
+        offsets.append(total)
+    return _to_bytes(offsets) + b"".join(encoded)
+
+
+def _encode_dictionary(values: list[str], dictionary: dict[str, None]) -> bytes:
+    codes = {value: code for code, value in enumerate(dictionary)}
+    code_size = next(size for size in sorted(_CODE_CODES) if len(codes) <= 1 << (8 * size))
+    return (_DICTIONARY_HEADER.pack(len(codes), code_size) + _to_bytes(array(_CODE_CODES[code_size], [codes[v] for v in values]))
+            + _encode_strings(list(codes)))
+
+
+def _decode_dictionary(payload: memoryview, row_cnt: int) -> (list[str], memoryview, int):
+    """
+    :return: distinct values, payload of codes and size of each code
+    """
+    dict_cnt, code_size = _DICTIONARY_HEADER.unpack_from(payload, 0)
+    codes_end = _DICTIONARY_HEADER.size + row_cnt * code_size
+    return _decode_strings(payload[codes_end:], dict_cnt), payload[_DICTIONARY_HEADER.size:codes_end], code_size
+
+
+def _decode_vector(tag: int, field_type: str, payload: memoryview, row_cnt: int):
+    # strings of a dictionary encoded column are compared by their codes
+    if tag == _DICTIONARY_TAG:
+        values, codes, code_size = _decode_dictionary(payload, row_cnt)
+        if numpy is not None:
+            return DictionaryVector(values, numpy.frombuffer(codes, dtype="<u{}".format(code_size)))
+        return DictionaryVector(values, _from_bytes(_CODE_CODES[code_size], codes))
+    # numbers are used as they are without being converted into python objects
+    if numpy is not None and field_type != 'str':
+        vector = numpy.frombuffer(payload, dtype=_NUMPY_DTYPES[field_type])
+        return vector != 0 if field_type == 'bool' else vector
+    if field_type in ['int', 'float']:
+        return _from_bytes(_ARRAY_CODES[field_type], payload)
+    return _decode_column(tag, field_type, payload, row_cnt)
+
+
+def _decode_column(tag: int, field_type: str, payload: memoryview, row_cnt: int) -> list:
+    if tag == _DICTIONARY_TAG:
+        # each distinct value is decoded once, rows with the same value share the same str object
+        values, codes, code_size = _decode_dictionary(payload, row_cnt)
+        return [values[code] for code in _from_bytes(_CODE_CODES[code_size], codes)]
+    if field_type != 'str':
+        values = _from_bytes(_ARRAY_CODES[field_type], payload).tolist()
+        if field_type == 'bool':
+            return [v != 0 for v in values]
+        return values
+    return _decode_strings(payload, row_cnt)
+
+
+def _decode_strings(payload: memoryview, cnt: int) -> list[str]:
+    offsets_len = (cnt + 1) * array(_OFFSET_CODE).itemsize
+    offsets = _from_bytes(_OFFSET_CODE, payload[:offsets_len])
+    blob = bytes(payload[offsets_len:])
+    if blob.isascii():
+        # byte offsets are identical to character offsets, decode the blob only once
+        text = blob.decode("ascii")
+        return [text[offsets[i]:offsets[i + 1]] for i in range(cnt)]
+    return [blob[offsets[i]:offsets[i + 1]].decode("utf-8") for i in range(cnt)]
+
+
+def encode_chunk(records: list[dict[str, object]], metadata: Metadata) -> bytes:
+    """
+    encode records into a binary columnar chunk
+    values are converted to the field type once here, thus decoding needs no per cell conversion
+    str columns with at most dictionary_max_distinct_ratio of distinct values are dictionary encoded
+    :param records: records of the chunk, each record must contain all fields in metadata
+    :param metadata: metadata of the table
+    :return: encoded chunk
+    """
+    fields = metadata.get_all_fields()
+    parts = [_HEADER.pack(COLUMNAR_MAGIC, COLUMNAR_VERSION, len(records), len(fields))]
+    for info in fields:
+        name, field_type = info.get_name(), info.get_value_type()
+        tag, payload = _encode_column(field_type, [record[name] for record in records])
+        parts.append(_COLUMN_HEADER.pack(tag, len(payload)))
+        parts.append(payload)
+    return b"".join(parts)
+
+
+def decode_columns(data: bytes, metadata: Metadata, names: set[str] | None = None, as_vectors: bool = False) -> (int, dict[str, list]):
+    """
+    decode a binary columnar chunk into column vectors
+    :param data: encoded chunk
+    :param metadata: metadata of the table
+    :param names: columns to decode, all columns are decoded if None. other columns are skipped without being decoded
+    :param as_vectors: decode numbers into numpy arrays (or array.array if numpy is not installed) and dictionary encoded str columns
+        into DictionaryVector instead of lists, which are only used for batch evaluation of expressions
+    :return: row count, and a map from column name to its values (in metadata sequence)
+    """
+    if len(data) == 0:
+        # newly created chunk
+        return 0, {name: [] for name in metadata.get_all_field_names() if names is None or name in names}
+
+    view = memoryview(data)
+    magic, version, row_cnt, col_cnt = _HEADER.unpack_from(view, 0)
+    if magic != COLUMNAR_MAGIC or version not in _READABLE_VERSIONS:
+        raise ValueError("unrecognized columnar chunk, magic: {}, version: {}".format(magic, version))
+    fields = metadata.get_all_fields()
+    if col_cnt != len(fields):
+        raise ValueError("columnar chunk has {} columns, but metadata has {} fields".format(col_cnt, len(fields)))
+
+    pos = _HEADER.size
+    columns = {}
+    for info in fields:
+        tag, payload_len = _COLUMN_HEADER.unpack_from(view, pos)
+        pos += _COLUMN_HEADER.size
+        name, field_type = info.get_name(), info.get_value_type()
+        if tag != _TYPE_TAGS[field_type] and not (tag == _DICTIONARY_TAG and field_type == 'str'):
+            raise ValueError("type of column {} mismatches with metadata type {}".format(name, field_type))
+        if names is None or name in names:
+            decode = _decode_vector if as_vectors else _decode_column
+            columns[name] = decode(tag, field_type, view[pos:pos + payload_len], row_cnt)
+        pos += payload_len
+    return row_cnt, columns
+
+
+def decode_chunk(data: bytes, metadata: Metadata) -> list[dict[str, object]]:
+    _, columns = decode_columns(data, metadata)
+    names = list(columns.keys())
+    return [dict(zip(names, values)) for values in zip(*columns.values())]
@@ -0,0 +1,45 @@
+import threading
+
+import config
+
+from app.common.table.table_manager import TableManager
+
+
+class Compactor:
+    """
+    background thread compacting chunks with deleted rows of all tables, every compaction_interval seconds
+    """
+
+    def __init__(self, table_manager: TableManager, interval: float = config.compaction_interval):
+        self.table_manager = table_manager
+        self.logger = table_manager.logger
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="compactor", daemon=True)
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.compact_all()
+
+    def compact_all(self):
+        with self.table_manager.lock:
+            tables = [(name, table) for name, table in self.table_manager.table_map.items() if not self.table_manager.is_tmp_table(name)]
+        for name, table in tables:
+            if self.stopped.is_set():
+                return
+            try:
+                # the table may be dropped and recreated under the same dir since listed
+                status = table.compact(lambda: self.table_manager.table_map.get(name) is table)
+            except Exception as e:
+                # the table may be dropped meanwhile, keep compacting other tables
+                self.logger.error("failed to compact table {}, due to {}".format(table.name, e))
+                continue
+            if not status.ok():
+                self.logger.error("failed to compact table {}".format(table.name))
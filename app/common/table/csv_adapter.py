@@ -10,5 +10,10 @@ def row_to_object(row: list[object], metadata: Metadata) -> dict[str: object]:
     return res
 
 
+# the function converting a csv cell into a value of field_type, same as row_to_object
+def get_converter(field_type: str):
+    return eval(field_type)
+
+
 def object_to_row(obj: dict[str: object], metadata: Metadata):
     return [obj[field_name] for field_name in metadata.get_all_field_names()]
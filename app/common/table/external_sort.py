@@ -0,0 +1,246 @@
+import heapq
+from typing import Callable, Iterator
+
+import config
+
+from app.common.table.metadata import Metadata
+from app.common.table.table import Table
+from app.common.table.table_manager import get_table_manager
+
+
+def get_fan_in(memory_budget: int) -> int:
+    # each run being merged keeps one chunk in memory
+    return max(2, memory_budget // config.max_chunk_size)
+
+
+class _Descending:
+    """
+    reverse the order of a value which has no inverted encoding, so that a min-heap pops the largest one first
+    """
+
+    __slots__ = ["value"]
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other: '_Descending') -> bool:
+        return other.value < self.value
+
+    def __eq__(self, other: '_Descending') -> bool:
+        return self.value == other.value
+
+
+# a string is inverted into the negated code points followed by a terminator greater than any of them,
+# so that a string sorts before its prefixes
+_STR_TERMINATOR = (1,)
+
+
+def invert(value) -> object:
+    """
+    encode a value so that the order of encoded values is the reverse of the original order
+    """
+    value_type = type(value)
+    if value_type is int or value_type is float:
+        return -value
+    if value_type is bool:
+        return not value
+    if value_type is str:
+        return tuple(-ord(c) for c in value) + _STR_TERMINATOR
+    return _Descending(value)
+
+
+def make_sort_key(columns: list[str], is_asc: list[bool]) -> Callable[[dict[str, object]], tuple]:
+    """
+    build a function which extracts the composite key of a record, e.g. ORDER BY a ASC, b DESC -> (a, invert(b))
+    records sorted by the key in ascending order are sorted by all columns
+    """
+    if all(is_asc):
+        def sort_key(record: dict[str, object]) -> tuple:
+            return tuple([record[column] for column in columns])
+    else:
+        def sort_key(record: dict[str, object]) -> tuple:
+            return tuple([record[column] if asc else invert(record[column]) for column, asc in zip(columns, is_asc)])
+    return sort_key
+
+
+class RunWriter:
+    """
+    write records into a tmp table chunk by chunk
+    """
+
+    def __init__(self, metadata: Metadata):
+        self.metadata = metadata
+        self.table: Table | None = None
+        self.buffer: list[dict[str, object]] = []
+
+    def append(self, record: dict[str, object]):
+        self.buffer.append(record)
+        if len(self.buffer) >= config.max_chunk_size:
+            self.flush()
+
+    def extend(self, records: list[dict[str, object]]):
+        self.buffer += records
+        if len(self.buffer) >= config.max_chunk_size:
+            self.flush()
+
+    def flush(self):
+        if self.table is None:
+            table, status = get_table_manager().create_tmp_table(self.metadata)
+            if not status.ok():
+                raise RuntimeError("failed to create new tmp table")
+            self.table = table
+        if len(self.buffer):
+            status = self.table.insert_bulk(self.buffer)
+            if not status.ok():
+                raise RuntimeError("failed to flush onto disk")
+            self.buffer = []
+
+    def close(self) -> Table:
+        self.flush()
+        return self.table
+
+    # drop the tmp table written so far, e.g. when the run can't be finished
+    def discard(self):
+        if self.table is not None:
+            get_table_manager().drop_table(self.table.name)
+            self.table = None
+
+
+def drop_runs(runs: list[Table]):
+    for run in runs:
+        get_table_manager().drop_table(run.name)
+
+
+def iterate_records(table: Table) -> Iterator[dict[str, object]]:
+    for chunk in table.chunk_manager.get_iter():
+        yield from chunk
+
+
+class ExternalSorter:
+    """
+    external merge sort
+    1. runs are generated by replacement selection: a heap keeps at most memory_budget records, the smallest one is
+       written to the current run as long as it's not smaller than the last written one, otherwise it's kept for the next run.
+       runs are about twice the memory budget on random input, and the whole input is a single run if it's already sorted
+    2. runs are merged with a heap, fan_in runs at a time, so each record costs O(log(fan_in)) instead of O(fan_in).
+       the final merge is streamed to the caller instead of being written onto the disk
+    input which fits in the memory budget is sorted in memory
+    """
+
+    def __init__(self, metadata: Metadata, sort_key: Callable[[dict[str, object]], object],
+                 memory_budget: int = config.memory_budget, fan_in: int | None = None):
+        """
+        :param sort_key: extract the key to sort on from a record in ascending order, see make_sort_key
+        :param fan_in: how many runs are merged at a time, chosen from the memory budget if None
+        """
+        self.metadata = metadata
+        self.sort_key = sort_key
+        self.memory_budget = max(1, memory_budget)
+        self.fan_in = get_fan_in(memory_budget) if fan_in is None else fan_in
+        if self.fan_in <= 1:
+            raise RuntimeError("invalid ways {} for merge sort".format(self.fan_in))
+
+    def sort(self, batches) -> Iterator[list[dict[str, object]]]:
+        records = iter(record for batch in batches for record in batch)
+        buffer = []
+        for record in records:
+            buffer.append(record)
+            if len(buffer) > self.memory_budget:
+                break
+        else:
+            buffer.sort(key=self.sort_key)
+            for i in range(0, len(buffer), config.max_chunk_size):
+                yield buffer[i:i + config.max_chunk_size]
+            return
+
+        runs = self.generate_runs(buffer, records)
+        # runs are dropped even if the caller stops early (e.g. LIMIT) or fails
+        try:
+            while len(runs) > self.fan_in:
+                runs = self._merge_pass(runs)
+            yield from self._merge(runs)
+        finally:
+            drop_runs(runs)
+
+    def generate_runs(self, buffer: list[dict[str, object]], records: Iterator[dict[str, object]]) -> list[Table]:
+        """
+        :param buffer: records already read from the input, which fill the heap
+        :param records: remaining records
+        :return: sorted runs, each one is a tmp table
+        """
+        # (run number, key, sequence number, record), records with the same key keep their order in the input
+        heap = [(0, self.sort_key(record), seq, record) for seq, record in enumerate(buffer)]
+        heapq.heapify(heap)
+        seq = len(heap)
+        runs, writer, current_run = [], RunWriter(self.metadata), 0
+        try:
+            while len(heap):
+                run, key, _, record = heap[0]
+                if run != current_run:
+                    runs.append(writer.close())
+                    writer, current_run = RunWriter(self.metadata), run
+                writer.append(record)
+
+                new_record = next(records, None)
+                if new_record is None:
+                    heapq.heappop(heap)
+                    continue
+                new_key = self.sort_key(new_record)
+                # a record smaller than the last written one can't join the current run
+                heapq.heapreplace(heap, (run + 1 if new_key < key else run, new_key, seq, new_record))
+                seq += 1
+            runs.append(writer.close())
+        except BaseException:
+            writer.discard()
+            drop_runs(runs)
+            raise
+        return runs
+
+    def _merge(self, runs: list[Table]) -> Iterator[list[dict[str, object]]]:
+        iterators = [iterate_records(run) for run in runs]
+        # (key, run idx, record), records with the same key are taken from the earlier run first
+        heap = []
+        for i, iterator in enumerate(iterators):
+            record = next(iterator, None)
+            if record is not None:
+                heap.append((self.sort_key(record), i, record))
+        heapq.heapify(heap)
+
+        batch = []
+        while len(heap):
+            _, i, record = heap[0]
+            batch.append(record)
+            new_record = next(iterators[i], None)
+            if new_record is None:
+                heapq.heappop(heap)
+            else:
+                heapq.heapreplace(heap, (self.sort_key(new_record), i, new_record))
+            if len(batch) >= config.max_chunk_size:
+                yield batch
+                batch = []
+        if len(batch):
+            yield batch
+
+    def _merge_pass(self, runs: list[Table]) -> list[Table]:
+        """
+        merge every fan_in runs into one, merged runs are dropped and removed from runs,
+        so that only runs left in it are dropped by the caller if the pass fails
+        """
+        merged_runs = []
+        try:
+            while len(runs):
+                group = runs[:self.fan_in]
+                writer = RunWriter(self.metadata)
+                try:
+                    for batch in self._merge(group):
+                        writer.extend(batch)
+                    merged_runs.append(writer.close())
+                except BaseException:
+                    writer.discard()
+                    raise
+                del runs[:self.fan_in]
+                drop_runs(group)
+        except BaseException:
+            drop_runs(merged_runs)
+            raise
+        return merged_runs
@@ -0,0 +1,363 @@
+import json
+import os
+import shutil
+from bisect import bisect_left, bisect_right
+from collections import Counter
+from typing import Iterator
+
+import config
+import constant
+
+from app.common.table.csv_adapter import get_converter
+from app.common.table.metadata import Metadata
+from app.common.table.wal import fsync_path
+from app.common.table.zone_map import parse_comparison
+
+_FIELD_TYPES = {'int': int, 'float': float, 'str': str, 'bool': bool}
+
+
+class BPlusTree:
+    """
+    disk-backed B+-tree mapping key -> number of rows with the key in each chunk
+    each node is a json file under the index dir, nodes are cached in memory and dirty nodes are written back on flush
+    leaf node:     {"leaf": true, "keys": [k1, k2, ...], "values": [{chunk_idx: row_cnt, ...}, ...], "next": next leaf id}
+    chunk ids are stored as strings (keys of json objects), a posting list never grows beyond the number of chunks
+    internal node: {"leaf": false, "keys": [k1, k2, ...], "children": [id0, id1, ...]}, keys in child i are in [keys[i-1], keys[i])
+    removal never rebalances the tree, lookups are still correct with underfull (even empty) leaves
+    """
+
+    META_FILE = "meta.json"
+
+    def __init__(self, path: str, order: int = config.index_node_size, cache_size: int = config.index_cache_size):
+        self.path = path
+        self.order = order
+        self.cache_size = cache_size
+        self.root = 0
+        self.next_id = 1
+        self.cache: dict[int, dict] = {}
+        self.dirty: dict[int, dict] = {}
+        # files written since the last sync
+        self.unsynced: set[str] = set()
+
+    def create(self):
+        os.makedirs(self.path, exist_ok=True)
+        self.root, self.next_id = 0, 1
+        self.cache, self.dirty = {}, {}
+        self._set_dirty(self.root, {"leaf": True, "keys": [], "values": [], "next": None})
+        self.flush()
+
+    def load(self):
+        with open(os.path.join(self.path, self.META_FILE), "r") as f:
+            meta = json.load(f)
+        self.root, self.next_id, self.order = meta["root"], meta["next_id"], meta["order"]
+        self.cache, self.dirty = {}, {}
+
+    def destroy(self):
+        self.cache, self.dirty, self.unsynced = {}, {}, set()
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def _node_path(self, node_id: int) -> str:
+        return os.path.join(self.path, "{}.json".format(node_id))
+
+    @staticmethod
+    def _write_json(path: str, obj):
+        # write to a temporary file then rename, readers never see a partially written file
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(obj, f)
+        os.replace(tmp_path, path)
+
+    def _get(self, node_id: int) -> dict:
+        node = self.dirty.get(node_id)
+        if node is None:
+            node = self.cache.get(node_id)
+        if node is None:
+            with open(self._node_path(node_id), "r") as f:
+                node = json.load(f)
+            self.cache[node_id] = node
+        return node
+
+    def _set_dirty(self, node_id: int, node: dict):
+        self.dirty[node_id] = node
+        self.cache[node_id] = node
+
+    def _new_node(self, node: dict) -> int:
+        node_id = self.next_id
+        self.next_id += 1
+        self._set_dirty(node_id, node)
+        return node_id
+
+    def _evict(self):
+        # only clean nodes are evicted, dirty ones are kept until flush
+        if len(self.cache) > self.cache_size:
+            self.cache = dict(self.dirty)
+
+    def flush(self):
+        for node_id, node in self.dirty.items():
+            self._write_json(self._node_path(node_id), node)
+            self.unsynced.add(self._node_path(node_id))
+        self.dirty = {}
+        self._write_json(os.path.join(self.path, self.META_FILE), {"root": self.root, "next_id": self.next_id, "order": self.order})
+        self.unsynced.add(os.path.join(self.path, self.META_FILE))
+
+    def sync(self) -> bool:
+        """
+        flush files written since the last sync onto the disk, see ChunkManager.checkpoint
+        :return: False if nothing is written
+        """
+        if len(self.unsynced) == 0:
+            return False
+        for path in self.unsynced:
+            fsync_path(path)
+        fsync_path(self.path)
+        self.unsynced = set()
+        return True
+
+    def _find_leaf(self, key) -> (int, dict):
+        node_id = self.root
+        node = self._get(node_id)
+        while not node["leaf"]:
+            node_id = node["children"][bisect_right(node["keys"], key)]
+            node = self._get(node_id)
+        return node_id, node
+
+    def insert(self, key, chunk_idx: int, cnt: int = 1):
+        self._evict()
+        split = self._insert(self.root, key, str(chunk_idx), cnt)
+        if split is not None:
+            separator, new_id = split
+            self.root = self._new_node({"leaf": False, "keys": [separator], "children": [self.root, new_id]})
+
+    def _insert(self, node_id: int, key, chunk: str, cnt: int):
+        """
+        :return: (separator, id of the new right sibling) if the node is split, otherwise None
+        """
+        node = self._get(node_id)
+        if node["leaf"]:
+            keys, values = node["keys"], node["values"]
+            i = bisect_left(keys, key)
+            if i < len(keys) and keys[i] == key:
+                values[i][chunk] = values[i].get(chunk, 0) + cnt
+            else:
+                keys.insert(i, key)
+                values.insert(i, {chunk: cnt})
+            self._set_dirty(node_id, node)
+            if len(keys) <= self.order:
+                return None
+            mid = len(keys) // 2
+            new_id = self._new_node({"leaf": True, "keys": keys[mid:], "values": values[mid:], "next": node["next"]})
+            node["keys"], node["values"], node["next"] = keys[:mid], values[:mid], new_id
+            return self._get(new_id)["keys"][0], new_id
+
+        i = bisect_right(node["keys"], key)
+        split = self._insert(node["children"][i], key, chunk, cnt)
+        if split is None:
+            return None
+        separator, child_id = split
+        node["keys"].insert(i, separator)
+        node["children"].insert(i + 1, child_id)
+        self._set_dirty(node_id, node)
+        if len(node["keys"]) <= self.order:
+            return None
+        mid = len(node["keys"]) // 2
+        separator = node["keys"][mid]
+        new_id = self._new_node({"leaf": False, "keys": node["keys"][mid + 1:], "children": node["children"][mid + 1:]})
+        node["keys"], node["children"] = node["keys"][:mid], node["children"][:mid + 1]
+        return separator, new_id
+
+    def remove(self, key, chunk_idx: int, cnt: int = 1) -> bool:
+        self._evict()
+        node_id, node = self._find_leaf(key)
+        keys, values = node["keys"], node["values"]
+        i, chunk = bisect_left(keys, key), str(chunk_idx)
+        if i == len(keys) or keys[i] != key or chunk not in values[i]:
+            return False
+        values[i][chunk] -= cnt
+        if values[i][chunk] <= 0:
+            del values[i][chunk]
+        if len(values[i]) == 0:
+            del keys[i]
+            del values[i]
+        self._set_dirty(node_id, node)
+        return True
+
+    def search(self, low=None, high=None, low_inclusive: bool = True, high_inclusive: bool = True) -> Iterator[tuple[object, int]]:
+        """
+        :param low: lower bound of keys, unbounded if None
+        :param high: upper bound of keys, unbounded if None
+        :return: a generator of (key, chunk_idx) in the order of keys
+        """
+        if low is None:
+            node = self._get(self.root)
+            while not node["leaf"]:
+                node = self._get(node["children"][0])
+            i = 0
+        else:
+            _, node = self._find_leaf(low)
+            i = bisect_left(node["keys"], low)
+
+        while True:
+            keys, values = node["keys"], node["values"]
+            while i < len(keys):
+                key = keys[i]
+                if high is not None and (key > high or (key == high and not high_inclusive)):
+                    return
+                if low is None or low_inclusive or key != low:
+                    for chunk in values[i]:
+                        yield key, int(chunk)
+                i += 1
+            if node["next"] is None:
+                return
+            node, i = self._get(node["next"]), 0
+
+
+class IndexManager:
+    """
+    secondary indexes (one B+-tree per column) of a sql table, stored under <table dir>/_index/<column>
+    indexes are maintained whenever a chunk is written, and used to find chunks which may satisfy an expression
+    only chunks are indexed, chunks are always filtered as a whole (see ChunkManager.get_chunks_to_scan)
+    """
+
+    def __init__(self, table_path: str, metadata: Metadata):
+        self.path = os.path.join(table_path, constant.INDEX_DIR_NAME)
+        self.metadata = metadata
+        self.indexes: dict[str, BPlusTree] = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        for column in os.listdir(self.path):
+            tree = BPlusTree(os.path.join(self.path, column))
+            if not os.path.exists(os.path.join(tree.path, BPlusTree.META_FILE)):
+                continue
+            tree.load()
+            self.indexes[column] = tree
+
+    def is_empty(self) -> bool:
+        return len(self.indexes) == 0
+
+    def has_index(self, column: str) -> bool:
+        return column in self.indexes
+
+    def get_indexed_columns(self) -> list[str]:
+        return list(self.indexes.keys())
+
+    # keys are values converted into the type of the field as they are stored (see csv_adapter), so keys of a tree are comparable
+    def _get_converter(self, column: str):
+        return get_converter(self.metadata.get_field_type(column))
+
+    def create(self, column: str, chunks, get_deleted=None) -> BPlusTree:
+        """
+        :param chunks: iterable of all chunks of the table (including deleted rows), used to build the index
+        :param get_deleted: chunk idx -> offsets of deleted rows (or None), which are not indexed
+        """
+        tree = BPlusTree(os.path.join(self.path, column))
+        tree.create()
+        convert = self._get_converter(column)
+        for chunk_idx, chunk in enumerate(chunks):
+            deleted = None if get_deleted is None else get_deleted(chunk_idx)
+            counts = Counter(convert(record[column]) for offset, record in enumerate(chunk) if deleted is None or offset not in deleted)
+            for key, cnt in counts.items():
+                tree.insert(key, chunk_idx, cnt)
+        tree.flush()
+        self.indexes[column] = tree
+        return tree
+
+    def on_write_chunk(self, chunk_idx: int, old_chunk: list[dict[str, object]], new_chunk: list[dict[str, object]], unchanged_cnt: int = 0, deleted=None):
+        """
+        update index entries of a rewritten chunk, the first unchanged_cnt rows are the same before and after
+        only keys whose number of rows in the chunk is changed are touched, e.g. none if no indexed column is updated
+        :param deleted: offsets of deleted rows, which have no index entries
+        """
+        for column, tree in self.indexes.items():
+            convert = self._get_converter(column)
+            counts = Counter()
+            for offset in range(unchanged_cnt, max(len(old_chunk), len(new_chunk))):
+                if deleted is not None and offset in deleted:
+                    continue
+                if offset < len(old_chunk):
+                    counts[convert(old_chunk[offset][column])] -= 1
+                if offset < len(new_chunk):
+                    counts[convert(new_chunk[offset][column])] += 1
+            for key, cnt in counts.items():
+                if cnt > 0:
+                    tree.insert(key, chunk_idx, cnt)
+                elif cnt < 0:
+                    tree.remove(key, chunk_idx, -cnt)
+
+    def on_append_chunk(self, chunk_idx: int, records: list[dict[str, object]]):
+        for column, tree in self.indexes.items():
+            convert = self._get_converter(column)
+            for key, cnt in Counter(convert(record[column]) for record in records).items():
+                tree.insert(key, chunk_idx, cnt)
+
+    def on_delete_rows(self, chunk_idx: int, chunk: list[dict[str, object]], offsets: list[int]):
+        for column, tree in self.indexes.items():
+            convert = self._get_converter(column)
+            for key, cnt in Counter(convert(chunk[offset][column]) for offset in offsets).items():
+                tree.remove(key, chunk_idx, cnt)
+
+    def flush(self):
+        for tree in self.indexes.values():
+            tree.flush()
+
+    def sync(self):
+        if any([tree.sync() for tree in self.indexes.values()]):
+            fsync_path(self.path)
+
+    # remove all entries, indexed columns are kept
+    def clear(self):
+        for tree in self.indexes.values():
+            tree.create()
+
+    def destroy(self):
+        for tree in self.indexes.values():
+            tree.destroy()
+        self.indexes = {}
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path)
+
+    def _lookup(self, column: str, op: str, literal) -> set[int] | None:
+        # comparing values of different types fails at runtime, keep the behavior unchanged
+        if type(literal) is not _FIELD_TYPES.get(self.metadata.get_field_type(column)):
+            return None
+        tree = self.indexes[column]
+        if op == constant.OP_NAME_EQ:
+            entries = tree.search(literal, literal)
+        elif op == constant.OP_NAME_LT:
+            entries = tree.search(high=literal, high_inclusive=False)
+        elif op == constant.OP_NAME_LE:
+            entries = tree.search(high=literal)
+        elif op == constant.OP_NAME_GT:
+            entries = tree.search(low=literal, low_inclusive=False)
+        elif op == constant.OP_NAME_GE:
+            entries = tree.search(low=literal)
+        else:
+            return None
+        return {chunk_idx for _, chunk_idx in entries}
+
+    def get_candidate_chunks(self, expression: any) -> set[int] | None:
+        """
+        find chunks which may contain records satisfying the expression
+        only &&, || and comparisons between an indexed column and a literal are used
+        :return: None if indexes can't be used for the expression, i.e. all chunks should be scanned
+        """
+        if type(expression) is not dict:
+            return None
+        op = expression.get(constant.QUERY_OP_KEY)
+        if op in [constant.OP_NAME_AND, constant.OP_NAME_OR]:
+            candidates1 = self.get_candidate_chunks(expression.get(constant.QUERY_VAR1_KEY))
+            candidates2 = self.get_candidate_chunks(expression.get(constant.QUERY_VAR2_KEY))
+            if op == constant.OP_NAME_AND:
+                if candidates1 is None or candidates2 is None:
+                    return candidates2 if candidates1 is None else candidates1
+                return candidates1 & candidates2
+            if candidates1 is None or candidates2 is None:
+                return None
+            return candidates1 | candidates2
+
+        comparison = parse_comparison(expression)
+        if comparison is None or comparison[0] not in self.indexes:
+            return None
+        return self._lookup(*comparison)
@@ -0,0 +1,280 @@
+from typing import Iterator
+
+import config
+import constant
+
+from app.common.table.field import FieldNameProcessor
+from app.common.table.metadata import Metadata
+from app.common.table.partition import HashPartitions
+from app.common.table.selector import Selector
+from app.common.table.table import Table
+
+# a skewed key may never fit in memory however the build side is partitioned, stop partitioning after a few rounds
+_MAX_PARTITION_DEPTH = 3
+
+
+class EquiJoinCondition:
+    """
+    join condition in the form of: 0::a == 1::b && 0::c == 1::d && residual
+    records are matched by the equi keys first, then the residual predicate (if any) is checked on each pair
+    """
+
+    def __init__(self, left_columns: list[str], right_columns: list[str], residual: Selector | None):
+        self.left_columns = left_columns
+        self.right_columns = right_columns
+        self.residual = residual
+
+    @staticmethod
+    def _split_conjuncts(expression: any) -> list:
+        if type(expression) is dict and expression.get(constant.QUERY_OP_KEY) == constant.OP_NAME_AND:
+            return EquiJoinCondition._split_conjuncts(expression.get(constant.QUERY_VAR1_KEY)) + \
+                EquiJoinCondition._split_conjuncts(expression.get(constant.QUERY_VAR2_KEY))
+        return [expression]
+
+    @staticmethod
+    def _parse_ref(operand: any) -> tuple[int, str] | None:
+        # same rule as ExprTree: a string with "::" is a reference
+        if type(operand) is not str or constant.QUERY_FIELD_REF_SYM not in operand:
+            return None
+        idx = FieldNameProcessor.get_outer_prefix(operand)
+        if idx not in ["0", "1"]:
+            return None
+        return int(idx), FieldNameProcessor.remove_outer_prefix(operand)
+
+    @staticmethod
+    def _parse_equi_key(conjunct: any) -> tuple[str, str] | None:
+        if type(conjunct) is not dict or conjunct.get(constant.QUERY_OP_KEY) != constant.OP_NAME_EQ:
+            return None
+        ref1 = EquiJoinCondition._parse_ref(conjunct.get(constant.QUERY_VAR1_KEY))
+        ref2 = EquiJoinCondition._parse_ref(conjunct.get(constant.QUERY_VAR2_KEY))
+        if ref1 is None or ref2 is None or ref1[0] == ref2[0]:
+            return None
+        return (ref1[1], ref2[1]) if ref1[0] == 0 else (ref2[1], ref1[1])
+
+    @staticmethod
+    def parse(expression: any, schemas: list[Metadata] | None = None) -> 'EquiJoinCondition | None':
+        """
+        :param expression: join condition in json format, "0::" refers to the left record and "1::" refers to the right one
+        :param schemas: metadata of both sides if known
+        :return: None if there is no equality between columns of both sides
+        """
+        keys, residuals = [], []
+        for conjunct in EquiJoinCondition._split_conjuncts(expression):
+            key = EquiJoinCondition._parse_equi_key(conjunct)
+            if key is None:
+                residuals.append(conjunct)
+            else:
+                keys.append(key)
+        if len(keys) == 0:
+            return None
+
+        residual = None
+        if len(residuals):
+            residual_expression = residuals[0]
+            for conjunct in residuals[1:]:
+                residual_expression = {constant.QUERY_OP_KEY: constant.OP_NAME_AND, constant.QUERY_VAR1_KEY: residual_expression, constant.QUERY_VAR2_KEY: conjunct}
+            residual = Selector(residual_expression, schemas)
+        return EquiJoinCondition([key[0] for key in keys], [key[1] for key in keys], residual)
+
+    @staticmethod
+    def _get_key(entry: dict[str, object], columns: list[str]) -> tuple | None:
+        # comparing with a missing field always fails, such records never match
+        if not all(column in entry for column in columns):
+            return None
+        return tuple(entry[column] for column in columns)
+
+    def get_left_key(self, entry: dict[str, object]) -> tuple | None:
+        return self._get_key(entry, self.left_columns)
+
+    def get_right_key(self, entry: dict[str, object]) -> tuple | None:
+        return self._get_key(entry, self.right_columns)
+
+    def is_residual_match(self, left: dict[str, object], right: dict[str, object]) -> bool:
+        if self.residual is None:
+            return True
+        match, status = self.residual.is_match([left, right])
+        if not status.ok():
+            raise RuntimeError("failed to compare entries: {}".format([left, right]))
+        return match
+
+
+def build_join_record(left_name: str, left: dict[str, object], right_name: str, right: dict[str, object]) -> dict[str, object]:
+    record = {FieldNameProcessor.add_prefix(k, left_name): v for k, v in left.items()}
+    record.update({FieldNameProcessor.add_prefix(k, right_name): v for k, v in right.items()})
+    return record
+
+
+class HashJoiner:
+    """
+    grace hash join, the right side is the build side and the left side is streamed to probe the hash table
+    if the build side exceeds the memory budget, both sides are spilled into hash partitions on the disk
+    and each pair of partitions is joined recursively
+    """
+
+    def __init__(self, condition: EquiJoinCondition, left_name: str, left_metadata: Metadata, right_name: str, right_metadata: Metadata,
+                 memory_budget: int = config.memory_budget, depth: int = 0, on_build=None):
+        """
+        :param on_build: called with the first key column of the left side and its values in the hash table before the left side is pulled,
+        e.g. to skip chunks of the left table without any of the values (see PhysicalOperator.set_key_filter)
+        """
+        self.condition = condition
+        self.left_name = left_name
+        self.left_metadata = left_metadata
+        self.right_name = right_name
+        self.right_metadata = right_metadata
+        self.memory_budget = memory_budget
+        self.depth = depth
+        self.on_build = on_build
+
+    def join(self, left_batches, right_batches) -> Iterator[list[dict[str, object]]]:
+        hash_table: dict[tuple, list[dict[str, object]]] = {}
+        build_cnt = 0
+        right_batches = iter(right_batches)
+        for batch in right_batches:
+            for entry in batch:
+                key = self.condition.get_right_key(entry)
+                if key is None:
+                    continue
+                hash_table.setdefault(key, []).append(entry)
+                build_cnt += 1
+            if build_cnt > self.memory_budget and self.depth < _MAX_PARTITION_DEPTH:
+                yield from self._partitioned_join(left_batches, hash_table, right_batches)
+                return
+        if self.on_build is not None:
+            self.on_build(self.condition.left_columns[0], {key[0] for key in hash_table})
+        yield from self._probe(left_batches, hash_table)
+
+    def _probe(self, left_batches, hash_table: dict[tuple, list[dict[str, object]]]) -> Iterator[list[dict[str, object]]]:
+        records = []
+        for batch in left_batches:
+            for entry in batch:
+                key = self.condition.get_left_key(entry)
+                if key is None:
+                    continue
+                for right_entry in hash_table.get(key, []):
+                    if self.condition.is_residual_match(entry, right_entry):
+                        records.append(build_join_record(self.left_name, entry, self.right_name, right_entry))
+            if len(records) >= config.max_chunk_size:
+                yield records
+                records = []
+        if len(records):
+            yield records
+
+    def _partitioned_join(self, left_batches, hash_table: dict[tuple, list[dict[str, object]]], right_batches) -> Iterator[list[dict[str, object]]]:
+        right_partitions = HashPartitions(self.right_metadata, self.depth)
+        left_partitions = HashPartitions(self.left_metadata, self.depth)
+        # spilled partitions are dropped even if the caller stops early (e.g. LIMIT) or fails
+        try:
+            for key, entries in hash_table.items():
+                for entry in entries:
+                    right_partitions.add(key, entry)
+            hash_table.clear()
+            for batch in right_batches:
+                for entry in batch:
+                    key = self.condition.get_right_key(entry)
+                    if key is not None:
+                        right_partitions.add(key, entry)
+            right_partitions.flush()
+
+            for batch in left_batches:
+                for entry in batch:
+                    key = self.condition.get_left_key(entry)
+                    # records of partitions without any right record never match
+                    if key is not None and right_partitions.get_partition(left_partitions.get_partition_idx(key)) is not None:
+                        left_partitions.add(key, entry)
+            left_partitions.flush()
+
+            for idx in range(right_partitions.partition_cnt):
+                left, right = left_partitions.get_partition(idx), right_partitions.get_partition(idx)
+                if left is not None and right is not None:
+                    sub_joiner = HashJoiner(self.condition, self.left_name, self.left_metadata, self.right_name, self.right_metadata, self.memory_budget, self.depth + 1)
+                    yield from sub_joiner.join(left.chunk_manager.get_iter(), right.chunk_manager.get_iter())
+                left_partitions.drop(idx)
+                right_partitions.drop(idx)
+        finally:
+            left_partitions.drop_all()
+            right_partitions.drop_all()
+
+
+def _group_by_first_key(batches, get_key) -> Iterator[tuple[object, list[dict[str, object]]]]:
+    # consecutive records sharing the same value of the first key column
+    value, group = None, []
+    for batch in batches:
+        for entry in batch:
+            key = get_key(entry)
+            if key is None:
+                continue
+            if len(group) and key[0] != value:
+                yield value, group
+                group = []
+            value = key[0]
+            group.append(entry)
+    if len(group):
+        yield value, group
+
+
+def merge_join(condition: EquiJoinCondition, left_name: str, left_batches, right_name: str, right_batches) -> Iterator[list[dict[str, object]]]:
+    """
+    sort-merge join, both sides must be sorted on the first key column in ascending order
+    other key columns and the residual predicate are checked on each pair of records sharing the first key
+    """
+    left_groups = _group_by_first_key(left_batches, condition.get_left_key)
+    right_groups = _group_by_first_key(right_batches, condition.get_right_key)
+    left_group, right_group = next(left_groups, None), next(right_groups, None)
+    records = []
+    while left_group is not None and right_group is not None:
+        if left_group[0] < right_group[0]:
+            left_group = next(left_groups, None)
+            continue
+        if left_group[0] > right_group[0]:
+            right_group = next(right_groups, None)
+            continue
+        for left in left_group[1]:
+            left_key = condition.get_left_key(left)
+            for right in right_group[1]:
+                if left_key == condition.get_right_key(right) and condition.is_residual_match(left, right):
+                    records.append(build_join_record(left_name, left, right_name, right))
+        if len(records) >= config.max_chunk_size:
+            yield records
+            records = []
+        left_group, right_group = next(left_groups, None), next(right_groups, None)
+    if len(records):
+        yield records
+
+
+def nested_loop_join(selector: Selector, left_name: str, left_batches, right: Table) -> Iterator[list[dict[str, object]]]:
+    """
+    records of the left side are streamed batch by batch, the right table is scanned once per batch
+    """
+    for left_batch in left_batches:
+        for right_chunk in right.chunk_manager.get_iter():
+            records = []
+            for entry1 in left_batch:
+                for entry2 in right_chunk:
+                    match, status = selector.is_match([entry1, entry2])
+                    if not status.ok():
+                        raise RuntimeError("failed to compare entries: {}".format([entry1, entry2]))
+                    if match:
+                        records.append(build_join_record(left_name, entry1, right.name, entry2))
+            if len(records):
+                yield records
+
+
+def join_batches(left_name: str, left_metadata: Metadata, left_batches, left_sorted_by: list[str] | None,
+                 right: Table, selector: Selector, memory_budget: int = config.memory_budget, on_build=None) -> Iterator[list[dict[str, object]]]:
+    """
+    join the left records with the right table, all columns are renamed with prefix of table names, e.g. a -> "A::a"
+    equi joins run as sort-merge join if both sides are sorted on the key, otherwise as grace hash join
+    any other condition falls back to nested loop join
+    :param left_sorted_by: columns the left records are sorted on in ascending order, None if unknown
+    :param on_build: see HashJoiner
+    """
+    condition = EquiJoinCondition.parse(selector.expression, [left_metadata, right.metadata])
+    if condition is None:
+        return nested_loop_join(selector, left_name, left_batches, right)
+
+    if left_sorted_by and right.sorted_by and left_sorted_by[0] == condition.left_columns[0] and right.sorted_by[0] == condition.right_columns[0]:
+        return merge_join(condition, left_name, left_batches, right.name, right.chunk_manager.get_iter())
+
+    joiner = HashJoiner(condition, left_name, left_metadata, right.name, right.metadata, memory_budget, on_build=on_build)
+    return joiner.join(left_batches, right.chunk_manager.get_iter())
@@ -0,0 +1,84 @@
+import functools
+import threading
+from contextlib import contextmanager
+
+
+class ReadWriteLock:
+    """
+    many readers or a single writer, writers are preferred so that a stream of queries can't starve them
+    a thread already holding the read lock may acquire it again (e.g. a self join scans the same table twice)
+    the lock is released by the thread which acquired it, even if a generator holding it is closed by another one
+    """
+
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        # thread id -> number of read locks held by the thread
+        self.readers: dict[int, int] = {}
+        self.writer: int | None = None
+        self.waiting_writers = 0
+
+    def acquire_read(self) -> int:
+        ident = threading.get_ident()
+        with self.cond:
+            while not self._can_read(ident):
+                self.cond.wait()
+            self.readers[ident] = self.readers.get(ident, 0) + 1
+        return ident
+
+    def _can_read(self, ident: int) -> bool:
+        if self.writer == ident:
+            return True
+        if self.writer is not None:
+            return False
+        return self.waiting_writers == 0 or ident in self.readers
+
+    def release_read(self, ident: int):
+        with self.cond:
+            self.readers[ident] -= 1
+            if self.readers[ident] == 0:
+                del self.readers[ident]
+                self.cond.notify_all()
+
+    def acquire_write(self):
+        ident = threading.get_ident()
+        with self.cond:
+            # the read lock held by the same thread would never be released, fail instead of deadlock
+            if self.writer == ident or ident in self.readers:
+                raise RuntimeError("write lock is not reentrant and can't be upgraded from a read lock")
+            self.waiting_writers += 1
+            while self.writer is not None or len(self.readers):
+                self.cond.wait()
+            self.waiting_writers -= 1
+            self.writer = ident
+
+    def release_write(self):
+        with self.cond:
+            self.writer = None
+            self.cond.notify_all()
+
+    @contextmanager
+    def read(self):
+        ident = self.acquire_read()
+        try:
+            yield
+        finally:
+            self.release_read(ident)
+
+    @contextmanager
+    def write(self):
+        self.acquire_write()
+        try:
+            yield
+        finally:
+            self.release_write()
+
+
+def write_locked(method):
+    """
+    run the method with the write lock of the object held, the object should have a ReadWriteLock named lock
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock.write():
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,128 @@
+import json
+import os
+
+# bumped whenever the layout of the manifest changes, manifests of other versions are rebuilt from the table dir
+FORMAT_VERSION = 1
+
+
+class ChunkInfo:
+
+    def __init__(self, chunk_id: int, row_cnt: int | None, size: int, version: int = 0, deleted_cnt: int = 0, file_id: int | None = None):
+        self.chunk_id = chunk_id
+        # name of the chunk file (and its tail log and deletion bitmap), kept while chunks before it are compacted
+        self.file_id = chunk_id if file_id is None else file_id
+        # None if unknown, e.g. the manifest is rebuilt for a table created before manifests were introduced
+        self.row_cnt = row_cnt
+        self.size = size
+        # increased whenever the chunk is written, used to tell whether a cached chunk is stale
+        self.version = version
+        # rows marked in the deletion bitmap, which are still counted in row_cnt until the chunk is compacted
+        self.deleted_cnt = deleted_cnt
+
+    def to_json_obj(self) -> dict:
+        return {"id": self.chunk_id, "row_cnt": self.row_cnt, "size": self.size, "version": self.version, "deleted_cnt": self.deleted_cnt,
+                "file_id": self.file_id}
+
+    @staticmethod
+    def from_json_obj(obj: dict) -> 'ChunkInfo':
+        return ChunkInfo(obj["id"], obj["row_cnt"], obj["size"], obj.get("version", 0), obj.get("deleted_cnt", 0), obj.get("file_id"))
+
+
+class ChunkManifest:
+    """
+    chunks of a table (id, number of rows, size in bytes, version), persisted in a sidecar file under the table dir
+    it is kept in memory, so counting chunks never lists the table dir
+    chunk ids are always 0, 1, ..., n - 1, files of chunks are named by file ids, which are never reused,
+    so files of a new layout (see replace_chunks) are written aside the old ones and switched to by saving the manifest
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks: list[ChunkInfo] = []
+        # lsn of the last operation in the write-ahead log which is applied to chunks
+        self.lsn = 0
+        # file id of the next new chunk
+        self.next_file_id = 0
+
+    def load(self) -> bool:
+        """
+        :return: False if there is no manifest of the current version, which should be rebuilt
+        """
+        if not os.path.exists(self.path):
+            return False
+        with open(self.path, "r") as f:
+            obj = json.load(f)
+        if obj.get("version") != FORMAT_VERSION:
+            return False
+        self.chunks = [ChunkInfo.from_json_obj(chunk) for chunk in obj["chunks"]]
+        self.lsn = obj.get("lsn", 0)
+        self.next_file_id = obj.get("next_file_id", max([chunk.file_id + 1 for chunk in self.chunks], default=0))
+        return True
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            return
+        # write to a temporary file then rename, readers never see a partially written file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"version": FORMAT_VERSION, "lsn": self.lsn, "next_file_id": self.next_file_id, "chunks": [chunk.to_json_obj() for chunk in self.chunks]}, f)
+        os.replace(tmp_path, self.path)
+
+    def get_chunk_cnt(self) -> int:
+        return len(self.chunks)
+
+    def get_chunk(self, chunk_idx: int) -> ChunkInfo | None:
+        if chunk_idx < 0 or chunk_idx >= len(self.chunks):
+            return None
+        return self.chunks[chunk_idx]
+
+    def get_row_cnt(self, chunk_idx: int) -> int | None:
+        chunk = self.get_chunk(chunk_idx)
+        return None if chunk is None else chunk.row_cnt
+
+    def get_version(self, chunk_idx: int) -> int:
+        chunk = self.get_chunk(chunk_idx)
+        return 0 if chunk is None else chunk.version
+
+    def get_file_id(self, chunk_idx: int) -> int:
+        """
+        :return: file id of the chunk, chunks after the last one get file ids of new chunks in order
+        """
+        if chunk_idx >= len(self.chunks):
+            return self.next_file_id + chunk_idx - len(self.chunks)
+        return self.chunks[chunk_idx].file_id
+
+    def get_file_ids(self) -> set[int]:
+        return {chunk.file_id for chunk in self.chunks}
+
+    def get_deleted_cnt(self, chunk_idx: int) -> int:
+        chunk = self.get_chunk(chunk_idx)
+        return 0 if chunk is None else chunk.deleted_cnt
+
+    # rows are appended or updated in place, offsets of deleted rows are unchanged
+    def set_chunk(self, chunk_idx: int, row_cnt: int | None, size: int):
+        if chunk_idx == len(self.chunks):
+            self.chunks.append(ChunkInfo(chunk_idx, row_cnt, size, file_id=self.next_file_id))
+            self.next_file_id += 1
+        else:
+            old = self.chunks[chunk_idx]
+            self.chunks[chunk_idx] = ChunkInfo(chunk_idx, row_cnt, size, old.version + 1, old.deleted_cnt, old.file_id)
+
+    def set_deleted_cnt(self, chunk_idx: int, deleted_cnt: int):
+        self.chunks[chunk_idx].deleted_cnt = deleted_cnt
+
+    def replace_chunks(self, start: int, end: int, chunks: list[tuple[int, int]]):
+        """
+        replace chunks [start, end) with new chunks without deleted rows, chunks after them are renumbered
+        :param chunks: (number of rows, size) of each new chunk, which is stored under the file id of a new chunk (see get_file_id)
+        """
+        version = max([chunk.version for chunk in self.chunks[start:end]], default=0) + 1
+        new_chunks = [ChunkInfo(start + i, row_cnt, size, version, file_id=self.next_file_id + i) for i, (row_cnt, size) in enumerate(chunks)]
+        self.next_file_id += len(chunks)
+        self.chunks = self.chunks[:start] + new_chunks + self.chunks[end:]
+        for i, chunk in enumerate(self.chunks):
+            chunk.chunk_id = i
+
+    def clear(self):
+        self.chunks = []
+        self.next_file_id = 0
@@ -1,6 +1,6 @@
 import math
-from collections import Counter
 from enum import Enum
+from typing import Iterator
 
 import config
 import constant
@@ -8,8 +8,11 @@ import constant
 import logger as logger
 
 from app.common.context.context import Context
+from app.common.table.external_sort import ExternalSorter, RunWriter, make_sort_key
 from app.common.table.field import FieldNameProcessor
+from app.common.table.join import join_batches
 from app.common.table.metadata import Metadata
+from app.common.table.partition import HashPartitions
 from app.common.table.selector import Selector
 from app.common.table.table import Table
 from app.common.table.table_manager import get_table_manager
@@ -19,10 +22,22 @@ import random
 
 class SortOption:
 
-    def __init__(self, column: str, is_asc: bool = True, ways: int = config.max_chunk_size):
+    def __init__(self, column: str, is_asc: bool = True, ways: int | None = None):
         self.column = column
         self.is_asc = is_asc
-        self.ways = ways  # how many ways are used in merge-sort
+        self.ways = ways  # how many runs are merged at a time in merge-sort, chosen from the memory budget if None
+
+
+def get_sorted_by(sort_options: list[SortOption]) -> list[str] | None:
+    """
+    :return: leading columns sorted in ascending order, None if the first column is sorted in descending order
+    """
+    columns = []
+    for option in sort_options:
+        if not option.is_asc:
+            break
+        columns.append(FieldNameProcessor.remove_outer_prefix(option.column))
+    return columns if len(columns) else None
 
 
 class ReduceOperation(Enum):
@@ -87,15 +102,113 @@ class Reducer:
 
 class GroupByOption:
 
-    def __init__(self, column: str, reduce_options: list[ReduceOption]):
+    def __init__(self, columns: list[str], reduce_options: list[ReduceOption]):
         """
-        :param column: group by column
-        :param reduce_options: e.g. max(col1), avg(col2), notice: col1 and col2 should not be the same as self.column
+        :param columns: group by columns
+        :param reduce_options: e.g. max(col1), avg(col2), notice: col1 and col2 should not be any of the group by columns
         """
-        self.column = column
+        self.columns = columns
         self.options = reduce_options
 
 
+class HashAggregator:
+    """
+    hash aggregation: one group of running reducers is kept in memory for each distinct key
+    once the number of groups reaches the memory budget, records of new keys are spilled into hash partitions on the disk
+    and each partition is aggregated recursively after all in-memory groups are produced
+    groups in memory are produced in the order of keys
+    """
+
+    def __init__(self, metadata: Metadata, group_by_option: GroupByOption, memory_budget: int = config.memory_budget, depth: int = 0):
+        """
+        :param metadata: metadata of input records
+        :param group_by_option: columns are without prefix
+        :param memory_budget: max number of groups kept in memory
+        :param depth: recursion depth, partitions of different depths use different hash functions
+        """
+        for option in group_by_option.options:
+            if FieldNameProcessor.remove_suffix(option.column) in group_by_option.columns:
+                raise RuntimeError("can't call reduce function on group by column: {}".format(option.column))
+        self.output_names = []
+        for option in group_by_option.options:
+            # max(col) will be renamed as col__MAX
+            name = option.column
+            if FieldNameProcessor.get_suffix(name) == "":
+                name = TableManipulator._decorate_reduced_column_name(name, option.agg)
+            if name in self.output_names:
+                raise RuntimeError("duplicated aggregated field detected: {}".format(name))
+            self.output_names.append(name)
+
+        self.metadata = metadata
+        self.group_by_option = group_by_option
+        self.memory_budget = max(1, memory_budget)
+        self.depth = depth
+
+    def get_metadata(self) -> Metadata:
+        # group by columns should be untouched
+        new_fields = [{column: self.metadata.get_field_type(column)} for column in self.group_by_option.columns]
+        # TODO handle potential type transferring e.g. int -> float
+        new_fields += [{name: 'float'} for name in self.output_names]
+        return Metadata(self.metadata.table_name, self.metadata.db_type, new_fields, self.metadata.get_chunk_format())
+
+    @staticmethod
+    def _key_order(key: tuple) -> tuple:
+        # null (missing in nosql records) is placed after other values
+        return tuple((v is None, 0 if v is None else v) for v in key)
+
+    def aggregate(self, batches) -> Iterator[list[dict[str, object]]]:
+        """
+        :param batches: iterable of input batches
+        :return: a generator of batches of reduced records
+        """
+        columns = self.group_by_option.columns
+        groups: dict[tuple, list[Reducer]] = {}
+        partitions = None
+
+        # spilled partitions are dropped even if the caller stops early (e.g. LIMIT) or fails
+        try:
+            for batch in batches:
+                for entry in batch:
+                    key = tuple(entry.get(column) for column in columns)
+                    reducers = groups.get(key)
+                    if reducers is None:
+                        if len(groups) >= self.memory_budget:
+                            if partitions is None:
+                                partitions = HashPartitions(self.metadata, self.depth)
+                            partitions.add(key, entry)
+                            continue
+                        reducers = groups[key] = [Reducer(option) for option in self.group_by_option.options]
+                    for reducer in reducers:
+                        reducer.append(entry)
+
+            records = []
+            for key in sorted(groups, key=self._key_order):
+                record = dict(zip(columns, key))
+                for name, reducer in zip(self.output_names, groups[key]):
+                    record[name] = reducer.reduce()
+                records.append(record)
+                if len(records) >= config.max_chunk_size:
+                    yield records
+                    records = []
+            if len(records):
+                yield records
+            groups.clear()
+
+            if partitions is None:
+                return
+            partitions.flush()
+            for idx in range(partitions.partition_cnt):
+                partition = partitions.get_partition(idx)
+                if partition is None:
+                    continue
+                sub_aggregator = HashAggregator(self.metadata, self.group_by_option, self.memory_budget, self.depth + 1)
+                yield from sub_aggregator.aggregate(partition.chunk_manager.get_iter())
+                partitions.drop(idx)
+        finally:
+            if partitions is not None:
+                partitions.drop_all()
+
+
 class JoinOption(Enum):
     outer = 1
 
@@ -106,51 +219,31 @@ class TableManipulator:
     """
 
     @staticmethod
-    def filter(src_table: Table, selector: Selector) -> Table:
+    def _scan_to_table(src_table: Table, selector: Selector | None, columns: list[str] | None, metadata: Metadata) -> Table:
         """
-        select entries which satisfies certain condition, only works on single table
-        :param src_table: input table
-        :return: Table: temporary table
+        scan src_table with filter and projection pushed down, all results are written into a single tmp table
         """
-        table_manger = get_table_manager()
-        new_table, status = table_manger.create_tmp_table(src_table.metadata)
+        new_table, status = get_table_manager().create_tmp_table(metadata)
         if not status.ok():
             raise RuntimeError("failed to create new tmp table")
 
         new_records = []
-        for chunk in src_table.chunk_manager.get_iter():
-            for entry in chunk:
-                match, status = selector.is_match([entry])
+        for records in src_table.chunk_manager.scan(selector, columns):
+            new_records += records
+            if len(new_records) >= config.max_chunk_size:
+                status = new_table.insert_bulk(new_records)
                 if not status.ok():
-                    raise RuntimeError("selector failed to valuate expression")
-                if match:
-                    new_records.append(entry)
-                    if len(new_records) >= config.max_chunk_size:
-                        status = new_table.insert_bulk(new_records)
-                        if not status.ok():
-                            raise RuntimeError("failed to insert new entry")
-                        new_records = []
+                    raise RuntimeError("failed to insert new entry")
+                new_records = []
         if len(new_records):
             status = new_table.insert_bulk(new_records)
             if not status.ok():
                 raise RuntimeError("failed to insert new entry")
 
-        if not status.ok():
-            raise RuntimeError("failed to insert records")
-
         return new_table
 
-    # TODO support nosql, which has nested fields i.e. a.b.c
     @staticmethod
-    def projection(src_table: Table, desired_column: list[str]) -> Table:
-        """
-        project src_table to desired columns, only works on single table
-        if duplicated columns are desired, we have to give them different names
-        :param src_table: input table
-        :param desired_column: all columns to keep
-        :return: temporary table
-        """
-        table_manger = get_table_manager()
+    def _get_projected_metadata(src_table: Table, desired_column: list[str]) -> (list[str], Metadata):
         if len(desired_column) != len(set(desired_column)):
             raise RuntimeError("unable to project duplicated columns {}, which is not existed".format(desired_column))
         new_column_names = []
@@ -160,222 +253,62 @@ class TableManipulator:
             new_column_names.append(extracted_name)
             if src_table.metadata.db_type == constant.DB_TYPE_SQL:
                 new_field_info.append({extracted_name: src_table.metadata.get_field_type(extracted_name)})
-        new_metadata = Metadata(src_table.name, src_table.metadata.db_type, new_field_info)
-        new_table, status = table_manger.create_tmp_table(new_metadata)
-
-        if not status.ok():
-            raise RuntimeError("failed to create new tmp table")
-
-        new_records = []
-        for chunk in src_table.chunk_manager.get_iter():
-            for entry in chunk:
-                new_entry = {}
-                for column in new_column_names:
-                    if column in entry:
-                        new_entry[column] = entry[column]
-                new_records.append(new_entry)
-                if len(new_records) >= config.max_chunk_size:
-                    status = new_table.insert_bulk(new_records)
-                    if not status.ok():
-                        raise RuntimeError("failed to insert new entry")
-                    new_records = []
-
-        if len(new_records):
-            status = new_table.insert_bulk(new_records)
-            if not status.ok():
-                raise RuntimeError("failed to insert new entry")
-
-        return new_table
+        return new_column_names, Metadata(src_table.name, src_table.metadata.db_type, new_field_info, src_table.metadata.get_chunk_format())
 
     @staticmethod
-    def _sort_each_chunk(src_table: Table, column: str, is_asc: bool) -> Table:
-        new_table, status = get_table_manager().create_tmp_table(src_table.metadata)
-        if not status.ok():
-            raise RuntimeError("failed to create new tmp table")
-
-        # first pass
-        for chunk in src_table.chunk_manager.get_iter():
-            def sort_key(item):
-                return item[column]
-
-            new_chunk = sorted(chunk, key=sort_key, reverse=(not is_asc))
-            status = new_table.insert_bulk(new_chunk)
-            if not status.ok():
-                raise RuntimeError("failed to insert records")
-
-        return new_table
-
-    @staticmethod
-    def _merge_sort(src_table: Table, ways: int, column: str, is_asc: bool) -> Table:
-        if ways <= 1:
-            raise RuntimeError("invalid ways {} for merge sort".format(ways))
-
-        total_chunks = src_table.chunk_manager.get_chunk_cnt()
-        # if there are 0 - 100 chunks, then 1 run is needed
-        # if there are 101 - 10000 chunks, then 2 run is needed
-        # ...
-        passes = math.ceil(math.log(total_chunks, ways))
-        input_table = src_table
-        step = 1
-        generated_runs_cnt = total_chunks
-        for _ in range(passes):
-            cm = input_table.chunk_manager
-            # total_chunks must be updated for each pass, as the size might shrink
-            total_chunks = cm.get_chunk_cnt()
-            generated_runs_cnt = math.ceil(generated_runs_cnt / ways)
-            out_put_table, status = get_table_manager().create_tmp_table(src_table.metadata)
-            if not status.ok():
-                raise RuntimeError("failed to create new tmp table")
-            idx = 0
-            for i in range(generated_runs_cnt):
-                runs = []
-                # load at most ways chunks into memory
-                for j in range(ways):
-                    if idx >= total_chunks:
-                        break
-                    chunk, status = cm.load_chunk(idx)
-                    if not status.ok():
-                        raise RuntimeError("failed to load records")
-                    runs.append([chunk, max(min(step, total_chunks - idx) - 1, 0), min(idx + step, total_chunks)])
-                    idx += step
-                idx_per_way, finish_cnt, new_records = [0 for _ in range(len(runs))], 0, []
-                while finish_cnt != len(runs):
-                    # if any way has run out of element, it should be ignored
-                    elements = [(runs[j][0][idx_per_way[j]], j) for j in range(len(runs)) if idx_per_way[j] != len(runs[j][0])]
-
-                    def sort_key(item):
-                        return item[0][column]
-
-                    next_idx = min(elements, key=sort_key)[1] if is_asc else max(elements, key=sort_key)[1]
-                    # notice, here we don't have to flush chunk into memory whenever it's full
-                    new_records.append(runs[next_idx][0][idx_per_way[next_idx]])
-                    idx_per_way[next_idx] += 1
-                    if idx_per_way[next_idx] == len(runs[next_idx][0]):
-                        if runs[next_idx][1] != 0:
-                            chunk, status = cm.load_chunk(runs[next_idx][2] - runs[next_idx][1])
-                            if not status.ok():
-                                raise RuntimeError("failed to load records")
-                            runs[next_idx][0] = chunk
-                            runs[next_idx][1] -= 1
-                            idx_per_way[next_idx] = 0
-                    if idx_per_way[next_idx] == len(runs[next_idx][0]) and runs[next_idx][1] == 0:
-                        finish_cnt += 1
-                status = out_put_table.insert_bulk(new_records)
-                if not status.ok():
-                    raise RuntimeError("failed to flush onto disk")
-            step *= ways
-            input_table = out_put_table
-
-        return input_table
-
-    @staticmethod
-    def _sort_one_column(src_table, sort_options: SortOption):
-        column, is_asc, ways = sort_options.column, sort_options.is_asc, sort_options.ways
-        table = TableManipulator._sort_each_chunk(src_table, column, is_asc)
-        return TableManipulator._merge_sort(table, ways, column, is_asc)
+    def filter(src_table: Table, selector: Selector) -> Table:
+        """
+        select entries which satisfies certain condition, only works on single table
+        chunks which can't satisfy the condition are skipped according to the zone map
+        :param src_table: input table
+        :return: Table: temporary table
+        """
+        return TableManipulator._scan_to_table(src_table, selector, None, src_table.metadata)
 
+    # TODO support nosql, which has nested fields i.e. a.b.c
     @staticmethod
-    def sort(src_table: Table, sort_options: list[SortOption]) -> Table:
+    def projection(src_table: Table, desired_column: list[str]) -> Table:
         """
-        sort src_table, use 100-way merge sort
-        For multiple columns:
-        1. sort by the first column, generate table t1
-        2. spilt table into multiple sub_tables t11, ..., t1n, based on the value of the first column (similar as group_by)
-        3. for each sub_table, sort by the second column, generate  sub_tables t21, ..., t2n
-        4. merge t21, ..., t2n into t2
-        5. split table into sub_tables t31, ..., t3n, based on the combination of the first two columns
-        6. ...
-
-        :param src_table:
-        :param sort_options: list of SortOption, support sorting by multiple columns
-        :return: result table
+        project src_table to desired columns, only works on single table
+        if duplicated columns are desired, we have to give them different names
+        :param src_table: input table
+        :param desired_column: all columns to keep
+        :return: temporary table
         """
-        # TODO implement multi-field sorting
-        # handle sorting columns:
-        new_options = []
-        for option in sort_options:
-            new_options.append(SortOption(FieldNameProcessor.remove_outer_prefix(option.column), option.is_asc))
-        return TableManipulator._sort_one_column(src_table, new_options[0])
+        new_column_names, new_metadata = TableManipulator._get_projected_metadata(src_table, desired_column)
+        return TableManipulator._scan_to_table(src_table, None, new_column_names, new_metadata)
 
     @staticmethod
-    def _sort_and_split_on_column(src_table: Table, sort_option: SortOption) -> list[Table]:
+    def filter_and_project(src_table: Table, selector: Selector, desired_column: list[str]) -> Table:
         """
-        split one sorted table into many tables according to the sorted column
-        all records in any one of the result table have the same value of the column
-        :param src_table:
-        :param sort_option:
-        :return:
+        filter and projection in a single pass over src_table, no intermediate table is created
+        only columns used by the selector or desired are decoded, and only matched records are built
+        :param src_table: input table
+        :param selector: filter
+        :param desired_column: all columns to keep
+        :return: temporary table
         """
-        tm = get_table_manager()
-        new_table, status = tm.create_tmp_table(src_table.metadata)
-        if not status.ok():
-            raise ValueError("failed to create empty table")
-        tables: list[Table] = [new_table]
-
-        if src_table.chunk_manager.is_empty_table():
-            return tables
-
-        column = sort_option.column
-        sorted_table = TableManipulator.sort(src_table, [sort_option])
-        last_value = sorted_table.chunk_manager.get_fist_chunk()[0][0][column]
-        new_records = []
-        for chunk in sorted_table.chunk_manager.get_iter():
-            for entry in chunk:
-                if last_value != entry[column]:
-                    # dump records
-                    status = tables[-1].chunk_manager.dump_bulk(new_records)
-                    if not status.ok():
-                        raise ValueError("failed to dump bulk")
-                    new_table, status = tm.create_tmp_table(src_table.metadata)
-                    if not status.ok():
-                        raise ValueError("failed to create empty table")
-                    new_records = []
-                    last_value = entry[column]
-                    tables.append(new_table)
-                new_records.append(entry)
-                # dump new_records
-                if len(new_records) == config.max_chunk_size:
-                    status = tables[-1].chunk_manager.dump_bulk(new_records)
-                    if not status.ok():
-                        raise ValueError("failed to dump bulk")
-                    new_records = []
-        if len(new_records) != 0:
-            status = tables[-1].chunk_manager.dump_bulk(new_records)
-            if not status.ok():
-                raise ValueError("failed to dump bulk")
-        return tables
+        new_column_names, new_metadata = TableManipulator._get_projected_metadata(src_table, desired_column)
+        return TableManipulator._scan_to_table(src_table, selector, new_column_names, new_metadata)
 
     @staticmethod
-    def _concat(tables: list[Table]) -> Table:
+    def sort(src_table: Table, sort_options: list[SortOption], memory_budget: int = config.memory_budget) -> Table:
         """
-        concat multiple table into a single table (keep the sequence)
-        :param tables: all tables to be merged (order matters)
-        :return: merged table
+        sort src_table with external merge sort, see ExternalSorter
+        records are sorted by the composite key of all sort columns, which is extracted once per record
+        :param src_table:
+        :param sort_options: list of SortOption, support sorting by multiple columns in mixed orders
+        :param memory_budget: max number of records kept in memory
+        :return: result table
         """
-        if len(tables) == 0:
-            raise RuntimeError("impossible to concat 0 tables")
-        # check metadata, field_info should be exactly the same:
-        if not all(table.metadata.get_all_fields() == tables[0].metadata.get_all_fields() for table in tables):
-            raise RuntimeError("only be able to concat tables with the same field_infos")
-        new_table, status = get_table_manager().create_tmp_table(tables[0].metadata)
-        if not status.ok():
-            raise RuntimeError("failed to create tmp table")
-        new_records = []
-        for table in tables:
-            for chunk in table.chunk_manager.get_iter():
-                for entry in chunk:
-                    new_records.append(entry)
-                    if new_records == config.max_chunk_size:
-                        status = new_table.chunk_manager.dump_bulk(new_records)
-                        if not status.ok():
-                            raise RuntimeError("failed to dump records")
-                        new_records = []
-
-        if len(new_records) != 0:
-            status = new_table.chunk_manager.dump_bulk(new_records)
-            if not status.ok():
-                raise RuntimeError("failed to dump records")
-
+        columns = [FieldNameProcessor.remove_outer_prefix(option.column) for option in sort_options]
+        sort_key = make_sort_key(columns, [option.is_asc for option in sort_options])
+        sorter = ExternalSorter(src_table.metadata, sort_key, memory_budget, sort_options[0].ways)
+        writer = RunWriter(src_table.metadata)
+        for batch in sorter.sort(src_table.chunk_manager.get_iter()):
+            writer.extend(batch)
+        new_table = writer.close()
+        new_table.sorted_by = get_sorted_by(sort_options)
         return new_table
 
     @staticmethod
@@ -390,7 +323,7 @@ class TableManipulator:
                 new_fields.append({field_rename_map[field_info.name]: field_info.value_type})
             else:
                 new_fields.append({field_info.name: field_info.value_type})
-        new_metadata = Metadata(src_table.metadata.table_name, src_table.metadata.db_type, new_fields)
+        new_metadata = Metadata(src_table.metadata.table_name, src_table.metadata.db_type, new_fields, src_table.metadata.get_chunk_format())
         new_table, status = tm.create_tmp_table(new_metadata)
         if not status.ok():
             raise ValueError("failed to create new tmp table")
@@ -401,92 +334,45 @@ class TableManipulator:
         return constant.REDUCED_COLUMN_NAME_SEP.join([name, agg.name])
 
     @staticmethod
-    def _reduce_table(src_table: Table, group_by_column: str, reduce_options: list[ReduceOption]) -> Table:
-        """
-        reduce all entries in a table into a single entry
-        must call _sort_and_split_on_column first, thus all entries in this table share the same value for the group by column
-        :param src_table:
-        :param reduce_options: support aggregation functions on multiple columns (but not the group by column!)
-        :return: a table with only one entry
-        """
-        if src_table.chunk_manager.is_empty_table():
-            raise RuntimeError("can't reduce empty table")
-
-        for option in reduce_options:
-            if option.column == group_by_column:
-                raise RuntimeError("can't call reduce function on group by column: {}".format(group_by_column))
-
-        tm = get_table_manager()
-        # group_by_column should be untouched
-        # max(col) will be renamed as MAX_col
-        new_fields = [{group_by_column: src_table.metadata.get_field_type(group_by_column)}]
-        reducers = []
-        for option in reduce_options:
-            new_field_name = option.column
-            if new_field_name in [reducer.column for reducer in reducers]:
-                raise RuntimeError("duplicated aggregated field detected: {}".format(new_field_name))
-            reducers.append(Reducer(option))
-            # TODO handle potential type transferring e.g. int -> float
-            new_fields.append({new_field_name: 'float'})
-        new_table, status = tm.create_tmp_table(Metadata(src_table.metadata.table_name, src_table.metadata.db_type, new_fields))
-        if not status.ok():
-            raise RuntimeError("can't create tmp table")
-
-        for chunk in src_table.chunk_manager.get_iter():
-            for entry in chunk:
-                for reducer in reducers:
-                    reducer.append(entry)
-
-        chunk, status = src_table.chunk_manager.get_fist_chunk()
-        if not status.ok():
-            raise RuntimeError("can't load src table")
-        new_record = {group_by_column: chunk[0][group_by_column]}
-        for i, field_info in enumerate(new_fields[1:]):
-            new_record[list(field_info.keys())[0]] = reducers[i].reduce()
-
-        status = new_table.chunk_manager.dump_one(new_record)
-        if not status.ok():
-            raise RuntimeError("can't dump new record")
-        return new_table
-
-    @staticmethod
-    def group_by(src_table: Table, group_by_option: 'GroupByOption') -> Table:
+    def group_by(src_table: Table, group_by_option: 'GroupByOption', memory_budget: int = config.memory_budget) -> Table:
         """
-        group by col can be implemented by:
-            1. gathering all fields we are interested, supported fields are: col, max_col,min_col, sum_col, count_col, avg_col
-            2. call _sort_and_split_on_column, get a bunch of tables
-            3. reduce each table to a table with a single line
-            4. merge all these reduced tables
-        This only involves O(N) I/O operations, N is entry cnt, which is acceptable
-        no need for implementing subquery, it can simply be done by sub query)
-        will rename max(col), min(col), sum(col), count(col), avg(col) to max_col, min_col, sum_col, count_col, avg_col
+        group by is implemented by hash aggregation (see HashAggregator):
+            1. keep running reducers for each distinct key while scanning the table once
+            2. spill records into hash partitions if there are too many groups to fit in memory, then aggregate each partition
+        supported fields are: col, col__MAX, col__MIN, col__SUM, col__COUNT, col__AVG
+        a reduced column without suffix will be renamed, e.g. max(col) -> col__MAX
 
         :param src_table: input table, only support single table
-        :param group_by_option: options to execute groupBy operation
+        :param group_by_option: options to execute groupBy operation, group by multiple columns is supported
+        :param memory_budget: max number of groups kept in memory
         :return: result table
         """
-        # TODO support group by on multiple columns & group by joined table
         # handle relative reference in GroupByOption
-        group_by_option.column = FieldNameProcessor.remove_outer_prefix(group_by_option.column)
-        for option in group_by_option.options:
-            option.column = FieldNameProcessor.remove_outer_prefix(option.column)
-
-        tables = TableManipulator._sort_and_split_on_column(src_table, SortOption(group_by_option.column))
-        new_tables = []
-        for table in tables:
-            new_tables.append(TableManipulator._reduce_table(table, group_by_option.column, group_by_option.options))
+        group_by_option = GroupByOption(
+            [FieldNameProcessor.remove_outer_prefix(column) for column in group_by_option.columns],
+            [ReduceOption(FieldNameProcessor.remove_outer_prefix(option.column), option.agg) for option in group_by_option.options])
 
-        return TableManipulator._concat(new_tables)
+        aggregator = HashAggregator(src_table.metadata, group_by_option, memory_budget)
+        new_table, status = get_table_manager().create_tmp_table(aggregator.get_metadata())
+        if not status.ok():
+            raise RuntimeError("can't create tmp table")
+        for records in aggregator.aggregate(src_table.chunk_manager.get_iter()):
+            status = new_table.insert_bulk(records)
+            if not status.ok():
+                raise RuntimeError("can't dump reduced records")
+        return new_table
 
     @staticmethod
-    def join(table1: Table, table2: Table, selector: Selector, join_option: 'JoinOption') -> Table:
+    def join(table1: Table, table2: Table, selector: Selector, join_option: 'JoinOption', memory_budget: int = config.memory_budget) -> Table:
         # TODO implement inner join, outer left/right join, handle null elegantly
         """
         support joining two tables only, joining more tables can be supported using subquery in src_tables
         all column will be renamed a -> "A::a"
+        equi joins (e.g. 0::a == 1::b && residual) run as sort-merge join or grace hash join, see join.py
         :param table1: table on the left
         :param table2: table on the right
         :param join_option: support outer join (which is by default), left outer join, right outer join, full outer join, inner join, no
+        :param memory_budget: max number of records of the build side kept in memory
         :return:
         """
         tm = get_table_manager()
@@ -501,37 +387,13 @@ class TableManipulator:
             for field in t.metadata.get_all_fields():
                 new_fields.append({FieldNameProcessor.add_prefix(field.get_name(), t.name): field.get_value_type()})
 
-        metadata = Metadata(table1.name, table1.metadata.db_type, new_fields)
+        metadata = Metadata(table1.name, table1.metadata.db_type, new_fields, table1.metadata.get_chunk_format())
         new_table, status = tm.create_tmp_table(metadata)
         if not status.ok():
             raise RuntimeError("failed to create tmp table")
 
-        def build_join_record(table_name, entry) -> dict:
-            res = {}
-            for k, v in entry.items():
-                res[FieldNameProcessor.add_prefix(k, table_name)] = v
-            return res
-
-        new_records = []
-        for chunk1 in table1.chunk_manager.get_iter():
-            for chunk2 in table2.chunk_manager.get_iter():
-                for entry1 in chunk1:
-                    for entry2 in chunk2:
-                        match, status = selector.is_match([entry1, entry2])
-                        if not status.ok():
-                            raise RuntimeError("failed to compare entries: {}".format([entry1, entry2]))
-                        if match:
-                            d = build_join_record(table1.name, entry1)
-                            d.update(build_join_record(table2.name, entry2))
-                            new_records.append(d)
-                            if len(new_records) == config.max_chunk_size:
-                                status = new_table.chunk_manager.dump_bulk(new_records)
-                                if not status.ok():
-                                    raise RuntimeError("failed to dump records")
-                                new_records = []
-
-        if len(new_records) != 0:
-            status = new_table.chunk_manager.dump_bulk(new_records)
+        for records in join_batches(table1.name, table1.metadata, table1.chunk_manager.get_iter(), table1.sorted_by, table2, selector, memory_budget):
+            status = new_table.chunk_manager.dump_bulk(records)
             if not status.ok():
                 raise RuntimeError("failed to dump records")
 
@@ -622,24 +484,6 @@ if __name__ == "__main__":
         sorted_chunk = sorted(chunk, key=lambda x: x['col1'])
         assert chunk == sorted_chunk, f"Chunk {chunk_idx} is not sorted correctly."
 
-    # test sort and split into different tables
-    tables = TableManipulator._sort_and_split_on_column(table, SortOption('col1', True, 2))
-    freq_list = sorted(Counter(item['col1'] for item in random_data).items())
-    assert len(freq_list) == len(tables)
-    for i, pair in enumerate(freq_list):
-        entries, status = tables[i].chunk_manager.load_chunk(0)
-        assert status.ok()
-        assert all(entry['col1'] == pair[0] for entry in entries)
-
-    # test concat tables
-    new_table_4 = TableManipulator._concat(tables)
-    sorted_random_data = sorted(random_data, key=lambda item: item['col1'])
-    i = 0
-    for chunk in new_table_4.chunk_manager.get_iter():
-        for j, entry in enumerate(chunk):
-            assert entry['col1'] == sorted_random_data[i]['col1']
-            i += 1
-
     # test rename
     table_name = "test_manipulator_rename"
     tm.drop_table(table_name)
@@ -668,7 +512,7 @@ if __name__ == "__main__":
     status = table.insert({"col1": 1, "col2": 1.0, "col3": "b"})
     assert status.ok()
     new_table = TableManipulator.group_by(table, group_by_option=GroupByOption(
-        column="0::col3",
+        columns=["0::col3"],
         reduce_options=[
             ReduceOption('0::col1', ReduceOperation.MAX),
             ReduceOption('0::col1', ReduceOperation.MIN),
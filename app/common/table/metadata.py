@@ -7,7 +7,7 @@ import constant
 import logger
 from app.common.context.context import Context
 
-from app.common.error.status import Status, FILE_NOT_EXIST, UNKNOWN, UNEXPECTED_EMPTY, UNSUPPORTED, OK, FILE_EXIST, INCONSISTENT
+from app.common.error.status import Status, FILE_NOT_EXIST, UNKNOWN, UNEXPECTED_EMPTY, UNSUPPORTED, OK, FILE_EXIST, INCONSISTENT, INVALID_ARGUMENT
 from app.common.table.field import FieldInfo
 # from app.services.database.sql.db_factory import DBFactory as SQLDBFactory
 
@@ -16,11 +16,17 @@ from app.common.table.field import FieldInfo
 # For consistency, nosql also creates metadata files under ${project_roo}/metadata/nosql
 class Metadata:
 
-    def __init__(self, table_name: str, db_type: str, field_info: list[dict[str, str]]):
+    def __init__(self, table_name: str, db_type: str, field_info: list[dict[str, str]], chunk_format: str = "", bloom_filter_columns: list[str] | None = None):
         self.fields: list[FieldInfo] = [FieldInfo(list(field.keys())[0], list(field.values())[0]) for field in field_info]
         # TODO add a self.fields_map to speed up
         self.db_type = db_type
         self.table_name = table_name
+        # how chunks are stored on the disk, chosen when the table is created
+        if chunk_format == "":
+            chunk_format = constant.CHUNK_FORMAT_CSV if db_type == constant.DB_TYPE_SQL else constant.CHUNK_FORMAT_JSON
+        self.chunk_format = chunk_format
+        # columns with per-chunk bloom filters, chosen when the table is created
+        self.bloom_filter_columns = [] if bloom_filter_columns is None else bloom_filter_columns
 
     # keep fields sequence
     def get_all_fields(self) -> list[FieldInfo]:
@@ -33,6 +39,18 @@ class Metadata:
     def get_table_name(self) -> str:
         return self.table_name
 
+    def get_chunk_format(self) -> str:
+        return self.chunk_format
+
+    def is_columnar(self) -> bool:
+        return self.chunk_format == constant.CHUNK_FORMAT_COLUMNAR
+
+    def is_ndjson(self) -> bool:
+        return self.chunk_format == constant.CHUNK_FORMAT_NDJSON
+
+    def get_bloom_filter_columns(self) -> list[str]:
+        return self.bloom_filter_columns
+
     def get_field_info(self, name: str) -> FieldInfo | None:
         for info in self.fields:
             if info.get_name() == name:
@@ -48,15 +66,20 @@ class Metadata:
         return self.get_field_info(field_name).get_value_type()
 
     def __str__(self) -> str:
-        return "table name: {}\tfields are: {}".format(self.get_table_name(), "\n".join([info.__str__() for info in self.fields]))
+        return "table name: {}\tformat: {}\tfields are: {}".format(self.get_table_name(), self.get_chunk_format(), "\n".join([info.__str__() for info in self.fields]))
 
     def __repr__(self) -> str:
         return self.__str__()
 
     def to_json_obj(self):
         if self.db_type == constant.DB_TYPE_NOSQL:
-            return {constant.METADATA_TABLE_NAME_KEY: self.table_name}
-        return {constant.METADATA_TABLE_NAME_KEY: self.table_name, constant.METADATA_FIELDS_KEY: [{info.get_name(): info.get_value_type()} for info in self.fields]}
+            obj = {constant.METADATA_TABLE_NAME_KEY: self.table_name, constant.METADATA_CHUNK_FORMAT_KEY: self.chunk_format}
+        else:
+            obj = {constant.METADATA_TABLE_NAME_KEY: self.table_name, constant.METADATA_FIELDS_KEY: [{info.get_name(): info.get_value_type()} for info in self.fields],
+                   constant.METADATA_CHUNK_FORMAT_KEY: self.chunk_format}
+        if len(self.bloom_filter_columns):
+            obj[constant.METADATA_BLOOM_FILTER_KEY] = self.bloom_filter_columns
+        return obj
 
 
 def load_from_json(file_path: str, ctx: Context) -> (Metadata | None, Status):
@@ -73,8 +96,17 @@ def load_from_json(file_path: str, ctx: Context) -> (Metadata | None, Status):
             return None, UNKNOWN
         # if table_name != metadata[constant.METADATA_TABLE_NAME_KEY]:
         #     return None, INCONSISTENT
+        # tables created before chunk formats were introduced use the default format
+        chunk_format = metadata.get(constant.METADATA_CHUNK_FORMAT_KEY, ctx.get_cfg().get_default_chunk_format())
+        if chunk_format not in ctx.get_cfg().get_supported_chunk_formats():
+            ctx.get_logger().error("unsupported chunk format: {}".format(chunk_format))
+            return None, UNSUPPORTED
+        bloom_filter_columns = metadata.get(constant.METADATA_BLOOM_FILTER_KEY, [])
+        if type(bloom_filter_columns) is not list or not all(type(column) is str and column != "" for column in bloom_filter_columns):
+            ctx.get_logger().error("invalid columns of bloom filters: {}".format(bloom_filter_columns))
+            return None, INVALID_ARGUMENT
         if db_type == constant.DB_TYPE_NOSQL:
-            return Metadata(metadata[constant.METADATA_TABLE_NAME_KEY], db_type, []), OK
+            return Metadata(metadata[constant.METADATA_TABLE_NAME_KEY], db_type, [], chunk_format, bloom_filter_columns), OK
 
         # only read field info for SQL
         # SQL table with 0 column is not allowed
@@ -88,8 +120,13 @@ def load_from_json(file_path: str, ctx: Context) -> (Metadata | None, Status):
             if field_type not in supported_types:
                 ctx.get_logger().error("unsupported type: {} for field {}".format(field_type, field_name))
                 return None, UNSUPPORTED
+        field_names = [list(field_info.keys())[0] for field_info in metadata[constant.METADATA_FIELDS_KEY]]
+        for column in bloom_filter_columns:
+            if column not in field_names:
+                ctx.get_logger().error("unable to create bloom filter on not existed column {}".format(column))
+                return None, INVALID_ARGUMENT
 
-        return Metadata(metadata[constant.METADATA_TABLE_NAME_KEY], db_type, metadata[constant.METADATA_FIELDS_KEY]), OK
+        return Metadata(metadata[constant.METADATA_TABLE_NAME_KEY], db_type, metadata[constant.METADATA_FIELDS_KEY], chunk_format, bloom_filter_columns), OK
 
 
 def save_as_json(metadata: Metadata, ctx: Context) -> Status:
@@ -0,0 +1,103 @@
+import json
+import os
+from typing import Iterator
+
+# newline-delimited json chunk layout of nosql tables
+#   records: one json object per line
+#   footer:  "#" + json list of byte offsets of all records + "\n"
+#   trailer: "#" + byte offset of the footer in 16 digits + "\n", its size is fixed so it's found by seeking from the end
+# record lines always start with "{", readers iterating lines stop at the footer
+# records are appended by overwriting the footer with new lines followed by a new footer, in a single write
+
+FOOTER_MARK = b"#"
+_TRAILER_FORMAT = "#{:016d}\n"
+_TRAILER_SIZE = 18
+
+
+def _encode_record(record: dict) -> bytes:
+    # json escapes line breaks in strings, so a record is always a single line
+    return json.dumps(record).encode("utf-8") + b"\n"
+
+
+def _encode_tail(start: int, offsets: list[int], records: list[dict]) -> bytes:
+    """
+    :param start: byte offset of the first new record
+    :param offsets: offsets of records before start, new offsets are appended
+    :return: lines of new records followed by the footer and the trailer
+    """
+    lines = []
+    pos = start
+    for record in records:
+        line = _encode_record(record)
+        offsets.append(pos)
+        lines.append(line)
+        pos += len(line)
+    footer = FOOTER_MARK + json.dumps(offsets, separators=(",", ":")).encode("utf-8") + b"\n"
+    return b"".join(lines) + footer + _TRAILER_FORMAT.format(pos).encode("utf-8")
+
+
+def encode_chunk(records: list[dict]) -> bytes:
+    return _encode_tail(0, [], records)
+
+
+def _read_footer(f) -> (int, list[int]):
+    """
+    :return: (offset of the footer, offsets of records)
+    """
+    f.seek(-_TRAILER_SIZE, os.SEEK_END)
+    trailer = f.read(_TRAILER_SIZE)
+    if not trailer.startswith(FOOTER_MARK):
+        raise ValueError("invalid trailer of ndjson chunk {}".format(f.name))
+    footer_pos = int(trailer[1:])
+    f.seek(footer_pos)
+    return footer_pos, json.loads(f.readline()[1:])
+
+
+def append_records(path: str, records: list[dict]):
+    with open(path, "r+b") as f:
+        footer_pos, offsets = _read_footer(f)
+        f.seek(footer_pos)
+        f.write(_encode_tail(footer_pos, offsets, records))
+        f.truncate()
+
+
+def read_first_records(path: str, cnt: int) -> list[dict]:
+    """
+    at most cnt records from the beginning of a chunk which may be partially written, e.g. interrupted by a crash while appending
+    """
+    records = []
+    with open(path, "rb") as f:
+        for line in f:
+            if len(records) >= cnt or line.startswith(FOOTER_MARK):
+                break
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                break
+    return records
+
+
+def iter_records(path: str) -> Iterator[dict]:
+    # only one record is decoded at a time
+    with open(path, "rb") as f:
+        for line in f:
+            if line.startswith(FOOTER_MARK):
+                return
+            yield json.loads(line)
+
+
+def read_chunk(path: str) -> list[dict]:
+    return list(iter_records(path))
+
+
+def read_row(path: str, row: int) -> dict | None:
+    """
+    random access to the row-th record by seeking to its offset in the footer
+    :return: None if there is no such row
+    """
+    with open(path, "rb") as f:
+        _, offsets = _read_footer(f)
+        if row < 0 or row >= len(offsets):
+            return None
+        f.seek(offsets[row])
+        return json.loads(f.readline())
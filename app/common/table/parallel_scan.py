@@ -0,0 +1,67 @@
+import multiprocessing
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import config
+
+from app.common.table.chunk_manager import ChunkFile, ChunkReader
+from app.common.table.selector import Selector
+from app.common.table.table import Table
+
+# each worker gets a few tasks, so that a worker finishing early can take over the remaining chunks
+_TASKS_PER_WORKER = 4
+
+scan_pool_singleton = None
+scan_pool_lock = threading.Lock()
+
+
+def get_scan_pool(workers: int) -> ProcessPoolExecutor:
+    # the pool is shared by all queries, workers are spawned instead of forked as the server runs multiple threads
+    global scan_pool_singleton
+    with scan_pool_lock:
+        if scan_pool_singleton is None:
+            scan_pool_singleton = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        return scan_pool_singleton
+
+
+def _scan_chunks(reader: ChunkReader, chunks: list[ChunkFile], expression: any, columns: list[str] | None) -> list[list[dict[str, object]]]:
+    """
+    run in a worker process: filter and project the chunk files, only selected records are sent back
+    workers only read the files described by the server, nothing of the table is loaded or written by them
+    """
+    selector = None if expression is None else Selector(expression, [reader.metadata])
+    return [reader.scan(chunk, selector, columns) for chunk in chunks]
+
+
+def parallel_scan(table: Table, selector: Selector | None, columns: list[str] | None, workers: int, chunk_filter=None) -> Iterator[list[dict[str, object]]]:
+    """
+    same as ChunkManager.scan, while ranges of chunks are filtered and projected by a pool of processes
+    results are produced in the order of chunks, and at most 2 tasks per worker are in flight to bound the memory usage
+    small tables and selectors which can't be sent to workers are scanned in the calling process
+    :param chunk_filter: chunks it returns False for are skipped, e.g. chunks without any key of a hash join
+    """
+    chunk_manager = table.chunk_manager
+    expression = None if selector is None else selector.expression
+    chunk_ids = chunk_manager.get_chunks_to_scan(expression)
+    if chunk_filter is not None:
+        chunk_ids = [i for i in chunk_ids if chunk_filter(i)]
+    # subclasses (e.g. AlwaysTrueSelector) don't valuate their expressions
+    if workers <= 1 or len(chunk_ids) < config.parallel_scan_min_chunks or (selector is not None and type(selector) is not Selector):
+        yield from chunk_manager.scan(selector, columns, chunk_ids)
+        return
+
+    task_size = max(1, len(chunk_ids) // (workers * _TASKS_PER_WORKER))
+    chunks = [chunk_manager.get_chunk_file(i) for i in chunk_ids]
+    tasks = deque(chunks[i:i + task_size] for i in range(0, len(chunks), task_size))
+    pool = get_scan_pool(workers)
+    futures = deque()
+    try:
+        while len(tasks) or len(futures):
+            while len(tasks) and len(futures) < workers * 2:
+                futures.append(pool.submit(_scan_chunks, chunk_manager.reader, tasks.popleft(), expression, columns))
+            yield from futures.popleft().result()
+    finally:
+        for future in futures:
+            future.cancel()
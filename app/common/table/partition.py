@@ -0,0 +1,64 @@
+import config
+
+from app.common.table.metadata import Metadata
+from app.common.table.table import Table
+from app.common.table.table_manager import get_table_manager
+
+
+class HashPartitions:
+    """
+    records spilled onto the disk by the hash of their keys, each partition is a tmp table
+    used by hash aggregation and grace hash join, records with the same key always fall into the same partition
+    """
+
+    def __init__(self, metadata: Metadata, depth: int = 0, partition_cnt: int = config.hash_partition_cnt):
+        """
+        :param metadata: metadata of records
+        :param depth: recursion depth, partitions of different depths use different hash functions
+        """
+        self.metadata = metadata
+        self.depth = depth
+        self.partition_cnt = partition_cnt
+        self.tables: list[Table | None] = [None] * partition_cnt
+        self.buffers: list[list[dict[str, object]]] = [[] for _ in range(partition_cnt)]
+
+    def get_partition_idx(self, key: tuple) -> int:
+        return hash((self.depth, key)) % self.partition_cnt
+
+    def add(self, key: tuple, record: dict[str, object]):
+        idx = self.get_partition_idx(key)
+        self.buffers[idx].append(record)
+        if len(self.buffers[idx]) >= config.max_chunk_size:
+            self._spill(idx)
+
+    def flush(self):
+        for idx in range(self.partition_cnt):
+            if len(self.buffers[idx]):
+                self._spill(idx)
+
+    def get_partition(self, idx: int) -> Table | None:
+        """
+        :return: the tmp table of the partition, None if no record falls into it. must call flush first
+        """
+        return self.tables[idx]
+
+    def drop(self, idx: int):
+        if self.tables[idx] is not None:
+            get_table_manager().drop_table(self.tables[idx].name)
+            self.tables[idx] = None
+
+    # drop partitions not dropped yet, e.g. when the consumer stops early or fails
+    def drop_all(self):
+        for idx in range(self.partition_cnt):
+            self.drop(idx)
+
+    def _spill(self, idx: int):
+        if self.tables[idx] is None:
+            table, status = get_table_manager().create_tmp_table(self.metadata)
+            if not status.ok():
+                raise RuntimeError("can't create tmp table")
+            self.tables[idx] = table
+        status = self.tables[idx].insert_bulk(self.buffers[idx])
+        if not status.ok():
+            raise RuntimeError("failed to spill records into hash partition")
+        self.buffers[idx] = []
@@ -0,0 +1,389 @@
+import heapq
+from contextlib import contextmanager, ExitStack
+from typing import Iterator
+
+import config
+import constant
+
+from app.common.table.bloom_filter import hash_value
+from app.common.table.external_sort import ExternalSorter, make_sort_key
+from app.common.table.field import FieldNameProcessor
+from app.common.table.join import join_batches
+from app.common.table.manipulator import SortOption, GroupByOption, HashAggregator, get_sorted_by
+from app.common.table.metadata import Metadata
+from app.common.table.parallel_scan import parallel_scan
+from app.common.table.selector import Selector
+from app.common.table.table import Table
+from app.common.table.table_manager import get_table_manager
+
+
+class PhysicalOperator:
+    """
+    node of a pull-based (volcano style) operator tree
+    records flow between operators in batches (list of records) in memory, no intermediate table is created
+    unless the operator has to spill onto the disk (e.g. sorting more records than the memory budget)
+    """
+
+    def get_metadata(self) -> Metadata:
+        """
+        :return: metadata of output records, the table name is meaningless
+        """
+        raise NotImplementedError
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        """
+        :return: a generator of batches, stop pulling from it whenever enough records are consumed
+        """
+        raise NotImplementedError
+
+    def get_sorted_by(self) -> list[str] | None:
+        """
+        :return: columns the output records are sorted on in ascending order, None if unknown
+        """
+        return None
+
+    def set_key_filter(self, column: str, values: set):
+        """
+        offered by a hash join before pulling this side to probe, records whose column isn't any of the values never match
+        operators able to skip such records cheaply (e.g. by bloom filters of chunks) may do so, others ignore it
+        """
+        pass
+
+    def get_tables(self) -> list[Table]:
+        """
+        :return: tables read by the operator tree, see read_locked. operators with a single child read the tables of the child
+        """
+        return self.child.get_tables()
+
+
+class ScanOp(PhysicalOperator):
+
+    def __init__(self, table: Table, selector: Selector | None = None, columns: list[str] | None = None):
+        """
+        scan a table with filter and projection pushed down, chunks of large tables are scanned by a pool of processes
+        :param table: table to scan
+        :param selector: filter, keep all records if None
+        :param columns: desired columns (without prefix), keep all columns if None
+        """
+        self.table = table
+        self.selector = selector
+        self.columns = columns
+        self.chunk_filter = None
+
+    def get_metadata(self) -> Metadata:
+        return project_metadata(self.table.metadata, self.columns)
+
+    # skip chunks whose bloom filter on the column rules out all the values
+    def set_key_filter(self, column: str, values: set):
+        chunk_manager = self.table.chunk_manager
+        # testing many values against the filter of each chunk costs as much as scanning the chunk
+        if not chunk_manager.bloom_filters.has_filter(column) or len(values) > config.bloom_filter_max_join_keys:
+            return
+        hashes = [hash_value(value) for value in values]
+        if None in hashes:
+            return
+        self.chunk_filter = lambda chunk_idx: chunk_manager.may_contain_any(chunk_idx, column, hashes)
+
+    def get_sorted_by(self) -> list[str] | None:
+        return self.table.sorted_by
+
+    def get_tables(self) -> list[Table]:
+        return [self.table]
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        # the key filter only applies to the scan started after it's set
+        chunk_filter, self.chunk_filter = self.chunk_filter, None
+        for records in parallel_scan(self.table, self.selector, self.columns, self.table.cfg.get_scan_workers(), chunk_filter):
+            if len(records):
+                yield records
+
+
+class FilterOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, selector: Selector):
+        self.child = child
+        self.selector = selector
+
+    def get_metadata(self) -> Metadata:
+        return self.child.get_metadata()
+
+    def get_sorted_by(self) -> list[str] | None:
+        return self.child.get_sorted_by()
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        for batch in self.child.batches():
+            mask, status = self.selector.get_mask(batch)
+            if not status.ok():
+                raise RuntimeError("selector failed to valuate expression")
+            records = [entry for entry, match in zip(batch, mask) if match]
+            if len(records):
+                yield records
+
+
+class ProjectOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, columns: list[str]):
+        """
+        :param columns: desired columns (without prefix)
+        """
+        if len(columns) != len(set(columns)):
+            raise RuntimeError("unable to project duplicated columns {}".format(columns))
+        self.child = child
+        self.columns = columns
+
+    def get_metadata(self) -> Metadata:
+        return project_metadata(self.child.get_metadata(), self.columns)
+
+    def get_sorted_by(self) -> list[str] | None:
+        sorted_by = self.child.get_sorted_by()
+        if sorted_by is None or sorted_by[0] not in self.columns:
+            return None
+        return sorted_by
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        for batch in self.child.batches():
+            yield [{column: entry[column] for column in self.columns if column in entry} for entry in batch]
+
+
+class RenameOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, prefix: str):
+        """
+        add the prefix to all field names, e.g. a -> "prefix::a"
+        """
+        self.child = child
+        self.prefix = prefix
+
+    def get_metadata(self) -> Metadata:
+        metadata = self.child.get_metadata()
+        fields = [{FieldNameProcessor.add_prefix(info.get_name(), self.prefix): info.get_value_type()} for info in metadata.get_all_fields()]
+        return Metadata(metadata.table_name, metadata.db_type, fields, metadata.get_chunk_format())
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        for batch in self.child.batches():
+            yield [{FieldNameProcessor.add_prefix(k, self.prefix): v for k, v in entry.items()} for entry in batch]
+
+
+class SortOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, sort_options: list[SortOption], memory_budget: int = config.memory_budget):
+        """
+        sort in memory if all records fit in the memory budget, otherwise use external merge sort
+        :param sort_options: columns are without prefix
+        """
+        self.child = child
+        self.sort_options = sort_options
+        self.memory_budget = memory_budget
+
+    def get_metadata(self) -> Metadata:
+        return self.child.get_metadata()
+
+    def get_sorted_by(self) -> list[str] | None:
+        return get_sorted_by(self.sort_options)
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        sort_key = make_sort_key([option.column for option in self.sort_options], [option.is_asc for option in self.sort_options])
+        sorter = ExternalSorter(self.get_metadata(), sort_key, self.memory_budget, self.sort_options[0].ways)
+        yield from sorter.sort(self.child.batches())
+
+
+class TopKOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, sort_options: list[SortOption], k: int):
+        """
+        the first k records in the order of sort options, selected with a bounded heap in a single pass
+        only k records are kept in memory, so k should fit in the memory budget
+        :param sort_options: columns are without prefix
+        """
+        self.child = child
+        self.sort_options = sort_options
+        self.k = k
+
+    def get_metadata(self) -> Metadata:
+        return self.child.get_metadata()
+
+    def get_sorted_by(self) -> list[str] | None:
+        return get_sorted_by(self.sort_options)
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        if self.k <= 0:
+            return
+        sort_key = make_sort_key([option.column for option in self.sort_options], [option.is_asc for option in self.sort_options])
+        records = (record for batch in self.child.batches() for record in batch)
+        # records with the same key keep their order in the input, the same as SortOp
+        yield from split_into_batches(heapq.nsmallest(self.k, records, key=sort_key))
+
+
+class AggregateOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, group_by_option: GroupByOption, memory_budget: int = config.memory_budget):
+        """
+        hash aggregation, spill into hash partitions if there are more groups than the memory budget
+        :param group_by_option: columns are without prefix
+        """
+        self.child = child
+        self.group_by_option = group_by_option
+        self.memory_budget = memory_budget
+
+    def _get_aggregator(self) -> HashAggregator:
+        return HashAggregator(self.child.get_metadata(), self.group_by_option, self.memory_budget)
+
+    def get_metadata(self) -> Metadata:
+        return self._get_aggregator().get_metadata()
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        yield from self._get_aggregator().aggregate(self.child.batches())
+
+
+class JoinOp(PhysicalOperator):
+
+    def __init__(self, left: PhysicalOperator, left_name: str, right: Table, selector: Selector, memory_budget: int = config.memory_budget):
+        """
+        records of the left side are streamed, equi joins run as sort-merge join or grace hash join (see join.py)
+        all columns are renamed with prefix of table names, e.g. a -> "A::a"
+        :param left: the left side, usually a scan of the left table
+        :param left_name: name of the left table
+        :param right: the right table
+        :param selector: join condition, "0::" refers to the left record and "1::" refers to the right one
+        """
+        self.left = left
+        self.left_name = left_name
+        self.right = right
+        self.selector = selector
+        self.memory_budget = memory_budget
+
+    def get_metadata(self) -> Metadata:
+        left_metadata = self.left.get_metadata()
+        new_fields = []
+        for name, metadata in [(self.left_name, left_metadata), (self.right.name, self.right.metadata)]:
+            for field in metadata.get_all_fields():
+                new_fields.append({FieldNameProcessor.add_prefix(field.get_name(), name): field.get_value_type()})
+        return Metadata(self.left_name, left_metadata.db_type, new_fields, left_metadata.get_chunk_format())
+
+    def get_tables(self) -> list[Table]:
+        return self.left.get_tables() + [self.right]
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        return join_batches(self.left_name, self.left.get_metadata(), self.left.batches(), self.left.get_sorted_by(),
+                            self.right, self.selector, self.memory_budget, self.left.set_key_filter)
+
+
+class LimitOp(PhysicalOperator):
+
+    def __init__(self, child: PhysicalOperator, limit: int | None, offset: int = 0):
+        """
+        skip the first offset records then keep at most limit records, no limit if None
+        """
+        self.child = child
+        self.limit = limit
+        self.offset = offset
+
+    def get_metadata(self) -> Metadata:
+        return self.child.get_metadata()
+
+    def get_sorted_by(self) -> list[str] | None:
+        return self.child.get_sorted_by()
+
+    def batches(self) -> Iterator[list[dict[str, object]]]:
+        to_skip, remaining = self.offset, self.limit
+        if remaining is not None and remaining <= 0:
+            return
+        # stop pulling from the child as soon as enough records are produced
+        for batch in self.child.batches():
+            if to_skip >= len(batch):
+                to_skip -= len(batch)
+                continue
+            batch = batch[to_skip:] if remaining is None else batch[to_skip:to_skip + remaining]
+            to_skip = 0
+            yield batch
+            if remaining is not None:
+                remaining -= len(batch)
+                if remaining == 0:
+                    return
+
+
+def project_metadata(metadata: Metadata, columns: list[str] | None) -> Metadata:
+    if columns is None:
+        return metadata
+    fields = []
+    if metadata.db_type == constant.DB_TYPE_SQL:
+        fields = [{column: metadata.get_field_type(column)} for column in columns]
+    return Metadata(metadata.table_name, metadata.db_type, fields, metadata.get_chunk_format())
+
+
+def split_into_batches(records: list[dict[str, object]], batch_size: int = config.max_chunk_size) -> Iterator[list[dict[str, object]]]:
+    for i in range(0, len(records), batch_size):
+        yield records[i:i + batch_size]
+
+
+def spill(metadata: Metadata, *sources) -> Table:
+    """
+    write batches into a tmp table
+    :param metadata: metadata of records
+    :param sources: iterables of batches
+    :return: tmp table
+    """
+    table, status = get_table_manager().create_tmp_table(metadata)
+    if not status.ok():
+        raise RuntimeError("failed to create new tmp table")
+    buffer = []
+    for source in sources:
+        for batch in source:
+            buffer += batch
+            if len(buffer) >= config.max_chunk_size:
+                status = table.insert_bulk(buffer)
+                if not status.ok():
+                    raise RuntimeError("failed to spill records")
+                buffer = []
+    if len(buffer):
+        status = table.insert_bulk(buffer)
+        if not status.ok():
+            raise RuntimeError("failed to spill records")
+    return table
+
+
+@contextmanager
+def read_locked(op: PhysicalOperator):
+    """
+    hold the read locks of all tables read by the operator tree, writers of the tables wait until they are released
+    operators never lock tables themselves, locks are acquired at once in order of table names,
+    so queries reading the same tables never wait for each other in a cycle
+    """
+    tables = {table.name: table for table in op.get_tables()}
+    with ExitStack() as stack:
+        for name in sorted(tables):
+            stack.enter_context(tables[name].lock.read())
+        yield
+
+
+def locked_batches(op: PhysicalOperator) -> Iterator[list[dict[str, object]]]:
+    """
+    batches of the operator tree, each one is pulled with the read locks held (see read_locked)
+    locks are released while a batch is consumed, so a slow consumer (e.g. a client reading the response) never blocks writers,
+    operators go on with the chunks they have listed as the tables are pinned, and the query fails if any of them is dropped
+    """
+    tables = op.get_tables()
+    batches = op.batches()
+    generations = None
+    with ExitStack() as stack:
+        for table in tables:
+            stack.enter_context(table.pin())
+        # the operator tree is closed before the tables are unpinned, e.g. spilled files are dropped
+        stack.callback(batches.close)
+        while True:
+            with read_locked(op):
+                current = [table.chunk_manager.generation for table in tables]
+                if generations is not None and current != generations:
+                    raise RuntimeError("tables of the query are dropped or compacted while they are scanned")
+                generations = current
+                batch = next(batches, None)
+            if batch is None:
+                return
+            yield batch
+
+
+def materialize(op: PhysicalOperator) -> Table:
+    """
+    run the operator tree and write all results into a tmp table
+    """
+    return spill(op.get_metadata(), op.batches())
@@ -1,40 +1,95 @@
 from app.common.error.status import Status, INTERNAL, INVALID_ARGUMENT, TYPE_ERROR, OK
+from app.common.query.compiler import compile_expression
 from app.common.query.expression_tree import ExprTree
+from app.common.query.vector import selection_indexes
+from app.common.table.metadata import Metadata
 
 
 class Selector:
 
-    def __init__(self, expression: any):
+    def __init__(self, expression: any, schemas: list[Metadata] | None = None):
         """
         return True only when the expression is True
         use relative prefix
         :param expression: expression object in json format
+        :param schemas: metadata of each entry if known, used to specialize the compiled expression
         """
         self.expression = expression
         self.expr_tree = ExprTree(expression)
+        self.compiled = None
+        if self.expr_tree.is_valid():
+            field_types = None
+            if schemas is not None:
+                field_types = [{info.get_name(): info.get_value_type() for info in metadata.get_all_fields()} for metadata in schemas]
+            self.compiled = compile_expression(expression, field_types)
+
+    # fields of the idx-th entry which must be offered to evaluate the expression
+    def get_referenced_columns(self, idx: int = 0) -> set[str]:
+        return self.expr_tree.get_referenced_columns(idx)
 
     # all entries used in the expression should be offered.
     def is_match(self, entries: list) -> (bool, Status):
         if not self.expr_tree.is_valid():
             return False, INVALID_ARGUMENT
 
-        res, status = self.expr_tree.valuate(entries)
+        if self.compiled is not None:
+            res, status = self.compiled.valuate(entries)
+        else:
+            res, status = self.expr_tree.valuate(entries)
         if type(res) is not bool:
             return False, TYPE_ERROR
         return res, status
 
+    # whether each record matches, the expression should only reference the first entry
+    def get_mask(self, records: list[dict]) -> (list[bool], Status):
+        if self.compiled is not None and self.compiled.has_mask():
+            return self.compiled.get_mask(records)
+
+        mask = []
+        for record in records:
+            match, status = self.is_match([record])
+            if not status.ok():
+                return [], status
+            mask.append(match)
+        return mask, OK
+
+    # indexes of matched rows in a batch of column vectors, the expression should only reference the first entry
+    def get_selection(self, columns: dict[str, object], row_cnt: int) -> (list[int], Status):
+        if not self.expr_tree.is_valid():
+            return [], INVALID_ARGUMENT
+
+        res, status = self.expr_tree.valuate_batch([columns], row_cnt)
+        if not status.ok():
+            return [], status
+        selection = selection_indexes(res, row_cnt)
+        if selection is None:
+            return [], TYPE_ERROR
+        return selection, OK
+
 
 class AlwaysTrueSelector(Selector):
 
     def is_match(self, entries: list) -> (bool, Status):
         return True, OK
 
+    def get_selection(self, columns: dict[str, object], row_cnt: int) -> (list[int], Status):
+        return list(range(row_cnt)), OK
+
+    def get_mask(self, records: list[dict]) -> (list[bool], Status):
+        return [True] * len(records), OK
+
 
 class AlwaysFalseSelector(Selector):
 
     def is_match(self, entries: list) -> (bool, Status):
         return False, OK
 
+    def get_mask(self, records: list[dict]) -> (list[bool], Status):
+        return [False] * len(records), OK
+
+    def get_selection(self, columns: dict[str, object], row_cnt: int) -> (list[int], Status):
+        return [], OK
+
 
 def get_always_true_selector():
     return Selector()
@@ -1,8 +1,16 @@
 import os
+import threading
+from contextlib import contextmanager
+
+import constant
 
 from app.common.context.context import Context
-from app.common.error.status import Status, OK, INTERNAL
+from app.common.error.status import Status, OK, INTERNAL, INCONSISTENT, UNSUPPORTED, INVALID_ARGUMENT
 from app.common.table.chunk_manager import ChunkManager
+from app.common.table.csv_adapter import get_converter
+from app.common.table.lock import ReadWriteLock, write_locked
+from app.common.table.selector import Selector
+from app.common.table.wal import WAL_OP_INSERT, WAL_OP_UPDATE, WAL_OP_DELETE, WAL_OP_BULK_LOAD, WAL_OP_COMPACT
 
 from app.common.table.metadata import Metadata
 
@@ -12,6 +20,30 @@ class TableIterator:
     pass
 
 
+class PendingWrite:
+    """
+    a logged write of a table, which may be applied by another thread (see Table._write_logged)
+    """
+
+    def __init__(self, entry: dict, apply):
+        self.entry = entry
+        self.apply = apply
+        self.status: Status | None = None
+        self.error: Exception | None = None
+
+    def run(self):
+        try:
+            self.status = self.apply()
+        except Exception as e:
+            self.error = e
+
+    # raise the error in the thread issuing the write
+    def get_status(self) -> Status:
+        if self.error is not None:
+            raise self.error
+        return self.status
+
+
 # The abstraction of actual tables storing on the disk
 # It should support two different data formats: json or csv
 # Supported operations: projection, filtering, sorting, deduplication, grouping by,joining two tables
@@ -22,12 +54,27 @@ class Table:
         self.name = table_name
         self.metadata = metadata
         self.chunk_cnt = 0
+        # columns the records are known to be sorted on in ascending order (e.g. result of sorting), only kept in memory
+        self.sorted_by: list[str] | None = None
         self.logger = ctx.get_logger()
         self.cfg = ctx.get_cfg()
         self.chunk_manager: ChunkManager = ChunkManager(os.path.join(self.cfg.get_tables_dir(), table_name), metadata, ctx)
         self.chunk_manager.start()
+        # writes hold the write lock, queries hold the read lock (see pipeline.read_locked)
+        self.lock = ReadWriteLock()
+        # number of queries scanning the table, which release the read lock between batches (see pin)
+        self.pin_cnt = 0
+        self.pin_lock = threading.Lock()
+        # tmp tables are dropped on restart, their writes are never logged
+        self.is_logged = not table_name.startswith(constant.TMP_TABLE_PREFIX)
+        # writes waiting for the write lock, which are logged and applied together by the first one getting the lock
+        self.pending_writes: list[PendingWrite] = []
+        self.pending_lock = threading.Lock()
+        # field name -> converter into the type of the field, None for nosql and tmp tables
+        self.converters = {name: get_converter(metadata.get_field_type(name)) for name in metadata.get_all_field_names()} if self.cfg.is_sql() and self.is_logged else None
 
     # drop this table, delete from disk
+    @write_locked
     def drop(self) -> Status:
         self.logger.warn("dropping a table {}".format(self.name))
         status = self.chunk_manager.destroy_all_chunks()
@@ -37,10 +84,53 @@ class Table:
         self.logger.warn("table {} is dropped".format(self.name))
         return OK
 
+    def _write_logged(self, entry: dict, apply) -> Status:
+        """
+        log the operation in the write-ahead log then apply it, with group commit:
+        writes queued while the write lock is held by others are logged with a single fsync by the next writer getting the lock,
+        which applies them in order of their entries
+        """
+        write = PendingWrite(entry, apply)
+        with self.pending_lock:
+            self.pending_writes.append(write)
+        with self.lock.write():
+            with self.pending_lock:
+                writes, self.pending_writes = self.pending_writes, []
+            # the write is already applied by another writer if it's not pending
+            if len(writes):
+                lsns = self.chunk_manager.log([w.entry for w in writes]) if self.is_logged else [None] * len(writes)
+                for w, lsn in zip(writes, lsns):
+                    if lsn is not None:
+                        self.chunk_manager.set_applied_lsn(lsn)
+                    w.run()
+                self.chunk_manager.checkpoint()
+        return write.get_status()
+
+    def _convert_records(self, records: list[dict]) -> (list[dict], Status):
+        """
+        convert values of sql records into types of their fields, before they are logged,
+        so a value which can't be stored is rejected instead of failing whenever the entry is applied (and replayed)
+        """
+        if self.converters is None:
+            return records, OK
+        try:
+            return [{name: self.converters[name](value) if name in self.converters else value for name, value in record.items()} for record in records], OK
+        except (ValueError, TypeError) as e:
+            self.logger.error("invalid values of records for table {}, due to {}".format(self.name, e))
+            return records, INVALID_ARGUMENT
+
     # table should know how many chunks are on the disks, where to find each chunk, and how to update/delete/insert data into these trunks
     # record should be a json object
     def insert(self, record: dict) -> Status:
+        records, status = self._convert_records([record])
+        if not status.ok():
+            return status
+        record = records[0]
+        return self._write_logged({"op": WAL_OP_INSERT, "records": [record]}, lambda: self._insert(record))
+
+    def _insert(self, record: dict) -> Status:
         # self.logger.info("inserting a record {} to table {}".format(record, self.name))
+        self.sorted_by = None
         status = self.chunk_manager.dump_one(record)
         if not status.ok():
             self.logger.warn("failed to insert record {} to table {}".format(record, self.name))
@@ -49,7 +139,14 @@ class Table:
         return OK
 
     def insert_bulk(self, records: list[dict]) -> Status:
+        records, status = self._convert_records(records)
+        if not status.ok():
+            return status
+        return self._write_logged({"op": WAL_OP_INSERT, "records": records}, lambda: self._insert_bulk(records))
+
+    def _insert_bulk(self, records: list[dict]) -> Status:
         # self.logger.info("inserting a record {} to table {}".format(record, self.name))
+        self.sorted_by = None
         status = self.chunk_manager.dump_bulk(records)
         if not status.ok():
             self.logger.warn("failed to insert record #{} to table {}".format(len(records), self.name))
@@ -57,62 +154,166 @@ class Table:
         # self.logger.info("record {} is inserted to table {}".format(record, self.name))
         return OK
 
-    # TODO add lock for all these operations on table
+    # append batches of records with the statistics and indexes built in the same pass, see ChunkManager.bulk_load
+    # records are not logged, loaded chunks are flushed onto the disk at the end
+    @write_locked
+    def bulk_load(self, batches) -> Status:
+        self.sorted_by = None
+        if self.is_logged:
+            self.chunk_manager.set_applied_lsn(self.chunk_manager.log([{"op": WAL_OP_BULK_LOAD}])[0])
+        status = self.chunk_manager.bulk_load(batches)
+        if not status.ok():
+            self.logger.warn("failed to bulk load records into table {}".format(self.name))
+        self.chunk_manager.checkpoint(force=True)
+        return status
+
+    # build a B+-tree index on the column, which is used to skip chunks when filtering on the column
+    @write_locked
+    def create_index(self, column: str) -> Status:
+        status = self.chunk_manager.create_index(column)
+        if not status.ok():
+            self.logger.warn("failed to create index on column {} of table {}".format(column, self.name))
+        return status
+
     def update(self, selector, new_record: dict) -> Status:
-        chunk_cnt = self.chunk_manager.get_chunk_cnt()
-        is_changed = False
-        for i in range(chunk_cnt):
+        records, status = self._convert_records([new_record])
+        if not status.ok():
+            return status
+        new_record = records[0]
+        entry = {"op": WAL_OP_UPDATE, "expression": selector.expression, "values": new_record}
+        return self._write_logged(entry, lambda: self._update(selector, new_record))
+
+    def _update(self, selector, new_record: dict) -> Status:
+        self.sorted_by = None
+        changed_chunks = {}
+        for i in self.chunk_manager.get_chunks_to_scan(selector.expression):
             chunk, status = self.chunk_manager.load_chunk(i)
             is_chunk_changed = False
             if not status.ok():
                 self.logger.error("failed to update")
                 return INTERNAL
+            mask, status = selector.get_mask(chunk)
+            if not status.ok():
+                self.logger.error("failed to use selector, may due to unable to parse expression {}".format(selector.expression))
+                return INTERNAL
+            deleted = self.chunk_manager.get_deleted_rows(i)
             for j in range(len(chunk)):
-                is_match, status = selector.is_match([chunk[j]])
-                if not status.ok():
-                    self.logger.error("failed to use selector, may due to unable to parse expression {}".format(selector.expression))
-                    return INTERNAL
-                if is_match:
+                if mask[j] and (deleted is None or j not in deleted):
                     self.logger.info("update record {} with {} in chunk {}".format(chunk[j], new_record, i))
                     chunk[j].update(new_record)
                     is_chunk_changed = True
-                    is_changed = True
             if is_chunk_changed:
-                self.chunk_manager.update_chunk(i, chunk)
-                self.logger.info("successfully update chunk {} for table {}".format(i, self.name))
-        if not is_changed:
+                changed_chunks[i] = chunk
+        if len(changed_chunks) == 0:
             self.logger.warn("no record is modified")
+            return OK
+        # all chunks are written before the manifest is saved, an interrupted update is replayed as a whole
+        status = self.chunk_manager.update_chunks(changed_chunks)
+        if not status.ok():
+            self.logger.error("failed to update records of table {}".format(self.name))
+            return status
+        self.logger.info("successfully update #{} chunks for table {}".format(len(changed_chunks), self.name))
         return OK
 
-    # TODO add lock for all these operations on table
+    # matched records are marked in deletion bitmaps of chunks, chunks are rewritten by compaction later (see compact)
     def delete(self, selector) -> Status:
-        chunk_cnt = self.chunk_manager.get_chunk_cnt()
-        is_changed = False
-        for i in range(chunk_cnt):
+        return self._write_logged({"op": WAL_OP_DELETE, "expression": selector.expression}, lambda: self._delete(selector))
+
+    def _delete(self, selector) -> Status:
+        deletions = {}
+        for i in self.chunk_manager.get_chunks_to_scan(selector.expression):
             chunk, status = self.chunk_manager.load_chunk(i)
-            is_chunk_changed = False
             if not status.ok():
-                self.logger.error("failed to update")
+                self.logger.error("failed to delete")
                 return INTERNAL
-            new_chunk = []
-            for j in range(len(chunk)):
-                is_match, status = selector.is_match([chunk[j]])
-                if not status.ok():
-                    self.logger.error("failed to use selector, may due to unable to parse expression {}".format(selector.expression))
-                    return INTERNAL
-                if is_match:
-                    self.logger.info("delete record {} in chunk {}".format(chunk[j], i))
-                    is_chunk_changed = True
-                    is_changed = True
-                    continue
-                new_chunk.append(chunk[j])
-            if is_chunk_changed:
-                self.chunk_manager.update_chunk(i, new_chunk)
-                self.logger.info("successfully delete records in chunk {} for table {}".format(i, self.name))
-        if not is_changed:
+            mask, status = selector.get_mask(chunk)
+            if not status.ok():
+                self.logger.error("failed to use selector, may due to unable to parse expression {}".format(selector.expression))
+                return INTERNAL
+            deleted = self.chunk_manager.get_deleted_rows(i)
+            offsets = [j for j in range(len(chunk)) if mask[j] and (deleted is None or j not in deleted)]
+            if len(offsets):
+                deletions[i] = offsets
+        if len(deletions) == 0:
             self.logger.warn("no record is deleted")
+            return OK
+        status = self.chunk_manager.delete_rows(deletions)
+        if not status.ok():
+            self.logger.error("failed to delete records of table {}".format(self.name))
+            return status
+        self.logger.info("successfully delete #{} records in #{} chunks for table {}".format(sum(len(offsets) for offsets in deletions.values()), len(deletions), self.name))
         return OK
 
+    def recover(self) -> Status:
+        """
+        replay operations in the write-ahead log which were not applied before a crash (or restart), see ChunkManager.replay_log
+        """
+        with self.lock.write():
+            return self.chunk_manager.replay_log(self._replay)
+
+    def _replay(self, entry: dict) -> Status:
+        op = entry["op"]
+        if op == WAL_OP_INSERT:
+            return self._insert_bulk(entry["records"])
+        if op == WAL_OP_UPDATE:
+            return self._update(Selector(entry["expression"], [self.metadata]), entry["values"])
+        if op == WAL_OP_DELETE:
+            return self._delete(Selector(entry["expression"], [self.metadata]))
+        if op == WAL_OP_BULK_LOAD:
+            self.logger.warn("interrupted bulk load into table {} is rolled back".format(self.name))
+            return OK
+        if op == WAL_OP_COMPACT:
+            return self.chunk_manager.rebuild_statistics()
+        self.logger.error("unknown operation {} in the write-ahead log of table {}".format(op, self.name))
+        return UNSUPPORTED
+
+    @contextmanager
+    def pin(self):
+        """
+        keep chunks of the table in place while the context is held, e.g. by a query releasing the read lock between batches
+        compaction is deferred until the table is no longer pinned
+        """
+        with self.pin_lock:
+            self.pin_cnt += 1
+        try:
+            yield
+        finally:
+            with self.pin_lock:
+                self.pin_cnt -= 1
+
+    def compact(self, is_current=None) -> Status:
+        """
+        merge runs of sparse chunks (see ChunkManager.get_sparse_chunks) into as few chunks as their live rows fill
+        live rows are read with the read lock held so queries keep running, only replacing files waits for the write lock
+        chunks written in between, and tables pinned by queries, are left for the next compaction
+        :param is_current: checked with the write lock held, nothing is replaced if it returns False,
+            e.g. the table is dropped and another one is created under the same dir
+        """
+        while True:
+            with self.lock.read():
+                chunks = self.chunk_manager.get_sparse_chunks()
+                if chunks is None or self.pin_cnt > 0:
+                    return OK
+                snapshot, records, status = self.chunk_manager.read_live_rows(*chunks)
+            if not status.ok():
+                self.logger.error("failed to read live rows of chunks {} of table {}".format(chunks, self.name))
+                return status
+            with self.lock.write():
+                if is_current is not None and not is_current():
+                    self.logger.warn("table {} is dropped, compaction is skipped".format(self.name))
+                    return OK
+                if self.pin_cnt > 0:
+                    self.logger.info("table {} is scanned by queries, compaction is deferred".format(self.name))
+                    return OK
+                if self.is_logged:
+                    self.chunk_manager.set_applied_lsn(self.chunk_manager.log([{"op": WAL_OP_COMPACT, "chunks": list(chunks)}])[0])
+                status = self.chunk_manager.compact(*chunks, snapshot, records)
+            if status == INCONSISTENT:
+                return OK
+            if not status.ok():
+                self.logger.error("failed to compact chunks {} of table {}".format(chunks, self.name))
+                return status
+
     # def filter(self, selector) -> Table:
 
 # def sort(self) -> (Table, Status):
@@ -136,6 +337,8 @@ class Table:
 
 # a table is consisted of chunks
 # ChunkManager manage all chunks of a table
-# chunks are stored as files 0${ext}, 1${ext}, ..., ${self.chunk_size - 1}${ext} under ./database/${db_type}/${table_name}, ${ext} is either .json or .csv
-# once the chunk is created, it won't be deleted (even if all records in it are removed).
+# chunks are stored as files ${file_id}${ext} under ./database/${db_type}/${table_name}, ${ext} is either .json or .csv,
+# the manifest maps chunk idx 0, 1, ..., ${self.chunk_size - 1} to file ids
+# deleted records are marked in a deletion bitmap ${file_id}.del of the chunk, chunks with many deleted records are merged by compaction,
+# which writes new files and renumbers chunks after them.
 # all operations changing data files on the disk should be carried out by ChunkManager
@@ -1,5 +1,6 @@
 import os
 import shutil
+import threading
 from enum import Enum
 
 import config
@@ -9,6 +10,7 @@ import logger as logger
 
 from app.common.context.context import Context
 from app.common.error.status import Status, DUPLICATED_TABLE_CREATION_REQUEST, INVALID_ARGUMENT, OK, START_FAILED, INTERNAL, FILE_NOT_EXIST, FILE_EXIST
+from app.common.table.chunk_cache import get_chunk_cache
 from app.common.table.metadata import Metadata, load_from_json, save_as_json
 from app.common.table.selector import Selector
 from app.common.table.table import Table
@@ -32,6 +34,8 @@ class TableManager:
         self.table_map = {}
         self.state = TableManagerState.STOPPED
         self.tmp_table_cnt = 0
+        # guards table_map and tmp_table_cnt, requests are served by multiple threads
+        self.lock = threading.RLock()
 
     def load_table_names(self) -> (list[str], Status):
         os.makedirs(self.metadata_dir, exist_ok=True)
@@ -115,25 +119,38 @@ class TableManager:
         if os.path.exists(metadata_path):
             os.remove(metadata_path)
         table_path = os.path.join(self.tables_dir, table_name)
+        get_chunk_cache().invalidate_table(table_path)
         if os.path.exists(table_path):
             shutil.rmtree(table_path)
 
     def drop_table(self, table_name: str) -> Status:
         if not self.is_started():
             return START_FAILED
-        status = self._unregister_table_in_memory(table_name)
+        with self.lock:
+            table = self.table_map.get(table_name)
+            status = self._unregister_table_in_memory(table_name)
         if not status.ok():
             self.logger.error("failed to drop table {}".format(table_name))
             return status
 
         # couldn't be reverted, should execute at the end
-        self._drop_table_on_disk(table_name)
+        if table is None:
+            self._drop_table_on_disk(table_name)
+            return OK
+        # wait for running scans and writes of the table
+        with table.lock.write():
+            table.chunk_manager.close()
+            self._drop_table_on_disk(table_name)
         return OK
 
     def create_table(self, table_name: str, metadata: Metadata) -> (Table | None, Status):
         if not self.is_started():
             return None, START_FAILED
 
+        with self.lock:
+            return self._create_table(table_name, metadata)
+
+    def _create_table(self, table_name: str, metadata: Metadata) -> (Table | None, Status):
         if table_name in self.table_map:
             self.logger.error("the table {} is already existed, failed to recreate".format(table_name))
             return None, DUPLICATED_TABLE_CREATION_REQUEST
@@ -165,19 +182,24 @@ class TableManager:
             full_path = os.path.join(self.tables_dir, f)
             if not os.path.isdir(full_path):
                 self.logger.warn("regular file {} detected under tables dir".format(f))
-            if f not in table_names:
+            if f not in table_names and not os.path.isdir(full_path):
                 self.logger.error("unexpected table {} detected under tables dir, should be removed".format(f))
                 return False
+            if f not in table_names:
+                # the metadata is removed before the table dir when a table is dropped, finish the interrupted drop
+                self.logger.warn("dangling table {} detected under tables dir, which is removed".format(f))
+                self._drop_table_on_disk(f)
         return True
 
     def create_tmp_table(self, metadata) -> (Table | None, Status):
-        tmp_table_name = constant.TMP_TABLE_PREFIX + str(self.tmp_table_cnt)
-        metadata.table_name = tmp_table_name
-        self.logger.info("creating temporary table: {}".format(tmp_table_name))
-        table, status = self.create_table(tmp_table_name, metadata)
-        if status.ok():
+        # names are taken under the lock, so that concurrent queries never get the same one
+        with self.lock:
+            tmp_table_name = constant.TMP_TABLE_PREFIX + str(self.tmp_table_cnt)
             self.tmp_table_cnt += 1
-        return table, status
+        # copy the metadata, as it's usually shared with the source table
+        metadata = Metadata(tmp_table_name, metadata.db_type, [{info.get_name(): info.get_value_type()} for info in metadata.get_all_fields()], metadata.get_chunk_format())
+        self.logger.info("creating temporary table: {}".format(tmp_table_name))
+        return self.create_table(tmp_table_name, metadata)
 
     def is_tmp_table(self, table_name: str):
         return table_name.startswith(constant.TMP_TABLE_PREFIX)
@@ -217,7 +239,11 @@ class TableManager:
             table_path = os.path.join(self.tables_dir, name)
             if not os.path.exists(table_path):
                 os.makedirs(table_path)
-            self.table_map[name] = Table(table_name=name, metadata=metadata, ctx=self.ctx)
+            table = Table(table_name=name, metadata=metadata, ctx=self.ctx)
+            if not table.recover().ok():
+                self.logger.error("failed to start table manager due to unable to recover table {}".format(name))
+                return START_FAILED
+            self.table_map[name] = table
 
         self.state = TableManagerState.RUNNING
         self.logger.info("table manager started successfully")
@@ -274,4 +300,9 @@ if __name__ == "__main__":
     }))
     assert status.ok()
     chunk, status = table.chunk_manager.load_chunk(1)
+    assert len(chunk) == 2 and len(list(table.chunk_manager.get_iter())[1]) == 1
+    # the deleted record is removed from the file by compaction
+    status = table.compact()
+    assert status.ok()
+    chunk, status = table.chunk_manager.load_chunk(1)
     assert len(chunk) == 1
@@ -0,0 +1,837 @@
+import io
+import json
+import os
+import random
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from unittest import TestCase
+from unittest.mock import patch
+
+import config
+import constant
+import logger as mylogger
+
+from app.common.context.context import Context
+from app.common.error.status import INVALID_ARGUMENT
+from app.common.query.query_engine import QueryEngine
+from app.common.query.vector import DictionaryVector
+from app.common.table.chunk_cache import ChunkCache, estimate_size
+from app.common.table.bloom_filter import BloomFilter
+from app.common.table.chunk_manager import ChunkManager
+from app.common.table.compactor import Compactor
+from app.common.table.columnar import encode_chunk, decode_columns
+from app.common.table.external_sort import ExternalSorter, iterate_records, make_sort_key
+from app.common.table.lock import ReadWriteLock
+from app.common.table.manipulator import HashAggregator, TableManipulator, SortOption, GroupByOption, ReduceOption, ReduceOperation
+from app.common.table.metadata import Metadata
+from app.common.table.parallel_scan import parallel_scan
+from app.common.table.pipeline import ScanOp, ProjectOp, SortOp, LimitOp, JoinOp, materialize
+from app.common.table.selector import Selector, AlwaysTrueSelector
+from app.common.table.table import Table
+from app.common.table.table_manager import get_table_manager
+from app.common.table.wal import WriteAheadLog, WAL_OP_INSERT, fsync_path
+from app.services.database.nosql.db_factory import DBFactory as NoSQLDBFactory
+from app.services.database.sql.db import DB as SQLDB
+from app.services.database.sql.db_factory import DBFactory as SQLDBFactory
+
+
+class Test(TestCase):
+
+    @classmethod
+    def setUpClass(cls) -> None:
+        cls.logger, cls.cfg = mylogger.get_logger(constant.DB_TYPE_SQL), config.config_map[constant.DB_TYPE_SQL]
+        ctx = Context(cls.logger, cls.cfg, SQLDBFactory.instance())
+        cls.tm = get_table_manager(ctx)
+        ctx.set_table_manager(cls.tm)
+        cls.ctx = ctx
+        if not cls.tm.is_started():
+            status = cls.tm.start()
+            assert status.ok()
+
+    def create_table(self, table_name: str, fields: list[dict[str, str]], chunk_format: str = ""):
+        self.tm.drop_table(table_name)
+        table, status = self.tm.create_table(table_name, Metadata(table_name, constant.DB_TYPE_SQL, fields, chunk_format))
+        assert status.ok()
+        return table
+
+    def test_columnar_chunk(self):
+        table = self.create_table("test_table_columnar", [{"col1": "int"}, {"col2": "str"}, {"col3": "float"}, {"col4": "bool"}], constant.CHUNK_FORMAT_COLUMNAR)
+        records = [{"col1": i, "col2": "名字{}".format(i) if i % 7 == 0 else "a,b\n{}".format(i), "col3": i / 2, "col4": i % 2 == 0} for i in range(self.cfg.max_chunk_size + 10)]
+        status = table.insert_bulk(records)
+        assert status.ok()
+        assert table.chunk_manager.get_chunk_cnt() == 2
+        assert table.chunk_manager.get_chunk_path(0).endswith(constant.COLUMNAR_CHUNK_EXT)
+
+        loaded = [entry for chunk in table.chunk_manager.get_iter() for entry in chunk]
+        assert loaded == records
+
+        status = table.update(Selector({"op": "==", "v1": "0::col1", "v2": 3}), {"col2": "updated"})
+        assert status.ok()
+        status = table.delete(Selector({"op": "<", "v1": "0::col1", "v2": 2}))
+        assert status.ok()
+        chunk = next(table.chunk_manager.get_iter())
+        assert chunk[0]["col1"] == 2
+        assert chunk[1] == {"col1": 3, "col2": "updated", "col3": 1.5, "col4": False}
+
+    def test_dictionary_encoding(self):
+        table = self.create_table("test_table_dictionary", [{"col1": "int"}, {"col2": "str"}, {"col3": "str"}], constant.CHUNK_FORMAT_COLUMNAR)
+        platforms = ["PS4", "Xbox One", "PC", "Wii"]
+        records = [{"col1": i, "col2": platforms[i % len(platforms)], "col3": "title {}".format(i)} for i in range(self.cfg.max_chunk_size)]
+        assert table.insert_bulk(records).ok()
+        # only the column with few distinct values is dictionary encoded
+        with patch.object(config, "dictionary_max_distinct_ratio", 0):
+            plain = encode_chunk(records, table.metadata)
+        assert os.path.getsize(table.chunk_manager.get_chunk_path(0)) < len(plain) - self.cfg.max_chunk_size * 4
+        with open(table.chunk_manager.get_chunk_path(0), "rb") as f:
+            row_cnt, vectors = decode_columns(f.read(), table.metadata, as_vectors=True)
+        assert type(vectors["col2"]) is DictionaryVector and sorted(vectors["col2"].values) == sorted(platforms)
+        assert type(vectors["col3"]) is list
+
+        # rows with the same value share the decoded str
+        loaded = [entry for chunk in table.chunk_manager.get_iter() for entry in chunk]
+        assert loaded == records
+        assert loaded[0]["col2"] is loaded[len(platforms)]["col2"]
+
+        # comparisons on the dictionary encoded column are valuated for each distinct value
+        for expression, expected in [({"op": "==", "v1": "0::col2", "v2": "PC"}, [r for r in records if r["col2"] == "PC"]),
+                                     ({"op": "<", "v1": "Wii", "v2": "0::col2"}, [r for r in records if r["col2"] > "Wii"]),
+                                     ({"op": "&&", "v1": {"op": "!=", "v1": "0::col2", "v2": "PC"}, "v2": {"op": "<", "v1": "0::col1", "v2": 8}},
+                                      [r for r in records if r["col2"] != "PC" and r["col1"] < 8])]:
+            selection, status = Selector(expression, [table.metadata]).get_selection(vectors, row_cnt)
+            assert status.ok() and selection == [r["col1"] for r in expected]
+            assert [entry for chunk in table.chunk_manager.scan(Selector(expression, [table.metadata])) for entry in chunk] == expected
+        assert not Selector({"op": "==", "v1": "0::col2", "v2": 1}).get_selection(vectors, row_cnt)[1].ok()
+
+    def test_zone_map_skip_chunks(self):
+        table = self.create_table("test_table_zone_map", [{"col1": "int"}, {"col2": "str"}])
+        status = table.insert_bulk([{"col1": i, "col2": "a"} for i in range(self.cfg.max_chunk_size * 4)])
+        assert status.ok()
+        cm = table.chunk_manager
+        expression = {"op": "&&",
+                      "v1": {"op": ">=", "v1": "0::col1", "v2": self.cfg.max_chunk_size * 3 + 10},
+                      "v2": {"op": "==", "v1": "a", "v2": "0::col2"}}
+        assert [i for i in range(cm.get_chunk_cnt()) if cm.may_match(i, expression)] == [3]
+
+        with patch.object(cm.reader, "scan", wraps=cm.reader.scan) as scan_chunk:
+            new_table = TableManipulator.filter(table, Selector(expression))
+            assert [call.args[0].chunk_path for call in scan_chunk.call_args_list] == [cm.get_chunk_path(3)]
+        with patch.object(cm, "load_chunk", wraps=cm.load_chunk) as load_chunk:
+            status = table.delete(Selector({"op": "<", "v1": "0::col1", "v2": 5}))
+            assert status.ok()
+            assert load_chunk.call_args_list[-1].args[0] == 0
+        assert sum(len(chunk) for chunk in new_table.chunk_manager.get_iter()) == self.cfg.max_chunk_size - 10
+
+        # statistics are persisted and refreshed after deletion
+        cm2 = ChunkManager(cm.table_path, table.metadata, Context(self.logger, self.cfg, SQLDBFactory.instance()))
+        cm2.start()
+        assert not cm2.may_match(0, {"op": "<", "v1": "0::col1", "v2": 5})
+        assert cm2.may_match(0, {"op": "<", "v1": "0::col1", "v2": 6})
+        assert cm2.may_match(0, {"op": "<", "v1": "0::col1", "v2": 5.0})  # mismatched type is never skipped
+        assert cm2.may_match(0, {"op": "!", "v1": {"op": "<", "v1": "0::col1", "v2": 5}})
+
+    def test_bloom_filter(self):
+        bloom = BloomFilter.create(100, 0.01)
+        for value in [1, "a", None]:
+            bloom.add(value)
+        assert bloom.may_contain(1.0) and bloom.may_contain(True) and bloom.may_contain("a") and bloom.may_contain(None)
+        assert not bloom.may_contain("b") and bloom.may_contain([1])
+
+        table_name = "test_table_bloom_filter"
+        self.tm.drop_table(table_name)
+        table, status = self.tm.create_table(table_name, Metadata(table_name, constant.DB_TYPE_SQL, [{"col1": "int"}, {"col2": "str"}], bloom_filter_columns=["col2"]))
+        assert status.ok()
+        with open(os.path.join(self.cfg.get_metadata_dir(), table_name + config.metadata_ext)) as f:
+            assert json.load(f)[constant.METADATA_BLOOM_FILTER_KEY] == ["col2"]
+        # names are shuffled, min/max of every chunk cover almost all names
+        names = ["name{}".format(i) for i in range(3 * self.cfg.max_chunk_size)]
+        random.Random(0).shuffle(names)
+        assert table.insert_bulk([{"col1": i, "col2": name} for i, name in enumerate(names)]).ok()
+        idx = self.cfg.max_chunk_size + 5
+        assert table.chunk_manager.get_chunks_to_scan({"op": "==", "v1": names[idx], "v2": "0::col2"}) == [1]
+        assert table.chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col2", "v2": "missing"}) == []
+        assert table.chunk_manager.get_chunks_to_scan({"op": "!=", "v1": "0::col2", "v2": "missing"}) == [0, 1, 2]
+
+        # filters are rebuilt when chunks are written, and persisted
+        assert table.update(Selector({"op": "==", "v1": "0::col2", "v2": names[idx]}), {"col2": "new"}).ok()
+        assert table.delete(Selector({"op": "==", "v1": "0::col1", "v2": 0})).ok()
+        chunk_manager = ChunkManager(table.chunk_manager.table_path, table.metadata, self.ctx)
+        chunk_manager.start()
+        assert chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col2", "v2": "new"}) == [1]
+        assert chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col2", "v2": names[idx]}) == []
+
+        # chunks of the probe side without any key of the build side are skipped
+        right_name = "test_table_bloom_filter_right"
+        right = self.create_table(right_name, [{"col3": "int"}, {"col2": "str"}])
+        assert right.insert_bulk([{"col3": i, "col2": names[2 * self.cfg.max_chunk_size + i]} for i in range(3)]).ok()
+        plan = JoinOp(ScanOp(table), table_name, right, Selector({"op": "==", "v1": "0::col2", "v2": "1::col2"}, [table.metadata, right.metadata]))
+        with patch.object(table.chunk_manager, "scan_chunk", wraps=table.chunk_manager.scan_chunk) as scan_chunk:
+            res = [(entry[table_name + "::col1"], entry[right_name + "::col3"]) for batch in plan.batches() for entry in batch]
+            assert [call.args[0] for call in scan_chunk.call_args_list] == [2]
+        assert sorted(res) == [(2 * self.cfg.max_chunk_size + i, i) for i in range(3)]
+
+        # values are hashed as they are stored, i.e. converted into types of fields
+        for chunk_format in self.cfg.get_supported_chunk_formats():
+            typed_name = "test_table_bloom_filter_typed"
+            self.tm.drop_table(typed_name)
+            typed, status = self.tm.create_table(typed_name, Metadata(typed_name, constant.DB_TYPE_SQL, [{"col1": "int"}], chunk_format, ["col1"]))
+            assert status.ok()
+            assert typed.chunk_manager.dump_bulk([{"col1": "2023"}]).ok()
+            assert [entry for chunk in typed.chunk_manager.scan(Selector({"op": "==", "v1": "0::col1", "v2": 2023})) for entry in chunk] == [{"col1": 2023}]
+
+    def test_index(self):
+        table = self.create_table("test_table_index", [{"col1": "int"}, {"col2": "str"}])
+        n = self.cfg.max_chunk_size * 3
+        # values are scattered over all chunks, the zone map can't skip any chunk
+        status = table.insert_bulk([{"col1": (i * 7) % n, "col2": "a"} for i in range(n)])
+        assert status.ok()
+        assert table.create_index("col1").ok()
+        assert not table.create_index("col1").ok()
+        assert not table.create_index("missing").ok()
+
+        cm = table.chunk_manager
+        assert cm.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": 7}) == [0]
+        # chunks loaded to build the index are cached, which are not scanned from the file
+        cm.cache.invalidate_table(cm.table_path)
+        with patch.object(cm.reader, "scan", wraps=cm.reader.scan) as scan_chunk:
+            res = [entry for batch in ScanOp(table, Selector({"op": "==", "v1": 14, "v2": "0::col1"})).batches() for entry in batch]
+            assert res == [{"col1": 14, "col2": "a"}]
+            assert [call.args[0].chunk_path for call in scan_chunk.call_args_list] == [cm.get_chunk_path(0)]
+
+        # indexes are maintained by insertion, update and deletion
+        status = table.insert_bulk([{"col1": -i, "col2": "b"} for i in range(10)])
+        assert status.ok()
+        assert table.update(Selector({"op": "==", "v1": "0::col1", "v2": 21}), {"col1": n + 1}).ok()
+        assert table.delete(Selector({"op": "<", "v1": "0::col1", "v2": 100})).ok()
+
+        cm2 = ChunkManager(cm.table_path, table.metadata, Context(self.logger, self.cfg, SQLDBFactory.instance()))
+        cm2.start()
+        expressions = [{"op": "==", "v1": "0::col1", "v2": 21},
+                       {"op": "==", "v1": "0::col1", "v2": n + 1},
+                       {"op": ">=", "v1": "0::col1", "v2": n - 5},
+                       {"op": "<", "v1": "0::col1", "v2": 120},
+                       {"op": "||", "v1": {"op": "==", "v1": "0::col1", "v2": 100}, "v2": {"op": "==", "v1": "0::col1", "v2": 101}},
+                       {"op": "&&", "v1": {"op": "<=", "v1": "0::col1", "v2": 1000}, "v2": {"op": "==", "v1": "0::col2", "v2": "a"}}]
+        for expression in expressions:
+            selector = Selector(expression)
+            expected = [i for i, chunk in enumerate(cm2.get_iter()) if any(selector.is_match([entry])[0] for entry in chunk)]
+            candidates = cm2.get_chunks_to_scan(expression)
+            assert set(expected) <= set(candidates), expression
+            assert len(candidates) <= len(expected) + 1, expression
+        assert cm2.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": 21}) == []
+        # comparing with a different type is never pruned by indexes
+        expression = {"op": "==", "v1": "0::col1", "v2": 21.0}
+        assert cm2.get_chunks_to_scan(expression) == [i for i in range(cm2.get_chunk_cnt()) if cm2.may_match(i, expression)]
+
+        # a value is indexed once for each chunk, however many rows of the chunk have it
+        assert table.create_index("col2").ok()
+        assert sorted(cm.index_manager.indexes["col2"].search()) == [("a", 0), ("a", 1), ("a", 2)]
+        # updating other columns leaves the index untouched
+        tree = cm.index_manager.indexes["col1"]
+        with patch.object(tree, "insert", wraps=tree.insert) as insert, patch.object(tree, "remove", wraps=tree.remove) as remove:
+            assert table.update(Selector({"op": ">=", "v1": "0::col1", "v2": 0}), {"col2": "c"}).ok()
+            assert insert.call_count == 0 and remove.call_count == 0
+
+    def test_manifest(self):
+        table = self.create_table("test_table_manifest", [{"col1": "int"}, {"col2": "str"}])
+        status = table.insert_bulk([{"col1": i, "col2": "a"} for i in range(self.cfg.max_chunk_size)])
+        assert status.ok()
+        cm = table.chunk_manager
+        # the table dir is never listed, and a full last chunk is never loaded when appending
+        with patch("os.listdir", side_effect=AssertionError), patch.object(cm, "load_chunk", wraps=cm.load_chunk) as load_chunk:
+            assert cm.get_chunk_cnt() == 1
+            assert cm.is_last_chunk_full()
+            assert table.insert({"col1": -1, "col2": "b"}).ok()
+            assert [call.args[0] for call in load_chunk.call_args_list] == []
+            assert [entry for chunk in cm.get_iter() for entry in chunk][-1] == {"col1": -1, "col2": "b"}
+        assert cm.manifest.get_row_cnt(0) == self.cfg.max_chunk_size and cm.manifest.get_row_cnt(1) == 1
+        assert cm.manifest.get_chunk(1).size == os.path.getsize(cm.get_chunk_path(1))
+
+        # the manifest is persisted, and rebuilt from the table dir if missing
+        cm2 = ChunkManager(cm.table_path, table.metadata, Context(self.logger, self.cfg, SQLDBFactory.instance()))
+        cm2.start()
+        assert [chunk.to_json_obj() for chunk in cm2.manifest.chunks] == [chunk.to_json_obj() for chunk in cm.manifest.chunks]
+        os.remove(os.path.join(cm.table_path, constant.MANIFEST_FILE_NAME))
+        cm3 = ChunkManager(cm.table_path, table.metadata, Context(self.logger, self.cfg, SQLDBFactory.instance()))
+        cm3.start()
+        assert cm3.get_chunk_cnt() == 2 and cm3.manifest.get_row_cnt(1) == 1
+
+    def test_append_to_tail(self):
+        table = self.create_table("test_table_append", [{"col1": "int"}, {"col2": "str"}])
+        assert table.insert_bulk([{"col1": 0, "col2": "a"}]).ok()
+        assert table.create_index("col1").ok()
+        cm = table.chunk_manager
+        # single inserts never rewrite or load the last chunk
+        with patch.object(cm, "_write_chunk", wraps=cm._write_chunk) as write_chunk, patch.object(cm, "load_chunk", wraps=cm.load_chunk) as load_chunk:
+            for i in range(1, self.cfg.max_chunk_size + 2):
+                assert table.insert({"col1": i, "col2": "b"}).ok()
+            assert [call.args[0] for call in load_chunk.call_args_list] == []
+            assert [call.args[0] for call in write_chunk.call_args_list] == [1]
+        assert [entry["col1"] for chunk in cm.get_iter() for entry in chunk] == list(range(self.cfg.max_chunk_size + 2))
+        assert cm.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": 100}) == [0]
+        assert not cm.may_match(0, {"op": ">", "v1": "0::col1", "v2": self.cfg.max_chunk_size - 1})
+        assert cm.may_match(0, {"op": "==", "v1": "0::col2", "v2": "b"})
+
+    def test_append_to_nosql_tail_log(self):
+        cfg = config.config_map[constant.DB_TYPE_NOSQL]
+        ctx = Context(mylogger.get_logger(constant.DB_TYPE_NOSQL), cfg, NoSQLDBFactory.instance())
+        with tempfile.TemporaryDirectory() as table_path:
+            cm = ChunkManager(table_path, Metadata("test_table_tail_log", constant.DB_TYPE_NOSQL, []), ctx)
+            cm.start()
+            for i in range(cfg.max_chunk_size + 1):
+                assert cm.dump_one({"a": i} if i % 2 else {"b": str(i)}).ok()
+                if i == 10:
+                    assert os.path.exists(cm.get_tail_path(0))
+                    chunk_file = cm.get_chunk_file(0)
+                    expected = cm.reader.scan(chunk_file)
+            # the tail log is folded into the json chunk once the chunk is full
+            assert not os.path.exists(cm.get_tail_path(0))
+            assert len(expected) == 11 and cm.reader.scan(chunk_file) == expected
+            chunk, status = cm.load_chunk(0)
+            assert status.ok() and len(chunk) == cfg.max_chunk_size and chunk[3] == {"a": 3}
+
+            cm2 = ChunkManager(table_path, cm.metadata, ctx)
+            cm2.start()
+            assert cm2.get_chunk_cnt() == 2
+            assert [entry for chunk in cm2.get_iter() for entry in chunk] == [{"a": i} if i % 2 else {"b": str(i)} for i in range(cfg.max_chunk_size + 1)]
+
+    def test_ndjson_chunk(self):
+        cfg = config.config_map[constant.DB_TYPE_NOSQL]
+        ctx = Context(mylogger.get_logger(constant.DB_TYPE_NOSQL), cfg, NoSQLDBFactory.instance())
+        records = [{"a": i, "s": "line\nbreak"} if i % 2 else {"a": i, "b": [str(i)]} for i in range(cfg.max_chunk_size + 3)]
+        with tempfile.TemporaryDirectory() as table_path:
+            cm = ChunkManager(table_path, Metadata("test_table_ndjson", constant.DB_TYPE_NOSQL, [], constant.CHUNK_FORMAT_NDJSON), ctx)
+            cm.start()
+            for record in records[:10]:
+                assert cm.dump_one(record).ok()
+            assert cm.dump_bulk(records[10:]).ok()
+            # records are appended to the chunk itself, there is no tail log
+            assert os.path.exists(os.path.join(table_path, "0" + constant.NDJSON_CHUNK_EXT)) and not os.path.exists(cm.get_tail_path(0))
+            assert cm.get_chunk_cnt() == 2
+
+            cm2 = ChunkManager(table_path, cm.metadata, ctx)
+            cm2.start()
+            cm2.cache = ChunkCache(0)
+            assert [entry for chunk in cm2.get_iter() for entry in chunk] == records
+            record, status = cm2.load_row(0, 5)
+            assert status.ok() and record == records[5]
+            assert cm2.load_row(1, 2)[0] == records[cfg.max_chunk_size + 2]
+            assert not cm2.load_row(1, 3)[1].ok()
+            selector = Selector({"op": ">", "v1": "0::a", "v2": 10})
+            assert [entry for chunk in cm2.scan(selector, ["s"]) for entry in chunk] == [{"s": "line\nbreak"} if i % 2 else {} for i in range(11, len(records))]
+
+    def test_delete_and_compact(self):
+        for chunk_format in [constant.CHUNK_FORMAT_CSV, constant.CHUNK_FORMAT_COLUMNAR]:
+            table = self.create_table("test_table_tombstone_" + chunk_format, [{"col1": "int"}, {"col2": "str"}], chunk_format)
+            n = self.cfg.max_chunk_size * 4
+            records = [{"col1": i, "col2": str(i % 3)} for i in range(n)]
+            assert table.insert_bulk(records).ok()
+            assert table.create_index("col1").ok()
+            cm = table.chunk_manager
+            # deleting rows never rewrites chunks
+            with patch.object(cm, "_write_chunk_file", wraps=cm._write_chunk_file) as write_chunk_file:
+                assert table.delete(Selector({"op": "<", "v1": "0::col1", "v2": self.cfg.max_chunk_size})).ok()
+                assert table.delete(Selector({"op": "!=", "v1": "0::col2", "v2": "0"})).ok()
+                assert write_chunk_file.call_count == 0
+            live = [record for record in records if record["col1"] >= self.cfg.max_chunk_size and record["col2"] == "0"]
+            assert cm.get_chunks_to_scan() == [1, 2, 3]
+            assert [entry for chunk in cm.get_iter() for entry in chunk] == live
+            assert [entry for chunk in cm.scan(Selector({"op": "<", "v1": "0::col1", "v2": n}, [table.metadata]), ["col1"]) for entry in chunk] == [{"col1": record["col1"]} for record in live]
+            assert table.update(Selector({"op": "==", "v1": "0::col1", "v2": n - 2}), {"col2": "0"}).ok()
+            assert [entry for chunk in cm.get_iter() for entry in chunk] == live
+            assert cm.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": self.cfg.max_chunk_size + 1}) == []
+
+            # deletion bitmaps are persisted
+            reloaded = ChunkManager(cm.table_path, table.metadata, self.ctx)
+            reloaded.start()
+            assert [entry for chunk in reloaded.get_iter() for entry in chunk] == live
+
+            assert table.insert({"col1": -1, "col2": "0"}).ok()
+            assert table.compact().ok()
+            # live rows of all sparse chunks are merged, offsets in indexes are rebuilt
+            assert cm.get_chunk_cnt() == 2 and cm.manifest.get_deleted_cnt(0) == 0
+            assert [entry for chunk in cm.get_iter(include_deleted=True) for entry in chunk] == live + [{"col1": -1, "col2": "0"}]
+            assert not any(os.path.exists(cm.tombstones.get_path(i)) for i in range(4))
+            assert cm.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": -1}) == [1]
+            assert table.insert_bulk(records[:self.cfg.max_chunk_size]).ok()
+            assert [entry for chunk in cm.get_iter() for entry in chunk] == live + [{"col1": -1, "col2": "0"}] + records[:self.cfg.max_chunk_size]
+
+    def test_compaction_crash(self):
+        m = self.cfg.max_chunk_size
+        table = self.create_table("test_table_compaction_crash", [{"col1": "int"}, {"col2": "str"}])
+        records = [{"col1": i, "col2": str(i % 2) if i < m * 3 else "x"} for i in range(m * 5)]
+        assert table.insert_bulk(records).ok()
+        assert table.delete(Selector({"op": "==", "v1": "0::col2", "v2": "1"})).ok()
+        live = [record for record in records if record["col2"] != "1"]
+
+        def restart(t: Table) -> Table:
+            t.chunk_manager.close()
+            t = Table(t.name, t.metadata, self.ctx)
+            assert t.recover().ok()
+            # only files of chunks in the manifest are left
+            cm = t.chunk_manager
+            assert {int(f[:-len(cm.ext)]) for f in os.listdir(cm.table_path) if f.endswith(cm.ext)} == cm.manifest.get_file_ids()
+            assert [entry for chunk in cm.get_iter() for entry in chunk] == live
+            return t
+
+        # crash before the manifest of the new layout is saved, the old layout is kept
+        with patch.object(table.chunk_manager.manifest, "save", side_effect=RuntimeError("crash")):
+            self.assertRaises(RuntimeError, table.compact)
+        table = restart(table)
+        assert table.chunk_manager.get_chunk_cnt() == 5
+        assert table.chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": m * 5 - 1}) == [4]
+
+        # crash after the manifest is saved, files of old chunks are left
+        with patch.object(table.chunk_manager.tombstones, "remove", side_effect=RuntimeError("crash")):
+            self.assertRaises(RuntimeError, table.compact)
+        table = restart(table)
+        assert table.chunk_manager.get_chunk_cnt() == 4
+        assert table.chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": m * 5 - 1}) == [3]
+        table.chunk_manager.close()
+        self.tm.table_map[table.name] = Table(table.name, table.metadata, self.ctx)
+
+    def test_compactor_recreated_table(self):
+        table = self.create_table("test_table_compactor", [{"col1": "int"}])
+        assert table.insert_bulk([{"col1": i} for i in range(self.cfg.max_chunk_size * 2)]).ok()
+        assert table.delete(Selector({"op": "<", "v1": "0::col1", "v2": self.cfg.max_chunk_size})).ok()
+        recreated = Table(table.name, table.metadata, self.ctx)
+
+        def read_live_rows(*args):
+            # the table is dropped and recreated while its live rows are read
+            self.tm.table_map[table.name] = recreated
+            return ChunkManager.read_live_rows(table.chunk_manager, *args)
+
+        with patch.object(table.chunk_manager, "read_live_rows", side_effect=read_live_rows):
+            Compactor(self.tm).compact_all()
+        assert table.chunk_manager.get_chunk_cnt() == 2
+        table.chunk_manager.close()
+        Compactor(self.tm).compact_all()
+        assert recreated.chunk_manager.get_chunk_cnt() == 1
+
+    def test_bulk_load(self):
+        table = self.create_table("test_table_bulk_load", [{"col1": "int"}, {"col2": "str"}])
+        assert table.insert({"col1": -1, "col2": "x"}).ok()
+        assert table.create_index("col1").ok()
+        records = [{"col1": i, "col2": str(i)} for i in range(self.cfg.max_chunk_size * 3)]
+        batches = [records[:10], records[10:self.cfg.max_chunk_size * 2], records[self.cfg.max_chunk_size * 2:]]
+        cm = table.chunk_manager
+        with patch.object(cm, "_save_sidecars", wraps=cm._save_sidecars) as save_sidecars, patch("os.sync", side_effect=AssertionError), \
+                patch("app.common.table.chunk_manager.fsync_path", wraps=fsync_path) as sync, patch("app.common.table.index.fsync_path", wraps=fsync_path) as sync_index:
+            assert table.bulk_load(iter(batches)).ok()
+        # sidecars are persisted once for all batches
+        assert save_sidecars.call_count == 1
+        # only files written by the bulk load are flushed onto the disk before the log is truncated
+        synced = [call.args[0] for call in sync.call_args_list]
+        assert set(synced) == {cm.get_chunk_path(i) for i in range(4)} | {cm.zone_map.path, cm.manifest.path, cm.table_path}
+        assert os.path.join(cm.index_manager.path, "col1") in [call.args[0] for call in sync_index.call_args_list]
+        assert len(cm.unsynced_paths) == 0 and cm.wal.get_size() == 0
+        assert [entry for chunk in cm.get_iter() for entry in chunk] == [{"col1": -1, "col2": "x"}] + records
+        assert [cm.manifest.get_row_cnt(i) for i in range(cm.get_chunk_cnt())] == [self.cfg.max_chunk_size] * 3 + [1]
+        assert cm.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": self.cfg.max_chunk_size * 3 - 1}) == [3]
+
+        reloaded = ChunkManager(cm.table_path, table.metadata, Context(self.logger, self.cfg, SQLDBFactory.instance()))
+        assert reloaded.start().ok()
+        assert reloaded.get_chunk_cnt() == 4 and reloaded.zone_map.get_chunk(3).row_cnt == 1
+
+    def test_insert_stream(self):
+        table = self.create_table("test_table_insert_stream", [{"col1": "int"}, {"col2": "str"}])
+        db = SQLDB()
+        assert db.start(self.ctx).ok()
+        n = self.cfg.max_chunk_size * 2 + 5
+        body = io.StringIO("".join(json.dumps({"col1": i, "col2": str(i)}) + "\n" for i in range(n)))
+        cnt, status = db.on_insert_stream(table.name, body, constant.INSERT_STREAM_NDJSON_MIMETYPE)
+        assert status.ok() and cnt == n
+        body = io.StringIO("col2,col1\r\na,-1\r\n\"b,c\",-2\r\n")
+        cnt, status = db.on_insert_stream(table.name, body, constant.INSERT_STREAM_CSV_MIMETYPE)
+        assert status.ok() and cnt == 2
+        records = [entry for chunk in table.chunk_manager.get_iter() for entry in chunk]
+        assert records == [{"col1": i, "col2": str(i)} for i in range(n)] + [{"col1": -1, "col2": "a"}, {"col1": -2, "col2": "b,c"}]
+
+        # records before a malformed line are kept, including those of a partial batch
+        lines = [json.dumps({"col1": i, "col2": "d"}) for i in range(self.cfg.max_chunk_size + 3)] + ["{"]
+        cnt, status = db.on_insert_stream(table.name, io.StringIO("\n".join(lines)), constant.INSERT_STREAM_NDJSON_MIMETYPE)
+        assert not status.ok() and cnt == self.cfg.max_chunk_size + 3
+        assert sum(table.chunk_manager.manifest.get_row_cnt(i) for i in range(table.chunk_manager.get_chunk_cnt())) == n + 2 + cnt
+        _, status = db.on_insert_stream(table.name, io.StringIO("col3\n1\n"), constant.INSERT_STREAM_CSV_MIMETYPE)
+        assert not status.ok()
+        # all fields are required in the csv header
+        assert db.on_insert_stream(table.name, io.StringIO("col1\n1\n"), constant.INSERT_STREAM_CSV_MIMETYPE) == (0, INVALID_ARGUMENT)
+
+    def test_chunk_cache(self):
+        cache = ChunkCache(estimate_size([{"a": i} for i in range(10)]) * 2)
+        cache.put("t", 0, 0, [{"a": i} for i in range(10)])
+        cache.put("t", 1, 0, [{"a": i} for i in range(10)])
+        assert cache.get("t", 0, 0) == [{"a": i} for i in range(10)]
+        assert cache.get("t", 0, 1) is None  # stale version
+        # the least recently used entry is evicted
+        cache.put("t", 2, 0, [{"a": i} for i in range(10)])
+        assert cache.get("t", 1, 0) is None and cache.contains("t", 0, 0) and cache.contains("t", 2, 0)
+        # loaded chunks can be modified without touching the cache
+        cache.get("t", 0, 0)[0]["a"] = -1
+        assert cache.get("t", 0, 0)[0] == {"a": 0}
+        assert cache.get_stats()["hits"] == 3 and cache.get_stats()["misses"] == 2 and cache.get_stats()["evictions"] == 1
+
+        table = self.create_table("test_table_cache", [{"col1": "int"}, {"col2": "str"}])
+        assert table.insert_bulk([{"col1": i, "col2": "a"} for i in range(self.cfg.max_chunk_size + 1)]).ok()
+        cm = table.chunk_manager
+        with patch.object(cm, "_read_chunk", wraps=cm._read_chunk) as read_chunk:
+            for _ in range(3):
+                assert sum(len(chunk) for chunk in cm.get_iter()) == self.cfg.max_chunk_size + 1
+            assert [call.args[0] for call in read_chunk.call_args_list] == [0, 1]
+            # written chunks are read again
+            assert table.update(Selector({"op": "==", "v1": "0::col1", "v2": 3}), {"col2": "b"}).ok()
+            assert table.insert({"col1": -1, "col2": "c"}).ok()
+            assert [entry["col2"] for chunk in cm.get_iter() for entry in chunk if entry["col1"] in [3, -1]] == ["b", "c"]
+            assert [call.args[0] for call in read_chunk.call_args_list] == [0, 1, 0, 1]
+        self.tm.drop_table("test_table_cache")
+        assert not cm.cache.contains(cm.table_path, 0, cm.manifest.get_version(0))
+
+    def test_index_field_types(self):
+        table = self.create_table("test_table_index_types", [{"col1": "int"}, {"col2": "str"}])
+        assert table.insert_bulk([{"col1": i, "col2": str(i)} for i in range(10)]).ok()
+        assert table.create_index("col1").ok()
+        # values are converted into types of fields before they are logged and indexed
+        assert table.insert({"col1": "2023", "col2": "x"}).ok()
+        assert table.update(Selector({"op": "==", "v1": "0::col1", "v2": 3}), {"col1": "30"}).ok()
+        assert table.chunk_manager.index_manager.get_candidate_chunks({"op": "==", "v1": "0::col1", "v2": 2023}) == {0}
+        assert table.chunk_manager.index_manager.get_candidate_chunks({"op": "==", "v1": "0::col1", "v2": 30}) == {0}
+        # invalid values are rejected without being logged
+        assert table.insert({"col1": "x", "col2": "x"}) == INVALID_ARGUMENT
+        assert table.update(Selector({"op": "==", "v1": "0::col1", "v2": 3}), {"col1": None}) == INVALID_ARGUMENT
+        assert table.chunk_manager.get_pending_log_entries() == []
+        # values of records written without conversion are indexed as they are stored
+        assert table.chunk_manager.dump_bulk([{"col1": "7", "col2": "y"}]).ok()
+        assert sorted(entry["col1"] for chunk in table.chunk_manager.scan(Selector({"op": ">", "v1": "0::col1", "v2": 9})) for entry in chunk) == [30, 2023]
+
+    def test_write_ahead_log(self):
+        table = self.create_table("test_table_wal", [{"col1": "int"}, {"col2": "str"}])
+        records = [{"col1": i, "col2": str(i)} for i in range(self.cfg.max_chunk_size + 10)]
+        assert table.insert_bulk(records[:10]).ok()
+        assert table.create_index("col1").ok()
+        operations = [lambda t: t.insert_bulk(records[10:]),
+                      lambda t: t.update(Selector({"op": "<", "v1": "0::col1", "v2": 5}, [t.metadata]), {"col2": "x"}),
+                      lambda t: t.delete(Selector({"op": "==", "v1": "0::col1", "v2": 7}, [t.metadata]))]
+        for operation in operations:
+            # crash after chunks are written but before sidecars are saved
+            with patch.object(table.chunk_manager, "_save_sidecars", side_effect=RuntimeError("crash")):
+                with self.assertRaises(RuntimeError):
+                    operation(table)
+            table.chunk_manager.close()
+            # the table is loaded from the disk as if the server is restarted
+            table = Table(table.name, table.metadata, self.ctx)
+            assert table.recover().ok()
+            assert table.chunk_manager.get_pending_log_entries() == []
+
+        expected = [{"col1": i, "col2": "x" if i < 5 else str(i)} for i in range(len(records)) if i != 7]
+        assert [entry for chunk in table.chunk_manager.get_iter() for entry in chunk] == expected
+        assert table.chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": 7}) == []
+        assert table.chunk_manager.get_chunks_to_scan({"op": "==", "v1": "0::col1", "v2": self.cfg.max_chunk_size + 1}) == [1]
+        table.chunk_manager.close()
+        self.tm.table_map["test_table_wal"] = Table(table.name, table.metadata, self.ctx)
+
+    def test_replay_failed_log_entry(self):
+        table = self.create_table("test_table_replay_failed", [{"col1": "int"}])
+        assert table.insert({"col1": 1}).ok()
+        # entries which can never be applied are skipped instead of failing every restart
+        table.chunk_manager.log([{"op": "unknown"}, {"op": WAL_OP_INSERT}, {"op": WAL_OP_INSERT, "records": [{"col1": 2}]}])
+        table.chunk_manager.close()
+        for _ in range(2):
+            table = Table(table.name, table.metadata, self.ctx)
+            assert table.recover().ok()
+            assert table.chunk_manager.get_pending_log_entries() == []
+            assert [entry["col1"] for chunk in table.chunk_manager.get_iter() for entry in chunk] == [1, 2]
+            table.chunk_manager.close()
+        self.tm.table_map[table.name] = Table(table.name, table.metadata, self.ctx)
+
+    def test_write_ahead_log_torn_entry(self):
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            wal = WriteAheadLog(os.path.join(tmp_dir, constant.WAL_FILE_NAME))
+            wal.open(0)
+            wal.append({"op": WAL_OP_INSERT, "records": [{"col1": 1}]})
+            wal.sync()
+            # a crash in the middle of writing an entry
+            wal.file.write(b'{"op": "insert", "rec')
+            wal.close()
+            wal.open(0)
+            assert wal.append({"op": WAL_OP_INSERT, "records": [{"col1": 2}]}) == 2
+            wal.sync()
+            wal.close()
+            assert [entry["records"] for entry in wal.read_entries()] == [[{"col1": 1}], [{"col1": 2}]]
+
+    def test_group_commit(self):
+        table = self.create_table("test_table_group_commit", [{"col1": "int"}])
+        with patch.object(table.chunk_manager.wal, "sync", wraps=table.chunk_manager.wal.sync) as sync:
+            with ThreadPoolExecutor(max_workers=8) as executor:
+                # writes queued while the table is locked are logged with a single fsync
+                with table.lock.write():
+                    futures = [executor.submit(table.insert, {"col1": i}) for i in range(8)]
+                    while len(table.pending_writes) < 8:
+                        threading.Event().wait(0.01)
+                assert all(future.result().ok() for future in futures)
+            assert sync.call_count == 1
+        assert sorted(entry["col1"] for chunk in table.chunk_manager.get_iter() for entry in chunk) == list(range(8))
+
+    def test_read_write_lock(self):
+        lock, events = ReadWriteLock(), []
+
+        def write():
+            with lock.write():
+                events.append("write")
+
+        def read():
+            with lock.read():
+                events.append("read")
+
+        with lock.read():
+            # readers share the lock and the same thread may acquire it again
+            with lock.read():
+                pass
+            self.assertRaises(RuntimeError, lock.acquire_write)
+            writer = threading.Thread(target=write)
+            writer.start()
+            while lock.waiting_writers == 0:
+                pass
+            # new readers wait for the waiting writer
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(0.1)
+            events.append("release")
+        writer.join()
+        reader.join()
+        assert events == ["release", "write", "read"]
+
+        # concurrent queries create tmp tables with distinct names
+        metadata = Metadata("test_table_tmp", constant.DB_TYPE_SQL, [{"col1": "int"}])
+        with ThreadPoolExecutor(max_workers=8) as pool:
+            tables = list(pool.map(lambda _: self.tm.create_tmp_table(metadata)[0], range(16)))
+        assert all(table is not None for table in tables) and len({table.name for table in tables}) == 16
+        for table in tables:
+            self.tm.drop_table(table.name)
+
+    def test_query_lock_order(self):
+        left = self.create_table("test_table_lock_order_a", [{"col1": "int"}])
+        right = self.create_table("test_table_lock_order_b", [{"col1": "int"}])
+        assert left.insert({"col1": 1}).ok() and right.insert({"col1": 1}).ok()
+        query = json.dumps({"src_table": {"t1": left.name, "t2": right.name, "join_type": "outer", "join_condition": {"op": "==", "v1": "0::col1", "v2": "1::col1"}}})
+        results = []
+        with left.lock.read():
+            writer = threading.Thread(target=left.insert, args=({"col1": 2},))
+            writer.start()
+            while left.lock.waiting_writers == 0:
+                threading.Event().wait(0.01)
+            # the query waits for the lock of the left table behind the writer
+            reader = threading.Thread(target=lambda: results.append(QueryEngine(self.ctx).run(query)))
+            reader.start()
+            reader.join(0.1)
+            # and holds no lock of the right table meanwhile
+            right_writer = threading.Thread(target=right.insert, args=({"col1": 2},))
+            right_writer.start()
+            right_writer.join(5)
+            assert not right_writer.is_alive()
+        writer.join()
+        reader.join()
+        table, status = results[0]
+        assert status.ok()
+        assert sorted(entry[left.name + "::col1"] for chunk in table.chunk_manager.get_iter() for entry in chunk) == [1, 2]
+        self.tm.drop_table(table.name)
+
+    def test_query_stream_lock(self):
+        table = self.create_table("test_table_stream_lock", [{"col1": "int"}])
+        n = self.cfg.max_chunk_size * 3
+        assert table.insert_bulk([{"col1": i} for i in range(n)]).ok()
+        result, status = QueryEngine(self.ctx).stream(json.dumps({"src_table": table.name}))
+        assert status.ok()
+        batches = result.batches()
+        assert len(next(batches)) == self.cfg.max_chunk_size
+        # no lock is held while the batch is consumed, the same thread is able to write
+        assert table.insert({"col1": n}).ok()
+        assert table.delete(Selector({"op": "<", "v1": "0::col1", "v2": self.cfg.max_chunk_size * 2})).ok()
+        # chunks listed by the scan are not compacted until the query is closed
+        assert table.compact().ok() and table.chunk_manager.get_chunk_cnt() == 4
+        assert [entry["col1"] for batch in batches for entry in batch] == list(range(self.cfg.max_chunk_size * 2, n))
+        assert table.compact().ok() and table.chunk_manager.get_chunk_cnt() == 2
+
+        result, _ = QueryEngine(self.ctx).stream(json.dumps({"src_table": table.name}))
+        batches = result.batches()
+        next(batches)
+        # dropping the table doesn't wait for the query, which fails instead
+        assert self.tm.drop_table(table.name).ok()
+        self.assertRaises(RuntimeError, next, batches)
+
+    def test_parallel_scan(self):
+        for chunk_format in [constant.CHUNK_FORMAT_CSV, constant.CHUNK_FORMAT_COLUMNAR]:
+            table = self.create_table("test_table_parallel_scan_" + chunk_format, [{"col1": "int"}, {"col2": "str"}], chunk_format)
+            assert table.insert_bulk([{"col1": i, "col2": str(i % 5)} for i in range(self.cfg.max_chunk_size * 6 + 10)]).ok()
+            selector = Selector({"op": "&&", "v1": {"op": "==", "v1": "0::col2", "v2": "3"}, "v2": {"op": ">=", "v1": "0::col1", "v2": 100}}, [table.metadata])
+            with patch.object(config, "parallel_scan_min_chunks", 2):
+                for selector, columns in [(selector, ["col1"]), (None, None), (AlwaysTrueSelector(None), ["col2"])]:
+                    expected = [records for records in table.chunk_manager.scan(selector, columns)]
+                    assert [records for records in parallel_scan(table, selector, columns, 2)] == expected
+                    # tasks of a single chunk
+                    assert [records for records in parallel_scan(table, selector, columns, 8)] == expected
+            # rows appended after the chunk file is taken are not scanned, e.g. by a worker while the table is written
+            cm = table.chunk_manager
+            chunk = cm.get_chunk_file(cm.get_last_chunk_index())
+            expected = cm.reader.scan(chunk)
+            assert table.insert({"col1": -1, "col2": "x"}).ok()
+            assert cm.reader.scan(chunk) == expected and len(cm.reader.scan(cm.get_chunk_file(cm.get_last_chunk_index()))) == len(expected) + 1
+
+    def test_external_sort(self):
+        metadata = Metadata("test_table_external_sort", constant.DB_TYPE_SQL, [{"col1": "int"}, {"col2": "str"}])
+        n = self.cfg.max_chunk_size * 6
+        records = [{"col1": random.randint(0, n), "col2": str(i)} for i in range(n)]
+        batches = [records[i:i + 100] for i in range(0, n, 100)]
+
+        # runs generated by replacement selection are about twice the memory budget
+        sorter = ExternalSorter(metadata, lambda record: record["col1"], memory_budget=self.cfg.max_chunk_size // 2)
+        runs = sorter.generate_runs(records[:self.cfg.max_chunk_size // 2], iter(records[self.cfg.max_chunk_size // 2:]))
+        assert 4 <= len(runs) <= 8
+        for run in runs:
+            values = [entry["col1"] for entry in iterate_records(run)]
+            assert values == sorted(values)
+            self.tm.drop_table(run.name)
+        # sorted input is a single run
+        sorted_records = sorted(records, key=lambda record: record["col1"])
+        runs = sorter.generate_runs(sorted_records[:self.cfg.max_chunk_size // 2], iter(sorted_records[self.cfg.max_chunk_size // 2:]))
+        assert len(runs) == 1
+        self.tm.drop_table(runs[0].name)
+
+        for is_asc, fan_in in [(True, 2), (False, None)]:
+            sorter = ExternalSorter(metadata, make_sort_key(["col1"], [is_asc]), self.cfg.max_chunk_size // 2, fan_in)
+            table_cnt = len(self.tm.table_map)
+            res = [entry for batch in sorter.sort(iter(batches)) for entry in batch]
+            assert [entry["col1"] for entry in res] == sorted([entry["col1"] for entry in records], reverse=not is_asc)
+            assert sorted(entry["col2"] for entry in res) == sorted(entry["col2"] for entry in records)
+            # runs are dropped once merged
+            assert len(self.tm.table_map) == table_cnt
+            # or when the caller stops early
+            sorted_batches = sorter.sort(iter(batches))
+            next(sorted_batches)
+            sorted_batches.close()
+            assert len(self.tm.table_map) == table_cnt
+
+        # or when the input fails
+        def failing_batches():
+            yield from batches
+            raise RuntimeError("failed to read input")
+        for fan_in in [2, None]:
+            sorter = ExternalSorter(metadata, make_sort_key(["col1"], [True]), self.cfg.max_chunk_size // 2, fan_in)
+            table_cnt = len(self.tm.table_map)
+            self.assertRaises(RuntimeError, lambda: list(sorter.sort(failing_batches())))
+            assert len(self.tm.table_map) == table_cnt
+
+    def test_multi_column_sort(self):
+        # strings sharing prefixes check the inverted encoding of strings in descending order
+        values = ["", "a", "ab", "abc", "b", "ba", "\u00e9", "z"]
+        records = [{"col1": i % 3, "col2": values[i % len(values)], "col3": i} for i in range(self.cfg.max_chunk_size * 3)]
+        random.shuffle(records)
+        table = self.create_table("test_table_multi_column_sort", [{"col1": "int"}, {"col2": "str"}, {"col3": "int"}])
+        assert table.insert_bulk(records).ok()
+
+        expected = sorted(records, key=lambda record: record["col3"], reverse=True)
+        expected = sorted(expected, key=lambda record: record["col2"], reverse=True)
+        expected = sorted(expected, key=lambda record: record["col1"])
+        options = [SortOption("col1"), SortOption("col2", False), SortOption("col3", False)]
+        for memory_budget in [config.memory_budget, self.cfg.max_chunk_size // 2]:
+            res = TableManipulator.sort(table, options, memory_budget)
+            assert [entry for chunk in res.chunk_manager.get_iter() for entry in chunk] == expected
+            assert res.sorted_by == ["col1"]
+            self.tm.drop_table(res.name)
+
+            plan = SortOp(ScanOp(table, AlwaysTrueSelector(None)), options, memory_budget=memory_budget)
+            assert [entry for batch in plan.batches() for entry in batch] == expected
+            assert plan.get_sorted_by() == ["col1"]
+
+    def test_pipeline(self):
+        table = self.create_table("test_table_pipeline", [{"col1": "int"}, {"col2": "str"}])
+        n = self.cfg.max_chunk_size * 3
+        status = table.insert_bulk([{"col1": (i * 7) % n, "col2": "a" if i % 2 else "b"} for i in range(n)])
+        assert status.ok()
+
+        # sorting more records than the memory budget spills onto the disk
+        scan = ScanOp(table, Selector({"op": "==", "v1": "0::col2", "v2": "a"}))
+        plan = ProjectOp(SortOp(scan, [SortOption("col1", False)], memory_budget=self.cfg.max_chunk_size), ["col1"])
+        tmp_table_cnt = self.tm.tmp_table_cnt
+        res_table = materialize(plan)
+        res = [entry for chunk in res_table.chunk_manager.get_iter() for entry in chunk]
+        assert res == [{"col1": v} for v in sorted([(i * 7) % n for i in range(n) if i % 2], reverse=True)]
+        assert self.tm.tmp_table_cnt > tmp_table_cnt + 1
+
+        # limit stops pulling from the scan as soon as enough records are produced
+        with patch.object(table.chunk_manager.reader, "scan", wraps=table.chunk_manager.reader.scan) as scan_chunk:
+            res = [entry for batch in LimitOp(ScanOp(table), 5, self.cfg.max_chunk_size - 2).batches() for entry in batch]
+            assert [entry["col1"] for entry in res] == [(i * 7) % n for i in range(self.cfg.max_chunk_size - 2, self.cfg.max_chunk_size + 3)]
+            assert len(scan_chunk.call_args_list) == 2
+
+    def test_hash_aggregation(self):
+        table = self.create_table("test_table_hash_aggregation", [{"col1": "int"}, {"col2": "str"}, {"col3": "float"}])
+        n = self.cfg.max_chunk_size * 3
+        records = [{"col1": i % 97, "col2": "a" if i % 3 else "b", "col3": float(i)} for i in range(n)]
+        status = table.insert_bulk(records)
+        assert status.ok()
+
+        expected = {}
+        for entry in records:
+            expected.setdefault((entry["col1"], entry["col2"]), []).append(entry["col3"])
+        option = GroupByOption(["0::col1", "0::col2"], [ReduceOption("0::col3", ReduceOperation.SUM), ReduceOption("0::col3__COUNT", ReduceOperation.COUNT)])
+        # fewer groups than the memory budget, result is sorted by keys; otherwise groups are spilled into partitions
+        for memory_budget in [self.cfg.max_chunk_size, 10]:
+            new_table = TableManipulator.group_by(table, option, memory_budget)
+            assert new_table.metadata.get_all_field_names() == ["col1", "col2", "col3__SUM", "col3__COUNT"]
+            res = [entry for chunk in new_table.chunk_manager.get_iter() for entry in chunk]
+            assert len(res) == len(expected)
+            assert {(entry["col1"], entry["col2"]): (entry["col3__SUM"], entry["col3__COUNT"]) for entry in res} == \
+                   {key: (sum(values), len(values)) for key, values in expected.items()}
+            if memory_budget > len(expected):
+                assert [(entry["col1"], entry["col2"]) for entry in res] == sorted(expected)
+
+        # spilled partitions are dropped when the caller stops early
+        table_cnt = len(self.tm.table_map)
+        aggregator = HashAggregator(table.metadata, GroupByOption(["col1", "col2"], [ReduceOption("col3", ReduceOperation.SUM)]), 10)
+        batches = aggregator.aggregate(table.chunk_manager.get_iter())
+        # groups in memory, then groups of the first partition
+        next(batches), next(batches)
+        assert len(self.tm.table_map) > table_cnt
+        batches.close()
+        assert len(self.tm.table_map) == table_cnt
+
+    def test_join(self):
+        left = self.create_table("test_table_join_left", [{"col1": "int"}, {"col2": "str"}])
+        right = self.create_table("test_table_join_right", [{"col1": "int"}, {"col3": "int"}])
+        n = self.cfg.max_chunk_size * 2
+        assert left.insert_bulk([{"col1": i % 300, "col2": str(i)} for i in range(n)]).ok()
+        assert right.insert_bulk([{"col1": (i * 7) % 400, "col3": i} for i in range(n)]).ok()
+
+        def join(selector, memory_budget=self.cfg.memory_budget):
+            new_table = TableManipulator.join(left, right, selector, "outer", memory_budget)
+            return sorted((entry["test_table_join_left::col2"], entry["test_table_join_right::col3"]) for chunk in new_table.chunk_manager.get_iter() for entry in chunk)
+
+        equi = {"op": "==", "v1": "1::col1", "v2": "0::col1"}
+        residual = {"op": "&&", "v1": equi, "v2": {"op": "<", "v1": "1::col3", "v2": 1000}}
+        left_records = [entry for chunk in left.chunk_manager.get_iter() for entry in chunk]
+        right_records = [entry for chunk in right.chunk_manager.get_iter() for entry in chunk]
+        expected = sorted((l["col2"], r["col3"]) for l in left_records for r in right_records if l["col1"] == r["col1"])
+        expected_residual = sorted((l["col2"], r["col3"]) for l in left_records for r in right_records if l["col1"] == r["col1"] and r["col3"] < 1000)
+
+        # in-memory hash join and grace hash join with spilled partitions
+        with patch.object(Selector, "is_match", wraps=Selector.is_match, autospec=True) as is_match:
+            assert join(Selector(equi)) == expected
+            assert is_match.call_count == 0
+        assert join(Selector(equi), memory_budget=100) == expected
+        assert join(Selector(residual), memory_budget=100) == expected_residual
+        # spilled partitions are dropped when the caller stops early
+        table_cnt = len(self.tm.table_map)
+        batches = JoinOp(ScanOp(left), left.name, right, Selector(equi), 100).batches()
+        next(batches)
+        assert len(self.tm.table_map) > table_cnt
+        batches.close()
+        assert len(self.tm.table_map) == table_cnt
+
+        # sort-merge join on sorted tables
+        sorted_left, sorted_right = TableManipulator.sort(left, [SortOption("0::col1")]), TableManipulator.sort(right, [SortOption("0::col1")])
+        assert sorted_left.sorted_by == ["col1"] and sorted_right.sorted_by == ["col1"]
+        with patch("app.common.table.join.HashJoiner.join") as hash_join:
+            new_table = TableManipulator.join(sorted_left, sorted_right, Selector(residual), "outer")
+            assert not hash_join.called
+        res = sorted((entry[sorted_left.name + "::col2"], entry[sorted_right.name + "::col3"]) for chunk in new_table.chunk_manager.get_iter() for entry in chunk)
+        assert res == expected_residual
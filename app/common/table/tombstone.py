@@ -0,0 +1,79 @@
+import os
+
+import constant
+
+
+class DeletionBitmap:
+    """
+    offsets of deleted rows in a chunk, one bit per row
+    """
+
+    def __init__(self, data: bytes = b""):
+        self.data = bytearray(data)
+        self.cnt = sum(bin(byte).count("1") for byte in self.data)
+
+    def __contains__(self, offset: int) -> bool:
+        i = offset >> 3
+        return i < len(self.data) and self.data[i] >> (offset & 7) & 1 == 1
+
+    def __len__(self) -> int:
+        return self.cnt
+
+    def add(self, offset: int):
+        i = offset >> 3
+        if i >= len(self.data):
+            self.data += bytes(i + 1 - len(self.data))
+        if not self.data[i] >> (offset & 7) & 1:
+            self.data[i] |= 1 << (offset & 7)
+            self.cnt += 1
+
+    def filter(self, records: list) -> list:
+        return [record for offset, record in enumerate(records) if offset not in self]
+
+
+class TombstoneManager:
+    """
+    deletion bitmaps of chunks, each one is stored in a small sidecar file <file id>.del under the table dir,
+    they are looked up by file ids of chunks (see ChunkManifest.get_file_id)
+    rows are only marked as deleted, chunks keep their rows (and offsets) until they are compacted
+    bitmaps are loaded lazily, the manifest tells which chunks have deleted rows
+    """
+
+    def __init__(self, table_path: str):
+        self.table_path = table_path
+        self.bitmaps: dict[int, DeletionBitmap] = {}
+
+    def get_path(self, file_id: int) -> str:
+        return os.path.join(self.table_path, str(file_id) + constant.TOMBSTONE_EXT)
+
+    def get(self, file_id: int) -> DeletionBitmap:
+        bitmap = self.bitmaps.get(file_id)
+        if bitmap is None:
+            path = self.get_path(file_id)
+            data = b""
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    data = f.read()
+            bitmap = DeletionBitmap(data)
+            self.bitmaps[file_id] = bitmap
+        return bitmap
+
+    def mark(self, file_id: int, offsets: list[int]) -> DeletionBitmap:
+        bitmap = self.get(file_id)
+        for offset in offsets:
+            bitmap.add(offset)
+        # write to a temporary file then rename, readers never see a partially written file
+        tmp_path = self.get_path(file_id) + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(bitmap.data)
+        os.replace(tmp_path, self.get_path(file_id))
+        return bitmap
+
+    def remove(self, file_id: int):
+        self.bitmaps.pop(file_id, None)
+        if os.path.exists(self.get_path(file_id)):
+            os.remove(self.get_path(file_id))
+
+    # forget loaded bitmaps, e.g. after all chunks are removed and file ids start over
+    def reset(self):
+        self.bitmaps = {}
@@ -0,0 +1,109 @@
+import json
+import os
+import threading
+
+# operations recorded in the log
+WAL_OP_INSERT = "insert"
+WAL_OP_UPDATE = "update"
+WAL_OP_DELETE = "delete"
+# records of a bulk load are not logged, an interrupted bulk load is rolled back instead
+WAL_OP_BULK_LOAD = "bulk_load"
+# chunks are rewritten from their own rows, only sidecars of an interrupted compaction are rebuilt
+WAL_OP_COMPACT = "compact"
+
+
+def fsync_path(path: str):
+    """
+    flush a file onto the disk, or a dir so that files created, renamed or removed in it are kept
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """
+    redo log of insert, update and delete operations of a table, stored as newline-delimited json entries
+    an entry gets an increasing lsn and is synced before the operation is applied, the manifest records the lsn of the
+    last applied operation, so entries after it are replayed on restart
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = None
+        self.lsn = 0
+        self.lock = threading.Lock()
+
+    def read_entries(self, after_lsn: int = 0) -> list[dict]:
+        """
+        :return: entries with lsn greater than after_lsn, a partially written entry at the end is ignored
+        """
+        return self._read(after_lsn)[0]
+
+    # entries with lsn greater than after_lsn and the size of the file up to the end of the last complete entry
+    def _read(self, after_lsn: int) -> (list[dict], int):
+        if not os.path.exists(self.path):
+            return [], 0
+        entries, end = [], 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                # an entry without the newline was never synced
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                end += len(line)
+                if entry["lsn"] > after_lsn:
+                    entries.append(entry)
+        return entries, end
+
+    def open(self, lsn: int):
+        """
+        :param lsn: lsn of the last applied operation, new entries are numbered after it and after all entries in the file
+        """
+        entries, end = self._read(lsn)
+        self.lsn = max([lsn] + [entry["lsn"] for entry in entries])
+        self.file = open(self.path, "ab")
+        # drop a partially written entry, or entries appended after it could never be read
+        if self.file.tell() > end:
+            self.file.truncate(end)
+
+    def is_open(self) -> bool:
+        return self.file is not None
+
+    def append(self, entry: dict) -> int:
+        """
+        write the entry without syncing it, entries appended together are synced by a single sync
+        :return: lsn of the entry
+        """
+        with self.lock:
+            self.lsn += 1
+            entry["lsn"] = self.lsn
+            self.file.write(json.dumps(entry).encode("utf-8") + b"\n")
+            return self.lsn
+
+    def sync(self):
+        with self.lock:
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def get_size(self) -> int:
+        with self.lock:
+            return 0 if self.file is None else self.file.tell()
+
+    # remove all entries, which should have been applied and checkpointed
+    def truncate(self):
+        with self.lock:
+            self.file.seek(0)
+            self.file.truncate()
+            self.file.flush()
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
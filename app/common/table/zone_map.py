@@ -0,0 +1,228 @@
+import json
+import os
+
+import constant
+from app.common.table.field import FieldNameProcessor
+
+# types whose min/max are meaningful, a column with mixed types has no min/max
+_ORDERED_TYPES = {int: "int", float: "float", str: "str", bool: "bool"}
+_TYPE_NAMES = {v: k for k, v in _ORDERED_TYPES.items()}
+
+# when the column is on the right side of the operator, the operator is mirrored to keep the column on the left side
+_MIRRORED_OPS = {
+    constant.OP_NAME_LT: constant.OP_NAME_GT,
+    constant.OP_NAME_LE: constant.OP_NAME_GE,
+    constant.OP_NAME_GT: constant.OP_NAME_LT,
+    constant.OP_NAME_GE: constant.OP_NAME_LE,
+    constant.OP_NAME_EQ: constant.OP_NAME_EQ,
+    constant.OP_NAME_NE: constant.OP_NAME_NE,
+}
+
+
+def _get_column_ref(operand) -> str | None:
+    # same rule as ExprTree: a string with "::" is a reference, only references to the first table are considered
+    if type(operand) is not str or constant.QUERY_FIELD_REF_SYM not in operand:
+        return None
+    if FieldNameProcessor.get_outer_prefix(operand) != "0":
+        return None
+    return FieldNameProcessor.remove_outer_prefix(operand)
+
+
+def _is_literal(operand) -> bool:
+    return type(operand) is not dict and _get_column_ref(operand) is None
+
+
+def parse_comparison(expression: any) -> tuple[str, str, object] | None:
+    """
+    parse a comparison between a column and a literal, e.g. {"op": "<", "v1": 3, "v2": "0::a"} -> ("a", ">", 3)
+    :return: (column, op, literal) with the column on the left side, None if the expression is not such a comparison
+    """
+    if type(expression) is not dict or expression.get(constant.QUERY_OP_KEY) not in _MIRRORED_OPS:
+        return None
+    op = expression.get(constant.QUERY_OP_KEY)
+    v1, v2 = expression.get(constant.QUERY_VAR1_KEY), expression.get(constant.QUERY_VAR2_KEY)
+    column, literal = _get_column_ref(v1), v2
+    if column is None or not _is_literal(v2):
+        column, literal, op = _get_column_ref(v2), v1, _MIRRORED_OPS[op]
+        if column is None or not _is_literal(v1):
+            return None
+    return column, op, literal
+
+
+class ColumnStatistics:
+
+    def __init__(self, value_type: str | None, min_value, max_value, null_cnt: int):
+        self.value_type = value_type  # None if the column has no value or mixed types
+        self.min = min_value
+        self.max = max_value
+        self.null_cnt = null_cnt
+
+    def has_range(self) -> bool:
+        return self.value_type is not None
+
+    def may_match(self, op: str, literal) -> bool:
+        # rows with null would fail to be compared, be conservative
+        if not self.has_range() or self.null_cnt != 0:
+            return True
+        # comparing values of different types fails at runtime, keep the behavior unchanged
+        if type(literal) is not _TYPE_NAMES[self.value_type]:
+            return True
+
+        if op == constant.OP_NAME_EQ:
+            return self.min <= literal <= self.max
+        if op == constant.OP_NAME_NE:
+            return not (self.min == literal == self.max)
+        if op == constant.OP_NAME_LT:
+            return self.min < literal
+        if op == constant.OP_NAME_LE:
+            return self.min <= literal
+        if op == constant.OP_NAME_GT:
+            return self.max > literal
+        if op == constant.OP_NAME_GE:
+            return self.max >= literal
+        return True
+
+    def to_json_obj(self) -> dict:
+        return {"type": self.value_type, "min": self.min, "max": self.max, "null_cnt": self.null_cnt}
+
+    @staticmethod
+    def from_json_obj(obj: dict) -> 'ColumnStatistics':
+        return ColumnStatistics(obj["type"], obj["min"], obj["max"], obj["null_cnt"])
+
+    @staticmethod
+    def build(values: list) -> 'ColumnStatistics':
+        non_null = [v for v in values if v is not None]
+        null_cnt = len(values) - len(non_null)
+        types = {type(v) for v in non_null}
+        if len(types) != 1 or next(iter(types)) not in _ORDERED_TYPES:
+            return ColumnStatistics(None, None, None, null_cnt)
+        return ColumnStatistics(_ORDERED_TYPES[next(iter(types))], min(non_null), max(non_null), null_cnt)
+
+    @staticmethod
+    def merge(a: 'ColumnStatistics', b: 'ColumnStatistics') -> 'ColumnStatistics':
+        null_cnt = a.null_cnt + b.null_cnt
+        if not a.has_range() or not b.has_range() or a.value_type != b.value_type:
+            return ColumnStatistics(None, None, None, null_cnt)
+        return ColumnStatistics(a.value_type, min(a.min, b.min), max(a.max, b.max), null_cnt)
+
+
+class ChunkStatistics:
+    """
+    min/max/null count of every column in one chunk, which is used to skip chunks when filtering
+    a column missing in some records (nosql) is counted as null
+    """
+
+    def __init__(self, row_cnt: int, columns: dict[str, ColumnStatistics]):
+        self.row_cnt = row_cnt
+        self.columns = columns
+
+    @staticmethod
+    def build(chunk: list[dict[str, object]]) -> 'ChunkStatistics':
+        names = {}
+        for record in chunk:
+            names.update(dict.fromkeys(record))
+        return ChunkStatistics(len(chunk), {name: ColumnStatistics.build([record.get(name) for record in chunk]) for name in names})
+
+    def merge(self, other: 'ChunkStatistics') -> 'ChunkStatistics':
+        """
+        statistics of rows of both chunks, e.g. after appending rows to a chunk
+        """
+        if self.row_cnt == 0:
+            return other
+        if other.row_cnt == 0:
+            return self
+        columns = {}
+        for name in list(self.columns) + [name for name in other.columns if name not in self.columns]:
+            # a column missing in one of the chunks is null in all its rows
+            a = self.columns.get(name, ColumnStatistics(None, None, None, self.row_cnt))
+            b = other.columns.get(name, ColumnStatistics(None, None, None, other.row_cnt))
+            columns[name] = ColumnStatistics.merge(a, b)
+        return ChunkStatistics(self.row_cnt + other.row_cnt, columns)
+
+    def to_json_obj(self) -> dict:
+        return {"row_cnt": self.row_cnt, "columns": {name: stats.to_json_obj() for name, stats in self.columns.items()}}
+
+    @staticmethod
+    def from_json_obj(obj: dict) -> 'ChunkStatistics':
+        return ChunkStatistics(obj["row_cnt"], {name: ColumnStatistics.from_json_obj(stats) for name, stats in obj["columns"].items()})
+
+    def may_match(self, expression: any) -> bool:
+        """
+        check whether any row of this chunk may satisfy the expression
+        only &&, || and comparisons between a column and a literal are used for pruning, anything else may match
+        :param expression: expression object in json format, with relative prefix
+        :return: False only when no row in this chunk can satisfy the expression
+        """
+        if self.row_cnt == 0:
+            return False
+        if type(expression) is not dict:
+            return True
+
+        op = expression.get(constant.QUERY_OP_KEY)
+        if op == constant.OP_NAME_AND:
+            return self.may_match(expression.get(constant.QUERY_VAR1_KEY)) and self.may_match(expression.get(constant.QUERY_VAR2_KEY))
+        if op == constant.OP_NAME_OR:
+            return self.may_match(expression.get(constant.QUERY_VAR1_KEY)) or self.may_match(expression.get(constant.QUERY_VAR2_KEY))
+        if op not in _MIRRORED_OPS:
+            return True
+
+        comparison = parse_comparison(expression)
+        if comparison is None:
+            return True
+        column, op, literal = comparison
+        if column not in self.columns:
+            return True
+        return self.columns[column].may_match(op, literal)
+
+
+class ZoneMap:
+    """
+    per-chunk statistics of a table, persisted in a sidecar file under the table dir
+    chunks without statistics (e.g. tables created before zone maps were introduced) are never skipped
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.chunks: dict[int, ChunkStatistics] = {}
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r") as f:
+            obj = json.load(f)
+        self.chunks = {int(idx): ChunkStatistics.from_json_obj(stats) for idx, stats in obj.items()}
+
+    def save(self):
+        if not os.path.exists(os.path.dirname(self.path)):
+            return
+        # write to a temporary file then rename, readers never see a partially written file
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({idx: stats.to_json_obj() for idx, stats in self.chunks.items()}, f)
+        os.replace(tmp_path, self.path)
+
+    def set_chunk(self, chunk_idx: int, chunk: list[dict[str, object]]):
+        self.chunks[chunk_idx] = ChunkStatistics.build(chunk)
+
+    def append_to_chunk(self, chunk_idx: int, records: list[dict[str, object]]):
+        # statistics of a chunk without statistics can't be refreshed without loading the whole chunk, it's never skipped anyway
+        if chunk_idx in self.chunks:
+            self.chunks[chunk_idx] = self.chunks[chunk_idx].merge(ChunkStatistics.build(records))
+
+    def get_chunk(self, chunk_idx: int) -> ChunkStatistics | None:
+        return self.chunks.get(chunk_idx)
+
+    # same as ChunkManifest.replace_chunks
+    def replace_chunks(self, start: int, end: int, chunks: list[list[dict[str, object]]]):
+        shift = (end - start) - len(chunks)
+        new_stats = {idx if idx < start else idx - shift: stats for idx, stats in self.chunks.items() if idx < start or idx >= end}
+        for i, chunk in enumerate(chunks):
+            new_stats[start + i] = ChunkStatistics.build(chunk)
+        self.chunks = new_stats
+
+    def clear(self):
+        self.chunks = {}
+
+    def may_match(self, chunk_idx: int, expression: any) -> bool:
+        stats = self.chunks.get(chunk_idx)
+        return stats is None or stats.may_match(expression)
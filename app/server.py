@@ -1,12 +1,17 @@
+import io
 import sys
-from flask import Flask, g, request, send_file
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Response, g, request
+from werkzeug.serving import BaseWSGIServer
 
 from app.common.error.status import Status, START_FAILED, OK
 from app.common.query.query_engine import QueryEngine
+from app.common.table.compactor import Compactor
 from app.common.table.table_manager import TableManager, get_table_manager
 from app.services.database.nosql.db_factory import DBFactory as NosqlDBFactory
 from app.services.database.sql.db_factory import DBFactory as SQLDBFactory
 import config
+import constant
 import logger
 from app.common.query.result import QueryResult
 from app.common.context import context
@@ -28,13 +33,21 @@ def get_file():
         return "query result is empty for query {} ".format(query), 200
 
     result = cast(QueryResult, result)
-    g.ctx.logger.info("result dat can be found under {}".format(result.get_result_file_path()))
+    db = g.ctx.get_db()
+    # the body is sent chunk by chunk while the query runs, tmp tables of the query are dropped once it completes
+    return Response(db.format_output(result), mimetype=db.get_output_mimetype())
 
-    return send_file(result.get_result_file_path(), as_attachment=True, mimetype='text/plain')
 
-
-@app.route('/insert')
+@app.route('/insert', methods=['GET', 'POST'])
 def insert():
+    # ndjson or csv bodies are read line by line, e.g. POST /insert?table_name=t with Content-Type: application/x-ndjson
+    if request.mimetype in [constant.INSERT_STREAM_NDJSON_MIMETYPE, constant.INSERT_STREAM_CSV_MIMETYPE]:
+        body = io.TextIOWrapper(request.stream, encoding="utf-8", newline="")
+        cnt, status = g.ctx.get_db().on_insert_stream(request.args.get(constant.INSERT_TABLE_NAME_KEY, ""), body, request.mimetype)
+        if not status.ok():
+            return "failed after #{} records are inserted: {}".format(cnt, status.msg), 400
+        return "#{} records are inserted".format(cnt), 200
+
     status = g.ctx.get_db().on_insert(request.json)
     if not status.ok():
         return status.msg, 400
@@ -73,6 +86,14 @@ def create():
     return "ok", 200
 
 
+@app.route('/create_index')
+def create_index():
+    status = g.ctx.get_db().on_create_index(request.json)
+    if not status.ok():
+        return status.msg, 400
+    return "ok", 200
+
+
 def check_args():
     if len(sys.argv) != 2 or sys.argv[1] not in config.supported_database_types:
         print("Usage: python server.py <database_type>\nSupported types are: {}".format(config.supported_database_types))
@@ -98,6 +119,27 @@ def start_db(ctx: Context) -> Status:
     return OK
 
 
+class ThreadPoolWSGIServer(BaseWSGIServer):
+    """
+    serve requests with a bounded pool of threads, queries run concurrently while writes serialize per table (see Table.lock)
+    """
+
+    def __init__(self, host: str, port: int, wsgi_app, threads: int):
+        super().__init__(host, port, wsgi_app)
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+
+    def process_request(self, request, client_address):
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+
 @app.before_request
 def before_request():
     # global context which could be used in entire life cycle
@@ -116,4 +158,8 @@ if __name__ == '__main__':
     ctx.set_query_engine(qe)
 
     start_db(ctx)
-    app.run(port=ctx.get_cfg().get_port())
+    # chunks with deleted records are compacted in the background while requests are served
+    Compactor(tm).start()
+    server = ThreadPoolWSGIServer("127.0.0.1", ctx.get_cfg().get_port(), app, config.server_threads)
+    ctx.logger.info("serving on port {} with {} threads".format(ctx.get_cfg().get_port(), config.server_threads))
+    server.serve_forever()
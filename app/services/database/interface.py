@@ -2,15 +2,16 @@ import csv
 import json
 import os
 import tempfile
+from typing import IO, Iterator
 
 import constant
 
 from app.common.context.context import Context
 from app.common.error.status import Status, START_FAILED, OK, INTERNAL, INVALID_ARGUMENT
 from app.common.query.result import QueryResult
+from app.common.table.csv_adapter import get_converter
 from app.common.table.metadata import load_from_json
 from app.common.table.selector import Selector
-from app.common.table.table import Table
 
 
 class DBInterface:
@@ -35,11 +36,12 @@ class DBInterface:
         if not self.started:
             return None, START_FAILED
 
-        table, status = self.ctx.qe.run(query)
+        # the query runs while the result is streamed, see format_output
+        result, status = self.ctx.qe.stream(query)
         if not status.ok():
             return None, INTERNAL
 
-        return QueryResult(self.format_output(table, self.ctx.cfg.get_tables_dir())), OK
+        return result, OK
 
     def on_insert(self, query_str: str) -> Status:
         query = json.loads(query_str)
@@ -60,6 +62,69 @@ class DBInterface:
 
         return table.insert_bulk(records)
 
+    def on_insert_stream(self, table_name: str, body: IO[str], mimetype: str) -> (int, Status):
+        """
+        insert records read from the body line by line, in batches of a chunk, the body is never fully loaded
+        :param body: newline-delimited json objects, or csv rows with a header line of field names
+        :return: number of inserted records, records before a malformed line are kept
+        """
+        table = self.ctx.get_table_manager().table_map.get(table_name)
+        if table is None:
+            self.logger.error("unable to find table {} for streaming insertion".format(table_name))
+            return 0, INVALID_ARGUMENT
+
+        if mimetype == constant.INSERT_STREAM_NDJSON_MIMETYPE:
+            records = (self.convert_input_record(json.loads(line)) for line in body if line.strip())
+        elif mimetype == constant.INSERT_STREAM_CSV_MIMETYPE and self.cfg.is_sql():
+            reader = csv.reader(body)
+            field_names = next(reader, [])
+            if any(not table.metadata.is_field_existed(name) for name in field_names):
+                self.logger.error("unknown fields in csv header {} for table {}".format(field_names, table_name))
+                return 0, INVALID_ARGUMENT
+            missing = [name for name in table.metadata.get_all_field_names() if name not in field_names]
+            if len(missing):
+                self.logger.error("missing fields {} in csv header {} for table {}".format(missing, field_names, table_name))
+                return 0, INVALID_ARGUMENT
+            converters = [get_converter(table.metadata.get_field_type(name)) for name in field_names]
+            records = ({name: converter(value) for name, converter, value in zip(field_names, converters, row)} for row in reader if len(row))
+        else:
+            self.logger.error("unsupported body {} for streaming insertion".format(mimetype))
+            return 0, INVALID_ARGUMENT
+
+        cnt = 0
+
+        def batches():
+            nonlocal cnt
+            batch = []
+            try:
+                for record in records:
+                    batch.append(record)
+                    if len(batch) == self.cfg.get_max_chunk_size():
+                        yield batch
+                        cnt += len(batch)
+                        batch = []
+            except (ValueError, TypeError):
+                # records parsed before the malformed line are inserted before the error is raised
+                if len(batch):
+                    yield batch
+                    cnt += len(batch)
+                raise
+            if len(batch):
+                yield batch
+                cnt += len(batch)
+
+        try:
+            status = table.bulk_load(batches())
+        except (ValueError, TypeError) as e:
+            self.logger.error("failed to parse records for table {} after #{} records, due to {}".format(table_name, cnt, e))
+            return cnt, INVALID_ARGUMENT
+        self.logger.info("#{} records are inserted into table {}".format(cnt, table_name))
+        return cnt, status
+
+    # convert a record of the request into the stored format
+    def convert_input_record(self, record: dict) -> dict:
+        return record
+
     def on_update(self, query_str: str) -> Status:
         query = json.loads(query_str)
         if constant.UPDATE_TABLE_NAME_KEY not in query or constant.UPDATE_EXPR_KEY not in query or constant.UPDATE_NEW_RECORD_KEY not in query:
@@ -70,7 +135,7 @@ class DBInterface:
         if table is None:
             self.logger.error("try to update on not existed table {}".format(table_name))
             return INVALID_ARGUMENT
-        return table.update(Selector(expr), record)
+        return table.update(Selector(expr, [table.metadata]), record)
 
     def on_delete(self, query_str: str) -> Status:
         query = json.loads(query_str)
@@ -82,7 +147,7 @@ class DBInterface:
         if table is None:
             self.logger.error("try to delete on not existed table {}".format(table_name))
             return INVALID_ARGUMENT
-        return table.delete(Selector(expr))
+        return table.delete(Selector(expr, [table.metadata]))
 
     def on_drop(self, query_str: str) -> Status:
         query = json.loads(query_str)
@@ -119,11 +184,24 @@ class DBInterface:
         self.logger.info("table {} is successfully created by q {}".format(table.name, query))
         return OK
 
-    def format_output(self, table: Table, tables_dir: str) -> str:
-        return ""
+    def on_create_index(self, query_str: str) -> Status:
+        query = json.loads(query_str)
+        if constant.CREATE_INDEX_TABLE_NAME_KEY not in query or constant.CREATE_INDEX_COLUMN_KEY not in query:
+            self.logger.error("missing necessary params in query {} ".format(query))
+            return INVALID_ARGUMENT
+        table_name, column = query[constant.CREATE_INDEX_TABLE_NAME_KEY], query[constant.CREATE_INDEX_COLUMN_KEY]
+        table = self.ctx.get_table_manager().get_table(table_name)
+        if table is None:
+            self.logger.error("try to create index on not existed table {}".format(table_name))
+            return INVALID_ARGUMENT
+        return table.create_index(column)
+
+    # pieces of the response body, produced batch by batch while the result is consumed
+    def format_output(self, result: QueryResult) -> Iterator[str]:
+        return iter([])
 
-    def merge_files(self, data_dir: str, output_file_path: str):
-        return
+    def get_output_mimetype(self) -> str:
+        return "text/plain"
 
     def format_input(self, query_str: str) -> str:
         return ""
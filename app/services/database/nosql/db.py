@@ -1,32 +1,24 @@
 import json
-import os
-import tempfile
+from typing import Iterator
 
 import constant
 
 from app.common.error.status import Status, INVALID_ARGUMENT, OK
+from app.common.query.result import QueryResult
 from app.common.table.selector import Selector
-from app.common.table.table import Table
 from app.services.database.interface import DBInterface
 from app.services.database.nosql.converter.converter import NestedJsonConverter
 
 
 class DB(DBInterface):
 
-    def merge_files(self, data_dir: str, output_file_path: str):
-        with open(output_file_path, 'w') as output_file:
-            for file_name in os.listdir(data_dir):
-                with open(os.path.join(data_dir, file_name), 'r') as input_file:
-                    json_list = json.load(input_file)
-                    for obj in json_list:
-                        json.dump(NestedJsonConverter.nest_to_json_obj(obj), output_file, indent=4)
-                        output_file.write('\n')
-
-    def format_output(self, table: Table, tables_dir: str) -> str:
-        table_path = os.path.join(tables_dir, table.name)
-        temp_file = tempfile.NamedTemporaryFile(delete=False, mode='w', newline='', suffix=".json")
-        self.merge_files(table_path, temp_file.name)
-        return temp_file.name
+    # one json object per line (ndjson), one piece for each batch of the result
+    def format_output(self, result: QueryResult) -> Iterator[str]:
+        for batch in result.batches():
+            yield "".join(json.dumps(NestedJsonConverter.nest_to_json_obj(obj)) + "\n" for obj in batch)
+
+    def get_output_mimetype(self) -> str:
+        return "application/x-ndjson"
 
     def on_insert(self, query_str: str) -> Status:
         query = json.loads(query_str)
@@ -47,6 +39,9 @@ class DB(DBInterface):
 
         return table.insert_bulk([NestedJsonConverter.flatten_json_obj(record) for record in records])
 
+    def convert_input_record(self, record: dict) -> dict:
+        return NestedJsonConverter.flatten_json_obj(record)
+
     def on_update(self, query_str: str) -> Status:
         query = json.loads(query_str)
         if constant.UPDATE_TABLE_NAME_KEY not in query or constant.UPDATE_EXPR_KEY not in query or constant.UPDATE_NEW_RECORD_KEY not in query:
@@ -57,4 +52,4 @@ class DB(DBInterface):
         if table is None:
             self.logger.error("try to update on not existed table {}".format(table_name))
             return INVALID_ARGUMENT
-        return table.update(Selector(expr), NestedJsonConverter.flatten_json_obj(record))
+        return table.update(Selector(expr, [table.metadata]), NestedJsonConverter.flatten_json_obj(record))
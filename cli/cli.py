@@ -39,7 +39,7 @@ def print_file(file_name: str):
         print("\n")
 
 
-supported_apis = [constant.REQUEST_KEY_QUERY, constant.REQUEST_KEY_CREATE, constant.REQUEST_KEY_DROP, constant.REQUEST_KEY_DELETE, constant.REQUEST_KEY_UPDATE, constant.REQUEST_KEY_INSERT]
+supported_apis = [constant.REQUEST_KEY_QUERY, constant.REQUEST_KEY_CREATE, constant.REQUEST_KEY_DROP, constant.REQUEST_KEY_DELETE, constant.REQUEST_KEY_UPDATE, constant.REQUEST_KEY_INSERT, constant.REQUEST_KEY_CREATE_INDEX]
 
 
 def is_request_valid(request_json) -> bool:
@@ -9,13 +9,33 @@ default_field_type_value = {
     'bool': False
 }
 supported_database_types = [constant.DB_TYPE_SQL, constant.DB_TYPE_NOSQL]
+sql_chunk_formats = [constant.CHUNK_FORMAT_CSV, constant.CHUNK_FORMAT_COLUMNAR]  # the first one is the default format
+nosql_chunk_formats = [constant.CHUNK_FORMAT_JSON, constant.CHUNK_FORMAT_NDJSON]
 metadata_ext = ".json"
 merge_sort_ways = 100
 max_chunk_size = 1024
+# max number of records a blocking query operator (e.g. sorting) keeps in memory before spilling onto the disk
+memory_budget = 16 * max_chunk_size
+hash_partition_cnt = 16  # fan-out of hash partitions when aggregation spills
+index_node_size = 128  # max number of keys in a node of B+-tree indexes
+index_cache_size = 1024  # max number of B+-tree nodes cached in memory for each index
+chunk_cache_size = 256 * 1024 * 1024  # max bytes of decoded chunks cached in memory, shared by all tables
+wal_checkpoint_size = 64 * 1024 * 1024  # bytes of the write-ahead log of a table, after which written files are synced and the log is truncated
+server_threads = 8  # max number of requests served concurrently
+scan_workers = 1  # number of processes scanning chunks of a table in parallel, 1 (in the calling process) unless measured to be faster
+parallel_scan_min_chunks = 16  # smaller tables are scanned in the calling process
+import_sample_rows = 1000  # rows sampled to infer field types of an imported csv file
+import_batch_size = 16 * max_chunk_size  # records sent in each insert request when importing through the server
+compaction_interval = 60  # seconds between two rounds of the background compactor
+compaction_min_deleted_ratio = 0.5  # chunks with at least this ratio of rows deleted are compacted
+bloom_filter_fpp = 0.01  # false positive probability of the bloom filter of a full chunk
+bloom_filter_max_join_keys = max_chunk_size  # probe-side chunks of a hash join are only pruned when the build side has fewer distinct keys
+dictionary_max_distinct_ratio = 0.5  # a str column of a columnar chunk with at most this ratio of distinct values is dictionary encoded
 
 class DBConfig:
 
-    def __init__(self, db_type: str, port: int, tables_dir: str, metadata_dir: str, supported_types: list[str], chunk_size: int, file_ext: str):
+    def __init__(self, db_type: str, port: int, tables_dir: str, metadata_dir: str, supported_types: list[str], chunk_size: int, file_ext: str, chunk_formats: list[str],
+                 memory_budget: int, chunk_cache_size: int, scan_workers: int):
         self.db_type = db_type
         self.port = port
         self.tables_dir = tables_dir
@@ -23,6 +43,10 @@ class DBConfig:
         self.supported_field_types = supported_types
         self.max_chunk_size = chunk_size
         self.file_extension = file_ext
+        self.chunk_formats = chunk_formats
+        self.memory_budget = memory_budget
+        self.chunk_cache_size = chunk_cache_size
+        self.scan_workers = scan_workers
 
     def is_sql(self) -> bool:
         return self.get_db_type() == constant.DB_TYPE_SQL
@@ -51,6 +75,21 @@ class DBConfig:
     def get_file_extension(self) -> str:
         return self.file_extension
 
+    def get_supported_chunk_formats(self) -> list[str]:
+        return self.chunk_formats
+
+    def get_default_chunk_format(self) -> str:
+        return self.chunk_formats[0]
+
+    def get_memory_budget(self) -> int:
+        return self.memory_budget
+
+    def get_chunk_cache_size(self) -> int:
+        return self.chunk_cache_size
+
+    def get_scan_workers(self) -> int:
+        return self.scan_workers
+
 
 nosql_cfg = DBConfig(
     db_type=constant.DB_TYPE_NOSQL,
@@ -59,7 +98,11 @@ nosql_cfg = DBConfig(
     metadata_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), constant.METADATA_SUB_DIR, constant.DB_TYPE_NOSQL),
     supported_types=supported_field_types,
     chunk_size=1024,
-    file_ext=".json"
+    file_ext=".json",
+    chunk_formats=nosql_chunk_formats,
+    memory_budget=memory_budget,
+    chunk_cache_size=chunk_cache_size,
+    scan_workers=scan_workers
 )
 
 sql_cfg = DBConfig(
@@ -69,7 +112,11 @@ sql_cfg = DBConfig(
     metadata_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)), constant.METADATA_SUB_DIR, constant.DB_TYPE_SQL),
     supported_types=supported_field_types,
     chunk_size=1024,
-    file_ext=".csv"
+    file_ext=".csv",
+    chunk_formats=sql_chunk_formats,
+    memory_budget=memory_budget,
+    chunk_cache_size=chunk_cache_size,
+    scan_workers=scan_workers
 )
 
 config_map = {
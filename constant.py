@@ -16,12 +16,29 @@ REQUEST_KEY_DROP = "drop"
 REQUEST_KEY_DELETE = "delete"
 REQUEST_KEY_UPDATE = "update"
 REQUEST_KEY_INSERT= "insert"
+REQUEST_KEY_CREATE_INDEX = "create_index"
 
 TABLES_SUB_DIR = "tables"
 METADATA_SUB_DIR = "metadata"
 
 METADATA_TABLE_NAME_KEY = "table_name"
 METADATA_FIELDS_KEY = "fields"
+METADATA_CHUNK_FORMAT_KEY = "format"
+METADATA_BLOOM_FILTER_KEY = "bloom_filter"
+
+CHUNK_FORMAT_CSV = "csv"
+CHUNK_FORMAT_COLUMNAR = "columnar"
+CHUNK_FORMAT_JSON = "json"
+CHUNK_FORMAT_NDJSON = "ndjson"
+COLUMNAR_CHUNK_EXT = ".col"
+NDJSON_CHUNK_EXT = ".ndjson"
+TAIL_LOG_EXT = ".tail"
+TOMBSTONE_EXT = ".del"
+ZONE_MAP_FILE_NAME = "zone_map.json"
+BLOOM_FILTER_FILE_NAME = "bloom_filter.json"
+MANIFEST_FILE_NAME = "manifest.json"
+WAL_FILE_NAME = "wal.log"
+INDEX_DIR_NAME = "_index"
 
 QUERY_OP_KEY = "op"
 QUERY_VAR1_KEY = "v1"
@@ -39,13 +56,20 @@ QUERY_JOIN_TABLE_RIGHT_KEY = "t2"
 QUERY_ORDER_BY_KEY = "order_by"
 QUERY_ORDER_BY_COLUMN_KEY = "column"
 QUERY_ORDER_BY_ASC_KEY = "is_asc"
+QUERY_LIMIT_KEY = "limit"
+QUERY_OFFSET_KEY = "offset"
 QUERY_FILTER_KEY = "row_filter"
 QUERY_GROUP_BY = "group_by"
 
 INSERT_TABLE_NAME_KEY = "table_name"
 INSERT_RECORDS_KEY = "records"
+# bodies of streaming insertion requests, the table name is passed as a query arg
+INSERT_STREAM_NDJSON_MIMETYPE = "application/x-ndjson"
+INSERT_STREAM_CSV_MIMETYPE = "text/csv"
 
 CREATE_TABLE_NAME_KEY = "table_name"
+CREATE_INDEX_TABLE_NAME_KEY = "table_name"
+CREATE_INDEX_COLUMN_KEY = "column"
 DROP_TABLE_NAME_KEY = "table_name"
 
 UPDATE_TABLE_NAME_KEY = "table_name"
@@ -1,92 +1,204 @@
+import argparse
 import csv
-
+import itertools
 import json
 import os
-import sys
+from typing import Iterator
 
 import requests
 
 import config
-
-
-def detect_column_info_from_csv(file_path):
-    res = []
+import constant
+import logger
+
+from app.common.context.context import Context
+from app.common.table.metadata import Metadata
+from app.common.table.table_manager import get_table_manager
+from app.services.database.nosql.converter.converter import NestedJsonConverter
+from app.services.database.nosql.db_factory import DBFactory as NoSQLDBFactory
+from app.services.database.sql.db_factory import DBFactory as SQLDBFactory
+
+# values treated as missing, replaced with the default value of the field type
+missing_values = ["", "N/A"]
+
+# text is read from json files in blocks of this size
+json_read_size = 1024 * 1024
+
+
+def infer_field_type(values: list[str]) -> str:
+    """
+    the narrowest type all sampled values (missing ones are ignored) can be parsed as
+    numbers are always imported as float
+    """
+    values = [value for value in values if value not in missing_values]
+    if len(values) == 0:
+        return 'str'
+    if all(value in ['True', 'False'] for value in values):
+        return 'bool'
+    try:
+        for value in values:
+            float(value)
+        return 'float'
+    except ValueError:
+        return 'str'
+
+
+def detect_column_info_from_csv(file_path: str, sample_size: int = config.import_sample_rows) -> list[dict[str, str]]:
+    # types are inferred from the first sample_size rows, the rest of the file is never read
     with open(file_path, newline='', encoding="utf-8") as csvfile:
         reader = csv.reader(csvfile)
-        rows = list(reader)
-
-        if len(rows) < 2:
-            raise ValueError("CSV file must have at least two rows")
+        field_names = next(reader, None)
+        samples = list(itertools.islice(reader, sample_size))
 
-        field_names = rows[0]
-        second_row = rows[1]
+    if field_names is None or len(samples) == 0:
+        raise ValueError("CSV file must have at least two rows")
 
-        for i, item in enumerate(second_row):
-            field_info = {field_names[i]: 'str'}
-            if item.replace('.', '', 1).isdigit():
-                # if '.' in item:
-                field_info[field_names[i]] = 'float'
-                # else:
-                #     field_info[field_names[i]] = 'int'
-            elif item in ['True', 'False']:
-                field_info[field_names[i]] = 'bool'
+    return [{name: infer_field_type([row[i] for row in samples if i < len(row)])} for i, name in enumerate(field_names)]
 
-            res.append(field_info)
 
-    return res
+def parse_value(item: str, field_type: str) -> object:
+    if item in missing_values:
+        return config.default_field_type_value[field_type]
+    try:
+        if field_type == 'bool':
+            return item == 'True'
+        if field_type == 'float':
+            return float(item)
+        if field_type == 'int':
+            return int(item)
+    except ValueError:
+        # a value out of the sample may not match the inferred type
+        return config.default_field_type_value[field_type]
+    return item
 
 
-def get_records_from_csv(file_path, field_info):
-    res = []
+def iter_records_from_csv(file_path: str, field_info: list[dict[str, str]]) -> Iterator[dict]:
+    fields = [(list(info.keys())[0], list(info.values())[0]) for info in field_info]
     with open(file_path, newline='', encoding="utf-8") as csvfile:
         reader = csv.reader(csvfile)
-        data = list(reader)[1:]
-        for row in data:
-            record = {}
-            for i, item in enumerate(row):
-                field_name, field_type = list(field_info[i].keys())[0], list(field_info[i].values())[0]
-                record[field_name] = eval(field_type)(item if item != "" and item != "N/A" else config.default_field_type_value[field_type])
-            res.append(record)
-    return res
+        next(reader, None)
+        for row in reader:
+            yield {name: parse_value(item, field_type) for (name, field_type), item in zip(fields, row)}
+
+
+def iter_records_from_json(file_path: str) -> Iterator[dict]:
+    """
+    objects of a top-level json array (or newline-delimited json objects), decoded one by one
+    only a block of text and the object being decoded are kept in memory
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, encoding="utf-8") as f:
+        buffer, pos, eof = "", 0, False
+        while True:
+            # skip separators between objects
+            while pos < len(buffer) and (buffer[pos].isspace() or buffer[pos] in "[,]"):
+                pos += 1
+            try:
+                obj, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError:
+                # the object is not complete yet
+                if eof:
+                    if pos < len(buffer):
+                        raise ValueError("invalid json content at offset {} of {}".format(pos, file_path))
+                    return
+                block = f.read(json_read_size)
+                eof = block == ""
+                buffer, pos = buffer[pos:] + block, 0
+                continue
+            yield obj
+            pos = end
+
+
+def batched(records: Iterator[dict], batch_size: int) -> Iterator[list[dict]]:
+    while True:
+        batch = list(itertools.islice(records, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+def import_online(base_url: str, table_name: str, field_info: list[dict[str, str]], records: Iterator[dict]):
+    """
+    send records to the running server, in requests of import_batch_size records
+    """
+    drop_url = "/".join([base_url, "drop"])
+    create_url = "/".join([base_url, "create"])
+    insert_url = "/".join([base_url, "insert"])
 
+    print("dropping current table: {}".format(table_name))
+    response = requests.get(drop_url, json=json.dumps({"table_name": table_name}))
+    print(response.text)
+    print("creating new table: {}, field_info: {}".format(table_name, field_info))
+    response = requests.get(create_url, json=json.dumps({"table_name": table_name, "fields": field_info}))
+    print(response.text)
+    cnt = 0
+    for batch in batched(records, config.import_batch_size):
+        response = requests.get(insert_url, json=json.dumps({"table_name": table_name, "records": batch}))
+        if response.status_code != 200:
+            print("failed to insert records #{}-#{}: {}".format(cnt, cnt + len(batch), response.text))
+            return
+        cnt += len(batch)
+    print("#{} records are inserted into table {}".format(cnt, table_name))
+
+
+def import_offline(db_type: str, table_name: str, field_info: list[dict[str, str]], records: Iterator[dict], index_columns: list[str]):
+    """
+    write chunks directly into the tables dir, the server of the database must not be running
+    the manifest, statistics and indexes are built in the same pass
+    """
+    cfg = config.config_map[db_type]
+    ctx = Context(logger.get_logger(db_type), cfg, SQLDBFactory.instance() if cfg.is_sql() else NoSQLDBFactory.instance())
+    tm = get_table_manager(ctx)
+    ctx.set_table_manager(tm)
+    if not tm.start().ok():
+        raise RuntimeError("failed to start table manager")
+
+    if table_name in tm.table_map:
+        print("dropping current table: {}".format(table_name))
+        tm.drop_table(table_name)
+    print("creating new table: {}, field_info: {}".format(table_name, field_info))
+    table, status = tm.create_table(table_name, Metadata(table_name, db_type, field_info))
+    if not status.ok():
+        raise RuntimeError("failed to create table {}".format(table_name))
+    # indexes of an empty table are maintained while chunks are written
+    for column in index_columns:
+        if not table.create_index(column).ok():
+            raise RuntimeError("failed to create index on column {}".format(column))
+
+    if cfg.is_nosql():
+        records = (NestedJsonConverter.flatten_json_obj(record) for record in records)
+    status = table.bulk_load(batched(records, cfg.get_max_chunk_size()))
+    if not status.ok():
+        raise RuntimeError("failed to load records into table {}".format(table_name))
+    print("#{} chunks are written into table {}".format(table.chunk_manager.get_chunk_cnt(), table_name))
 
-usage = "usage: python3 import_data.py ${file_path}, only support csv or json"
 
 if __name__ == "__main__":
-    if len(sys.argv) != 2:
-        print(usage)
-        exit(1)
-    file_path = sys.argv[1]
-    file_dir, file_name = os.path.dirname(file_path), os.path.basename(file_path)
-    table_name, file_type = os.path.splitext(file_name)[0], os.path.splitext(file_name)[1]
+    parser = argparse.ArgumentParser(description="import a csv file into the sql database or a json file into the nosql database, "
+                                                 "the table is named after the file")
+    parser.add_argument("file_path", help="csv file, json array or newline-delimited json objects")
+    parser.add_argument("--offline", action="store_true", help="write chunks directly instead of sending records to the server, which must be stopped")
+    parser.add_argument("--index", action="append", default=[], help="column to build an index on (offline sql import only), may be repeated")
+    args = parser.parse_args()
+
+    file_path = args.file_path
+    table_name, file_type = os.path.splitext(os.path.basename(file_path))
     field_info = []
-    records = []
 
-    base_url = "http://localhost:{}"
     if file_type == ".csv":
-        base_url = base_url.format("9528")
+        db_type = constant.DB_TYPE_SQL
         print("csv file detected, will be inserted into sql database")
         field_info = detect_column_info_from_csv(file_path)
-        records = get_records_from_csv(file_path, field_info)
-    elif file_type == ".json":
-        base_url = base_url.format("9527")
-        with open(file_path) as f:
-            records = json.load(f)
+        records = iter_records_from_csv(file_path, field_info)
+    elif file_type in [".json", ".ndjson", ".jsonl"]:
+        db_type = constant.DB_TYPE_NOSQL
         print("json file detected, will be inserted into nosql database")
+        records = iter_records_from_json(file_path)
     else:
-        print(usage)
+        parser.print_usage()
         exit(1)
 
-    drop_url = "/".join([base_url, "drop"])
-    create_url = "/".join([base_url, "create"])
-    insert_url = "/".join([base_url, "insert"])
-
-    print("dropping current table: {}".format(table_name))
-    response = requests.get(drop_url, json=json.dumps({"table_name": table_name}))
-    print(response.text)
-    print("creating new table: {}, field_info: {}".format(table_name, field_info))
-    requests.get(create_url, json=json.dumps({"table_name": table_name, "fields": field_info}))
-    print(response.text)
-    print("inserting #{} records into table {}".format(len(records), table_name))
-    requests.get(insert_url, json=json.dumps({"table_name": table_name, "records": records}))
-    print(response.text)
+    if args.offline:
+        import_offline(db_type, table_name, field_info, records, args.index)
+    else:
+        import_online("http://localhost:{}".format(config.config_map[db_type].get_port()), table_name, field_info, records)